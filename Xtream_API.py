@@ -1,182 +1,109 @@
-from flask import Flask, request, jsonify
-import joblib
-import pandas as pd
-import numpy as np
-import os
-import logging
-from src.pipelines.predict_pipeline import PredictPipeline, CustomData
-from src.pipelines.train_pipeline import TrainPipeline, CustomTrainData
+from flask import Flask, Response, request, jsonify
+from src.logger import get_logger
+from src.metrics import metrics, CONTENT_TYPE
+from src.startup import startup, health, NotReady
+from src import wire_format
 
 app = Flask('Xtream Diamond Price Prediction')
 
+logger = get_logger('Xtream_API', 'XtreamAPI.log')
+logger.info("API started")
 
+# The heavy imports, the model loading and the warmup run apart from the health check (see
+# src/startup.py). Requests wait for them, then the models are hot reloaded when the artifacts change.
+startup.start()
 
-# Set up the logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
-# Create a log folder if it doesn't exist
-log_dir = 'log'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+@app.errorhandler(NotReady)
+def not_ready(error):
+    return jsonify({'error': str(error)}), 503
 
+@app.errorhandler(wire_format.UnsupportedFormat)
+def unsupported_format(error):
+    return jsonify({'error': str(error)}), 415
 
-# Set up the file handler
-handler = logging.FileHandler(filename=os.path.join(log_dir, 'XtreamAPI.log'), mode='a')
-handler.setLevel(logging.INFO)
-# Set up the formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-# Add the handler to the logger
-logger.addHandler(handler)
+@app.errorhandler(wire_format.InvalidPayload)
+def invalid_payload(error):
+    return jsonify({'error': str(error)}), 400
 
 
-logger.info("API started")
+def read_payload():
+    # JSON by default, or a columnar binary body decoded into NumPy columns (see src/wire_format.py).
+    # Decoded like the ASGI app does: bodies of any other content type are read as JSON.
+    body_format = wire_format.request_format(request.content_type)
+    try:
+        return wire_format.decode_request(request.get_data(), body_format)
+    except (wire_format.UnsupportedFormat, wire_format.InvalidPayload):
+        raise
+    except ValueError:
+        raise wire_format.InvalidPayload('The request body must be valid JSON.')
+
+
+def respond(result):
+    # Response in the format asked by the Accept header, JSON by default
+    response_format = wire_format.response_format(request.headers.get('Accept'))
+    if response_format == wire_format.JSON:
+        return jsonify(result)
+    return Response(wire_format.encode_response(result, response_format), content_type=response_format)
+
 # -----------------------------------------------------------------------------------
 #                            Health check
 # -----------------------------------------------------------------------------------
 @app.get("/")
 def home():
-    return{"Health_check": "OK"} 
+    return health()
+
+@app.get("/ready")
+def ready():
+    # Readiness check, with the duration of every startup phase
+    return jsonify(startup.report()), 200 if startup.is_ready() else 503
+
+@app.get("/stats")
+def stats():
+    return jsonify(dict(startup.service().stats(), startup=startup.report()))
+
+@app.get("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape endpoint
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    logger.info("Processing request")
+    # Get input data from request
+    with metrics.stage('predict_request', 'parse'):
+        input_data = read_payload()
 
-    try:
-        # Get input data from request
-        input_data = request.get_json()
-
-        # Log the input features
-        logger.info("Input features: %s", input_data)
-
-        # Check if the input is a single set of features or a list of sets
-        if isinstance(input_data, list):
-
-            logger.info("List request received. Processing input...")
-
-            # Handle multiple sets of features
-            features_list = []
-            for data in input_data:
-                features = CustomData(
-                    carat=data['carat'],
-                    cut=data['cut'],
-                    color=data['color'],
-                    clarity=data['clarity'],
-                    depth=data['depth'],
-                    table=data['table'],
-                    x=data['x'],
-                    y=data['y'],
-                    z=data['z']
-                )
-                features_list.append(features.get_data_as_data_frame())
-            features_df = pd.concat(features_list, ignore_index=True)
-        else:
-
-            logger.info("Single request received. Processing input...")
-
-            # Handle a single set of features
-            features = CustomData(
-                carat=input_data['carat'],
-                cut=input_data['cut'],
-                color=input_data['color'],
-                clarity=input_data['clarity'],
-                depth=input_data['depth'],
-                table=input_data['table'],
-                x=input_data['x'],
-                y=input_data['y'],
-                z=input_data['z']
-            )
-            features_df = features.get_data_as_data_frame()
-
-        # Make predictions
-        prediction_pipeline = PredictPipeline()
-        predictions = prediction_pipeline.predict(features = features_df)
-
-        # Return the predictions
-        result = {'predicted_prices': predictions.tolist()} if len(predictions) > 1 else {'predicted_price': float(predictions)}
-
-        # Log the predictions
-        logger.info("Predictions: %s", result)
-
-        logger.info("Prediction complete")
-        return jsonify(result)
+    # Optional latency budget of this request, past it the ensemble is degraded
+    budget_ms = request.headers.get('X-Latency-Budget-Ms', type=float)
+    return respond(startup.service().predict(input_data, budget_ms=budget_ms))
+
+
+@app.route('/predict/bulk', methods=['POST'])
+def predict_bulk():
+    # Stream the CSV/NDJSON body through the models, the results are sent back as NDJSON chunk by chunk
+    results = startup.service().predict_bulk(request.stream, request.content_type,
+                                               chunk_size=request.args.get('chunk_size', type=int))
 
-    except Exception as e:
-        logger.exception("An error occurred: %s", str(e))
-        return jsonify({'error': str(e)})
+    return Response(results, mimetype='application/x-ndjson')
 
 
 @app.route("/train", methods=['POST'])
 def train():
-    logger.info("Processing training request")
+    # Get input data from request
+    with metrics.stage('train_request', 'parse'):
+        input_data = read_payload()
 
-    try:
-        # Get input data from request
-        input_data = request.get_json()
-
-        # Log the input features
-        logger.info("Input features: %s", input_data)
-
-        # Check if the input is a single set of features or a list of sets
-        if isinstance(input_data, list):
-
-            logger.info("List request received. Processing input...")
-
-            # Handle multiple sets of features
-            features_list = []
-            for data in input_data:
-                features = CustomTrainData(
-                    carat=data['carat'],
-                    cut=data['cut'],
-                    color=data['color'],
-                    clarity=data['clarity'],
-                    depth=data['depth'],
-                    table=data['table'],
-                    x=data['x'],
-                    y=data['y'],
-                    z=data['z'],
-                    price=data['price']
-                )
-                features_list.append(features.get_data_as_data_frame())
-            features_df = pd.concat(features_list, ignore_index=True)
-        else:
-
-            logger.info("Single request received. Processing input...")
-
-            # Handle a single set of features
-            features = CustomTrainData(
-                carat=input_data['carat'],
-                cut=input_data['cut'],
-                color=input_data['color'],
-                clarity=input_data['clarity'],
-                depth=input_data['depth'],
-                table=input_data['table'],
-                x=input_data['x'],
-                y=input_data['y'],
-                z=input_data['z'],
-                price=input_data['price']
-            )
-            features_df = features.get_data_as_data_frame()
-
-        # Check if the 'price' feature is present
-        if 'price' not in features_df.columns:
-            logger.error("The 'price' feature is missing from the input data.")
-            return jsonify({'error': "The 'price' feature is missing from the input data."})
-
-        # Train the model
-        training_pipeline = TrainPipeline()
-        training_pipeline.train(features_df)
-
-        # Return a success message
-        result = {'message': f"The model has been partially trained with {features_df.shape[0]} samples successfully."}
-        logger.info("Training complete")
-        return jsonify(result)
+    return respond(startup.service().train(input_data))
+
+
+@app.get("/train/<job_id>")
+def train_status(job_id):
+    result = startup.service().train_status(job_id)
+    if result is None:
+        return jsonify({'error': f"Unknown training job '{job_id}'."}), 404
 
-    except Exception as e:
-        logger.exception("An error occurred: %s", str(e))
-        return jsonify({'error': str(e)})
+    return jsonify(result)
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,326 @@
+"""
+ASGI entry point of the Xtream Diamond Price Prediction API.
+
+It exposes the same '/', '/ready', '/stats', '/metrics', '/predict', '/predict/bulk', '/train'
+and '/train/<job_id>' contracts as Xtream_API.py, with the same startup (src/startup.py). The CPU-bound model work runs in bounded worker
+pools (a separate one for training, so a slow /train never blocks predictions) and requests are
+answered with HTTP 503 when the queue is full.
+
+Run it with any ASGI server, e.g.:
+    uvicorn Xtream_ASGI:app --host 0.0.0.0 --port 5000 --workers 4
+
+Settings (environment variables):
+    XTREAM_ASGI_POOL: 'thread' (default) or 'process'. The pool processes are forked once the
+        models are loaded and warmed, and share them.
+    XTREAM_ASGI_PREDICT_WORKERS: Size of the prediction pool (default: number of CPUs).
+    XTREAM_ASGI_TRAIN_WORKERS: Size of the training pool (default 1).
+    XTREAM_ASGI_MAX_PENDING: Requests allowed in flight or queued per pool before answering 503 (default 64).
+    XTREAM_ASGI_BULK_WORKERS: Bulk scoring streams served at the same time, others get a 503 (default 2).
+"""
+
+import io
+import os
+import json
+import asyncio
+import threading
+import multiprocessing
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from src.logger import get_logger
+from src.metrics import metrics, CONTENT_TYPE
+from src.startup import startup, health, NotReady
+from src import wire_format
+
+
+logger = get_logger('Xtream_API', 'XtreamAPI.log')
+
+
+POOL_KIND = os.environ.get('XTREAM_ASGI_POOL', 'thread')
+PREDICT_WORKERS = int(os.environ.get('XTREAM_ASGI_PREDICT_WORKERS', os.cpu_count() or 1))
+TRAIN_WORKERS = int(os.environ.get('XTREAM_ASGI_TRAIN_WORKERS', 1))
+MAX_PENDING = int(os.environ.get('XTREAM_ASGI_MAX_PENDING', 64))
+BULK_WORKERS = int(os.environ.get('XTREAM_ASGI_BULK_WORKERS', 2))
+
+
+def _init_process_worker():
+    # Every pool process keeps its own models: the ones loaded before the fork, hot reloaded on their own
+    from src import api_service
+    api_service.start_model_serving()
+
+
+class BoundedPool:
+    """
+    Worker pool that refuses new work once max_pending tasks are running or waiting.
+    """
+
+    def __init__(self, max_workers, max_pending, kind='thread', name='worker'):
+        if kind == 'process':
+            # Forked on first use, after the startup loaded and warmed the models
+            context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_process_worker,
+                                                mp_context=context)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, func, *args):
+        """
+        Run func in the pool. The caller holds a slot from try_acquire until it releases it.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+predict_pool = BoundedPool(PREDICT_WORKERS, MAX_PENDING, kind=POOL_KIND, name='predict')
+train_pool = BoundedPool(TRAIN_WORKERS, MAX_PENDING, kind=POOL_KIND, name='train')
+# Bulk streams talk to the client while they score, so they always run in threads of this process
+bulk_pool = BoundedPool(BULK_WORKERS, BULK_WORKERS, kind='thread', name='bulk')
+
+# POST routes, the name of their src.api_service handler and the pool that serves them
+POST_ROUTES = {
+    '/predict': ('predict', predict_pool),
+    '/train': ('train', train_pool),
+}
+
+# The heavy imports, the model loading and the warmup run apart from the health check (see src/startup.py)
+startup.start()
+
+
+async def _service(send):
+    """
+    Return the service module once the process is ready, without blocking the event loop.
+    If it can't serve, answer HTTP 503 and return None.
+    """
+    try:
+        if startup.is_ready():
+            return startup.service()
+        return await asyncio.get_running_loop().run_in_executor(None, startup.service)
+    except NotReady as e:
+        await _send_json(send, {'error': str(e)}, status=503)
+        return None
+
+
+async def _send_json(send, payload, status=200):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_text(send, text, content_type=CONTENT_TYPE, status=200):
+    await _send_bytes(send, text.encode('utf-8'), content_type, status)
+
+
+async def _send_bytes(send, body, content_type, status=200):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _latency_budget(scope):
+    # Optional latency budget of a /predict request, in milliseconds
+    value = dict(scope.get('headers', [])).get(b'x-latency-budget-ms')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+class _ReceiveStream(io.RawIOBase):
+    """
+    Binary file object over the request body, read from a worker thread. Body messages
+    are received only when the reader needs more data, so the body is never buffered.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            self._buffer = message.get('body', b'')
+            self._more_body = message['type'] == 'http.request' and message.get('more_body', False)
+
+        n = min(len(buffer), len(self._buffer))
+        buffer[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _stream_bulk(service, scope, receive, send, loop):
+    """
+    Serve a /predict/bulk request from a worker thread: read the body, score it chunk by
+    chunk and send every chunk of results as soon as it is ready.
+    """
+    def call(coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    headers = dict(scope.get('headers', []))
+    content_type = headers.get(b'content-type', b'').decode('latin-1')
+    chunk_size = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('chunk_size', [None])[0]
+
+    stream = io.BufferedReader(_ReceiveStream(receive, loop))
+    results = service.predict_bulk(stream, content_type, chunk_size=int(chunk_size) if chunk_size and chunk_size.isdigit() else None)
+
+    call(send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/x-ndjson')],
+    }))
+    for lines in results:
+        call(send({'type': 'http.response.body', 'body': lines, 'more_body': True}))
+    call(send({'type': 'http.response.body', 'body': b''}))
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            logger.info("ASGI API started")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            predict_pool.shutdown()
+            train_pool.shutdown()
+            bulk_pool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path'].rstrip('/') or '/'
+    method = scope['method']
+
+    if method == 'GET' and path == '/':
+        await _send_json(send, health())
+    elif method == 'GET' and path == '/ready':
+        await _send_json(send, startup.report(), status=200 if startup.is_ready() else 503)
+    elif method == 'GET' and path == '/stats':
+        service = await _service(send)
+        if service is not None:
+            await _send_json(send, dict(service.stats(), startup=startup.report()))
+    elif method == 'GET' and path == '/metrics':
+        await _send_text(send, metrics.render())
+    elif method == 'GET' and path.startswith('/train/'):
+        service = await _service(send)
+        if service is None:
+            return
+        job_id = path[len('/train/'):]
+        # The job queue is a SQLite database, read off the event loop
+        result = await asyncio.get_running_loop().run_in_executor(None, service.train_status, job_id)
+        if result is None:
+            await _send_json(send, {'error': f"Unknown training job '{job_id}'."}, status=404)
+        else:
+            await _send_json(send, result)
+    elif path == '/predict/bulk':
+        if method != 'POST':
+            await _send_json(send, {'error': 'Method not allowed'}, status=405)
+            return
+
+        service = await _service(send)
+        if service is None:
+            return
+
+        if not bulk_pool.try_acquire():
+            logger.warning("Rejecting %s request, the worker pool is full", path)
+            await _send_json(send, {'error': 'Server busy, please retry later.'}, status=503)
+            return
+
+        try:
+            await bulk_pool.run(_stream_bulk, service, scope, receive, send, asyncio.get_running_loop())
+        finally:
+            bulk_pool.release()
+    elif path in POST_ROUTES:
+        if method != 'POST':
+            await _send_json(send, {'error': 'Method not allowed'}, status=405)
+            return
+
+        service = await _service(send)
+        if service is None:
+            return
+        handler_name, pool = POST_ROUTES[path]
+        handler = getattr(service, handler_name)
+
+        # Backpressure: refuse the request before reading it if the pool is saturated
+        if not pool.try_acquire():
+            logger.warning("Rejecting %s request, the worker pool is full", path)
+            await _send_json(send, {'error': 'Server busy, please retry later.'}, status=503)
+            return
+
+        headers = dict(scope.get('headers', []))
+        try:
+            body = await _read_body(receive)
+            try:
+                # JSON by default, or a columnar binary body decoded into NumPy columns (see src/wire_format.py)
+                with metrics.stage(f'{path[1:]}_request', 'parse'):
+                    body_format = wire_format.request_format(headers.get(b'content-type', b'').decode('latin-1'))
+                    input_data = wire_format.decode_request(body, body_format)
+            except wire_format.UnsupportedFormat as e:
+                await _send_json(send, {'error': str(e)}, status=415)
+                return
+            except wire_format.InvalidPayload as e:
+                await _send_json(send, {'error': str(e)}, status=400)
+                return
+            except ValueError:
+                await _send_json(send, {'error': 'The request body must be valid JSON.'}, status=400)
+                return
+
+            # Past its latency budget, a prediction is served by a degraded ensemble
+            args = (input_data, _latency_budget(scope)) if path == '/predict' else (input_data,)
+            result = await pool.run(handler, *args)
+        finally:
+            pool.release()
+
+        # Response in the format asked by the Accept header, JSON by default
+        response_format = wire_format.response_format(headers.get(b'accept', b'').decode('latin-1'))
+        try:
+            response_body = wire_format.encode_response(result, response_format)
+        except wire_format.UnsupportedFormat as e:
+            await _send_json(send, {'error': str(e)}, status=415)
+            return
+        await _send_bytes(send, response_body, response_format)
+    else:
+        await _send_json(send, {'error': 'Not found'}, status=404)
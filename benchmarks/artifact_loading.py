@@ -0,0 +1,103 @@
+"""
+Benchmark of the artifact formats: load time and memory (RSS) of the serving artifacts
+stored as pickle versus the native formats of src/artifact_format.py.
+
+Every measurement runs in a fresh Python process, so it reflects a cold start of an API worker.
+
+Usage:
+    python benchmarks/artifact_loading.py [--artifacts-dir artifacts] [--repeats 5]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.artifact_format import NATIVE_FILE_NAMES, export_native
+
+
+# Code run in the child process: import the libraries, then time the loading of the artifacts
+_CHILD = r"""
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, {root!r})
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+import numpy, sklearn.ensemble, xgboost
+from src.artifact_format import load_artifact
+
+rss_before = rss_mb()
+start = time.perf_counter()
+artifacts = [load_artifact(path) for path in {paths!r}]
+load_seconds = time.perf_counter() - start
+rss_after = rss_mb()
+
+print(json.dumps({{'load_seconds': load_seconds, 'rss_mb': rss_after - rss_before}}))
+"""
+
+
+def measure(paths, repeats):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', _CHILD.format(root=root, paths=paths)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    load_times = sorted(run['load_seconds'] for run in runs)
+    return {
+        'load_seconds_median': load_times[len(load_times) // 2],
+        'load_seconds_min': load_times[0],
+        'rss_mb': max(run['rss_mb'] for run in runs),
+        'size_mb': sum(os.path.getsize(path) for path in paths) / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--artifacts-dir', default='artifacts', help='Directory with the pickled serving artifacts')
+    parser.add_argument('--repeats', type=int, default=5, help='Cold loads per format')
+    args = parser.parse_args()
+
+    pickle_paths = [os.path.join(args.artifacts_dir, name) for name in NATIVE_FILE_NAMES]
+    missing = [path for path in pickle_paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f"Missing artifacts: {missing}")
+
+    native_dir = tempfile.mkdtemp(prefix='xtream-native-')
+    try:
+        export_native(args.artifacts_dir, native_dir)
+        native_paths = [os.path.join(native_dir, NATIVE_FILE_NAMES[name]) for name in NATIVE_FILE_NAMES]
+
+        results = {
+            'pickle': measure(pickle_paths, args.repeats),
+            'native': measure(native_paths, args.repeats),
+        }
+    finally:
+        shutil.rmtree(native_dir, ignore_errors=True)
+
+    print(f"{'format':<8} {'load (median)':>14} {'load (min)':>11} {'RSS delta':>10} {'size':>9}")
+    for name, result in results.items():
+        print(f"{name:<8} {result['load_seconds_median'] * 1000:>11.1f} ms {result['load_seconds_min'] * 1000:>8.1f} ms "
+              f"{result['rss_mb']:>7.1f} MB {result['size_mb']:>6.1f} MB")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""
+Benchmark suite of the prediction and training paths, with regression tracking.
+
+Scenarios (each group runs in a fresh Python process, from the repository root):
+    predict: PredictPipeline.predict_with_mask on decoded batches.
+    api: POST /predict through the Flask app (in-process test client), JSON encoding included.
+    train: TrainPipeline.update on buffered samples (appending boosting rounds and the holdout
+        check; the updates are never promoted, so the served models don't change).
+    cold: Import, model loading and first prediction of a new process.
+
+The batches are drawn from datasets/diamonds/diamonds.csv (with replacement when larger than the
+file). Latency percentiles, throughput and memory (RSS) are reported and can be saved as JSON
+with --output. A run compared with a saved baseline (--baseline) exits with status 1 if a metric
+regressed by more than --tolerance.
+
+The prediction cache is disabled, so repeated batches always reach the models. Recorded /predict
+payloads (one JSON payload per line) can be replayed with --payloads.
+
+Usage:
+    python benchmarks/suite.py --output benchmarks/baseline.json
+    python benchmarks/suite.py --baseline benchmarks/baseline.json --tolerance 0.2
+    python benchmarks/suite.py --scenarios predict api --batch-sizes 1 100 10000 --seconds 5
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ['predict', 'api', 'train', 'cold']
+DATA_PATH = os.path.join('datasets', 'diamonds', 'diamonds.csv')
+
+# Direction of the metrics compared with the baseline
+HIGHER_IS_WORSE = ('p50_ms', 'p95_ms', 'seconds_median', 'rss_mb', 'peak_rss_mb', 'after_load_rss_mb')
+LOWER_IS_WORSE = ('rows_per_second',)
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def time_calls(func, seconds, max_iterations, warmup=3, min_iterations=5):
+    """
+    Call func repeatedly for about `seconds` (at least min_iterations times, at most max_iterations)
+    after a few warmup calls, and return the duration of every call.
+    """
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    deadline = time.perf_counter() + seconds
+    while len(durations) < max_iterations and (len(durations) < min_iterations or time.perf_counter() < deadline):
+        started_at = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+def summarize(durations, rows):
+    """
+    Latency percentiles (ms) and throughput (rows/s) of timed calls processing `rows` rows each.
+    """
+    milliseconds = np.asarray(durations) * 1000
+    return {
+        'rows': rows,
+        'iterations': len(durations),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'rows_per_second': rows * len(durations) / float(np.sum(durations)),
+    }
+
+
+def sample_rows(data, n_rows, seed=42):
+    return data.sample(n=n_rows, replace=n_rows > data.shape[0], random_state=seed).reset_index(drop=True)
+
+
+# -----------------------------------------------------------------------------------
+#                            Child processes
+# -----------------------------------------------------------------------------------
+
+def _run_group(config):
+    """
+    Run the warm scenarios of a group in this process and return their results.
+    """
+    import warnings
+    warnings.filterwarnings('ignore')
+    import pandas as pd
+    from src.model_registry import model_registry
+
+    data = pd.read_csv(DATA_PATH)
+    features = data.drop(columns='price')
+    results = {}
+    after_load_rss = None
+
+    if config['group'] == 'predict':
+        from src.decoding import decode_features
+        from src.pipelines.predict_pipeline import PredictPipeline
+
+        model_registry.load()
+        after_load_rss = rss_mb()
+        pipeline = PredictPipeline()
+        for n_rows in config['batch_sizes']:
+            batch = decode_features(sample_rows(features, n_rows).to_dict(orient='list'))
+            durations = time_calls(lambda: pipeline.predict_with_mask(batch), config['seconds'], config['max_iterations'])
+            results[f'predict/{n_rows}'] = summarize(durations, n_rows)
+
+    elif config['group'] == 'api':
+        import Xtream_API
+
+        client = Xtream_API.app.test_client()
+        # The models load in the background (src/startup.py), wait until they are served
+        Xtream_API.startup.service()
+        after_load_rss = rss_mb()
+
+        def post(payload):
+            response = client.post('/predict', json=payload)
+            if response.status_code != 200 or 'error' in response.json:
+                raise RuntimeError(f"/predict failed: {response.get_data(as_text=True)[:200]}")
+
+        for n_rows in config['batch_sizes']:
+            records = sample_rows(features, n_rows).to_dict(orient='records')
+            payload = records[0] if n_rows == 1 else records
+            durations = time_calls(lambda: post(payload), config['seconds'], config['max_iterations'])
+            results[f'api/{n_rows}'] = summarize(durations, n_rows)
+
+        if config.get('payloads'):
+            with open(config['payloads'], encoding='utf-8') as lines:
+                payloads = [json.loads(line) for line in lines if line.strip()]
+            durations, n_rows = [], 0
+            for payload in payloads:
+                started_at = time.perf_counter()
+                post(payload)
+                durations.append(time.perf_counter() - started_at)
+                n_rows += len(payload) if isinstance(payload, list) else 1
+            results['api/replay'] = summarize(durations, n_rows / len(payloads))
+
+    elif config['group'] == 'train':
+        from src.utils import FeatureMatrixCache
+        from src.pipelines.train_pipeline import TrainPipeline, FreshDataBuffer
+
+        model_registry.load()
+        scratch = tempfile.mkdtemp(prefix='xtream-bench-')
+        try:
+            # Never promoted: the served booster stays the same for every iteration
+            pipeline = TrainPipeline(buffer=FreshDataBuffer(os.path.join(scratch, 'buffer.csv')),
+                                     max_rmse_increase=-1.0,
+                                     feature_cache=FeatureMatrixCache(os.path.join(scratch, 'feature_cache')))
+            for n_rows in config['train_sizes']:
+                samples = sample_rows(data, n_rows)
+
+                def update():
+                    pipeline.buffer.append(samples)
+                    pipeline.update()
+
+                durations = time_calls(update, config['seconds'], config['max_iterations'], warmup=1)
+                results[f'train/{n_rows}'] = summarize(durations, n_rows)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    memory = {'rss_mb': rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+    if after_load_rss is not None:
+        memory['after_load_rss_mb'] = after_load_rss
+    results[f"memory/{config['group']}"] = memory
+    return results
+
+
+def _run_cold():
+    """
+    Time the start of a serving process: imports, model loading and the first prediction.
+    """
+    started_at = time.perf_counter()
+    import warnings
+    warnings.filterwarnings('ignore')
+    from src.decoding import decode_features
+    from src.model_registry import model_registry
+    from src.pipelines.predict_pipeline import PredictPipeline
+    imported_at = time.perf_counter()
+
+    model_registry.load()
+    loaded_at = time.perf_counter()
+
+    row = {'carat': 0.5, 'cut': 'Ideal', 'color': 'E', 'clarity': 'SI1', 'depth': 61.5,
+           'table': 55.0, 'x': 5.0, 'y': 5.1, 'z': 3.0}
+    PredictPipeline().predict_with_mask(decode_features(row))
+    predicted_at = time.perf_counter()
+
+    return {
+        'import_seconds': imported_at - started_at,
+        'load_seconds': loaded_at - imported_at,
+        'first_prediction_seconds': predicted_at - loaded_at,
+        'rss_mb': rss_mb(),
+    }
+
+
+def run_child(config, log_dir):
+    """
+    Run a group of scenarios (or a cold start) in a fresh process and return its results.
+    """
+    env = dict(os.environ)
+    env.update({
+        'XTREAM_PREDICTION_CACHE': '0',
+        'XTREAM_TRAIN_ASYNC': '0',
+        'XTREAM_LOG_DIR': log_dir,
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    started_at = time.perf_counter()
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                               cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started_at
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark {config['group']} failed:\n{completed.stderr[-2000:]}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    return result, elapsed
+
+
+def run_suite(scenarios, batch_sizes, train_sizes, seconds, max_iterations, cold_repeats, payloads=None):
+    """
+    Run the selected scenarios and return the results with the environment they were measured in.
+    """
+    log_dir = tempfile.mkdtemp(prefix='xtream-bench-logs-')
+    results = {}
+    try:
+        for group in scenarios:
+            if group == 'cold':
+                runs = []
+                for _ in range(cold_repeats):
+                    run, elapsed = run_child({'group': 'cold'}, log_dir)
+                    run['process_seconds'] = elapsed
+                    runs.append(run)
+                results['cold'] = {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+                results['cold']['seconds_median'] = results['cold'].pop('process_seconds')
+                results['cold']['repeats'] = cold_repeats
+                continue
+
+            config = {'group': group, 'batch_sizes': batch_sizes, 'train_sizes': train_sizes,
+                      'seconds': seconds, 'max_iterations': max_iterations, 'payloads': payloads}
+            run, _ = run_child(config, log_dir)
+            results.update(run)
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    return {'environment': environment(), 'results': results}
+
+
+def environment():
+    import sklearn
+    import xgboost
+    from src.model_registry import model_store
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'model_version': model_store.current_version() or 'legacy',
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'xgboost': xgboost.__version__,
+        'scikit-learn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'micro_batching': os.environ.get('XTREAM_MICRO_BATCHING', '1') == '1',
+    }
+
+
+# -----------------------------------------------------------------------------------
+#                            Baseline comparison
+# -----------------------------------------------------------------------------------
+
+def compare(current, baseline, tolerance):
+    """
+    Compare the results of a run with a baseline.
+
+    Parameters:
+    current, baseline (dict): Results of run_suite.
+    tolerance (float): Relative degradation allowed, e.g. 0.2 for 20%.
+
+    Returns:
+    list: (scenario, metric, baseline value, current value, relative degradation, regressed) tuples.
+    """
+    rows = []
+    for scenario, baseline_metrics in baseline['results'].items():
+        current_metrics = current['results'].get(scenario)
+        if current_metrics is None:
+            continue
+        for metric, baseline_value in baseline_metrics.items():
+            value = current_metrics.get(metric)
+            if value is None or not baseline_value:
+                continue
+            if metric in HIGHER_IS_WORSE:
+                degradation = value / baseline_value - 1
+            elif metric in LOWER_IS_WORSE:
+                degradation = baseline_value / value - 1 if value else float('inf')
+            else:
+                continue
+            rows.append((scenario, metric, baseline_value, value, degradation, degradation > tolerance))
+    return rows
+
+
+def print_results(results):
+    print(f"{'scenario':<16} {'p50':>10} {'p95':>10} {'p99':>10} {'rows/s':>12} {'iters':>6}")
+    for scenario, metrics in results['results'].items():
+        if 'p50_ms' in metrics:
+            print(f"{scenario:<16} {metrics['p50_ms']:>7.2f} ms {metrics['p95_ms']:>7.2f} ms "
+                  f"{metrics['p99_ms']:>7.2f} ms {metrics['rows_per_second']:>12.0f} {metrics['iterations']:>6}")
+    for scenario, metrics in results['results'].items():
+        if 'p50_ms' not in metrics:
+            print(f"{scenario:<16} " + ', '.join(f"{key}={value:.3f}" for key, value in metrics.items()))
+
+
+def print_comparison(rows, tolerance):
+    print(f"\nComparison with the baseline (tolerance {tolerance:.0%}):")
+    print(f"{'scenario':<16} {'metric':<16} {'baseline':>12} {'current':>12} {'change':>8}")
+    for scenario, metric, baseline_value, value, degradation, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{scenario:<16} {metric:<16} {baseline_value:>12.3f} {value:>12.3f} {degradation:>+7.1%}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS, help='Scenario groups to run')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 100, 10000], help='Rows per prediction request')
+    parser.add_argument('--train-sizes', nargs='+', type=int, default=[100, 1000], help='Buffered samples per training update')
+    parser.add_argument('--seconds', type=float, default=3.0, help='Time spent on every scenario')
+    parser.add_argument('--max-iterations', type=int, default=1000, help='Maximum calls per scenario')
+    parser.add_argument('--cold-repeats', type=int, default=3, help='Cold starts measured')
+    parser.add_argument('--payloads', help='NDJSON file of recorded /predict payloads to replay')
+    parser.add_argument('--output', help='Save the results as JSON')
+    parser.add_argument('--baseline', help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative degradation allowed before failing')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        config = json.loads(args.child)
+        result = _run_cold() if config['group'] == 'cold' else _run_group(config)
+        print(json.dumps(result))
+        return 0
+
+    results = run_suite(args.scenarios, args.batch_sizes, args.train_sizes, args.seconds, args.max_iterations,
+                        args.cold_repeats, os.path.abspath(args.payloads) if args.payloads else None)
+    print_results(results)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file_obj:
+            json.dump(results, file_obj, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file_obj:
+            baseline = json.load(file_obj)
+        rows = compare(results, baseline, args.tolerance)
+        print_comparison(rows, args.tolerance)
+        if any(row[-1] for row in rows):
+            print("Performance regressed against the baseline.", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
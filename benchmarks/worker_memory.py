@@ -0,0 +1,118 @@
+"""
+Benchmark of the memory taken by the random forest across several API worker processes.
+
+N worker processes load the forest (pickled sklearn model versus the memory-mapped native
+artifact evaluated by src/forest_engine.py), score a small batch and a large one so the whole
+model is touched on both evaluation paths of ForestEngine (the large batch has more rows than
+XTREAM_FOREST_ENGINE_MAX_ROWS), and then report their RSS and PSS (proportional set size: shared pages are split between the
+processes that map them). With the native artifact the total PSS grows with the model size
+once, not once per worker.
+
+Usage:
+    python benchmarks/worker_memory.py [--artifacts-dir artifacts] [--workers 4] [--batch-rows 2000]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.artifact_format import save_artifact
+from src.utils import load_object
+
+
+# Code run in every worker: load the forest, predict, then report memory once all workers are ready
+_WORKER = r"""
+import os, sys, json, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, {root!r})
+import numpy as np
+from src.artifact_format import load_artifact
+
+def memory_mb():
+    values = {{}}
+    for file_name, key in (('/proc/self/status', 'VmRSS:'), ('/proc/self/smaps_rollup', 'Pss:')):
+        try:
+            with open(file_name) as lines:
+                for line in lines:
+                    if line.startswith(key):
+                        values[key.rstrip(':').lower()] = int(line.split()[1]) / 1024
+                        break
+        except OSError:
+            pass
+    return values
+
+forest = load_artifact({path!r})
+rng = np.random.default_rng(0)
+for n_rows in (10, {batch_rows}):
+    forest.predict(rng.normal(size=(n_rows, forest.n_features_in_)))
+
+print('ready', flush=True)
+sys.stdin.readline()
+print(json.dumps(memory_mb()), flush=True)
+"""
+
+
+def measure(path, n_workers, batch_rows):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workers = [
+        subprocess.Popen([sys.executable, '-c', _WORKER.format(root=root, path=path, batch_rows=batch_rows)],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in range(n_workers)
+    ]
+    try:
+        # Measure while every worker holds its model
+        for worker in workers:
+            if worker.stdout.readline().strip() != 'ready':
+                raise RuntimeError("A worker failed to load the model.")
+        for worker in workers:
+            worker.stdin.write('\n')
+            worker.stdin.flush()
+        results = [json.loads(worker.stdout.readline()) for worker in workers]
+    finally:
+        for worker in workers:
+            worker.wait()
+
+    return {
+        'workers': n_workers,
+        'rss_mb_total': sum(result.get('vmrss', 0.0) for result in results),
+        'pss_mb_total': sum(result.get('pss', 0.0) for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--artifacts-dir', default='artifacts', help='Directory with RandomForestRegressorModel.pkl')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--batch-rows', type=int, default=2000, help='Rows of the large batch scored by every worker')
+    args = parser.parse_args()
+
+    pickle_path = os.path.join(args.artifacts_dir, 'RandomForestRegressorModel.pkl')
+    if not os.path.exists(pickle_path):
+        parser.error(f"Missing artifact: {pickle_path}")
+
+    native_dir = tempfile.mkdtemp(prefix='xtream-native-')
+    try:
+        native_path = os.path.join(native_dir, 'RandomForestRegressorModel.forest')
+        save_artifact(native_path, load_object(pickle_path))
+
+        results = {}
+        for name, path in (('pickle', pickle_path), ('native', native_path)):
+            results[name] = [measure(path, 1, args.batch_rows), measure(path, args.workers, args.batch_rows)]
+    finally:
+        shutil.rmtree(native_dir, ignore_errors=True)
+
+    print(f"{'format':<8} {'workers':>7} {'RSS total':>10} {'PSS total':>10}")
+    for name, runs in results.items():
+        for run in runs:
+            print(f"{name:<8} {run['workers']:>7} {run['rss_mb_total']:>7.1f} MB {run['pss_mb_total']:>7.1f} MB")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import numpy as np
+from src.pipelines.predict_pipeline import PredictPipeline
+from src.pipelines.train_pipeline import TrainPipeline, check_training_samples
+from src.logger import get_logger, log_request
+from src.metrics import metrics
+from src.model_registry import model_registry
+from src.decoding import decode_features, decode_train_features, is_batch_payload
+from src.pipelines.micro_batching import MicroBatcher
+from src.pipelines.degradation import DegradationPolicy, SERVING_PATHS
+from src.pipelines.prediction_cache import PredictionCache
+from src.pipelines import bulk_scoring
+from src.pipelines.training_queue import TrainingJobQueue, TrainingWorker
+
+
+# Request handlers shared by the Flask (Xtream_API.py) and ASGI (Xtream_ASGI.py) entry points.
+# They take the decoded payload (JSON, or the NumPy columns of a binary body, see src/wire_format.py)
+# and return the response as a dict.
+
+
+# API logger, with a log file of its own. Every request is logged as a one line summary.
+logger = get_logger('Xtream_API', 'XtreamAPI.log')
+
+
+# Latency budget of the /predict requests (overridden per request by the X-Latency-Budget-Ms header).
+# When the random forest can't be evaluated in time, or too many requests are in flight, the
+# predictions come from a subset of its trees or from XGBoost alone (see src/pipelines/degradation.py)
+LATENCY_BUDGET_MS = float(os.environ['XTREAM_LATENCY_BUDGET_MS']) if os.environ.get('XTREAM_LATENCY_BUDGET_MS') else None
+degradation_policy = DegradationPolicy(
+    max_in_flight=int(os.environ.get('XTREAM_DEGRADE_MAX_IN_FLIGHT', 0)),
+    min_trees=int(os.environ.get('XTREAM_DEGRADE_MIN_TREES', 10)),
+    overload_trees=int(os.environ.get('XTREAM_DEGRADE_OVERLOAD_TREES', 0)),
+    cost_half_life=float(os.environ.get('XTREAM_DEGRADE_COST_HALF_LIFE_S', 30)),
+)
+
+# Coalesce concurrent small /predict requests into one batched ensemble prediction
+MICRO_BATCHING = os.environ.get('XTREAM_MICRO_BATCHING', '1') == '1'
+micro_batcher = MicroBatcher(
+    pipeline=PredictPipeline(policy=degradation_policy),
+    max_batch_size=int(os.environ.get('XTREAM_MICRO_BATCH_SIZE', 64)),
+    max_wait=float(os.environ.get('XTREAM_MICRO_BATCH_WAIT_MS', 2)) / 1000,
+)
+
+# Catalog stones are re-priced many times: cache the row predictions of the current model version
+PREDICTION_CACHE = os.environ.get('XTREAM_PREDICTION_CACHE', '1') == '1'
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('XTREAM_PREDICTION_CACHE_SIZE', 100000)),
+    ttl=float(os.environ.get('XTREAM_PREDICTION_CACHE_TTL_S', 3600)),
+)
+
+# Training requests are queued and trained in the background, so /train answers right away
+TRAIN_ASYNC = os.environ.get('XTREAM_TRAIN_ASYNC', '1') == '1'
+training_queue = TrainingJobQueue(os.environ.get('XTREAM_TRAIN_QUEUE_PATH', 'artifacts/training_jobs.sqlite3'))
+# Fresh samples are buffered until there are enough of them (or they are old enough) to append
+# new boosting rounds, and the update is only promoted if the holdout RMSE does not regress
+training_pipeline = TrainPipeline(
+    min_rows=int(os.environ.get('XTREAM_TRAIN_MIN_ROWS', 100)),
+    max_age=float(os.environ.get('XTREAM_TRAIN_MAX_AGE_S', 3600)),
+    n_rounds=int(os.environ.get('XTREAM_TRAIN_ROUNDS', 10)),
+)
+training_worker = TrainingWorker(training_queue, pipeline=training_pipeline)
+
+
+def load_models():
+    """
+    Load the models, unless this process already has them (e.g. inherited from the process that forked it).
+    """
+    return model_registry.get()
+
+
+def start_model_serving():
+    """
+    Load the models once at startup and hot reload them when the artifacts change.
+    """
+    try:
+        load_models()
+    except Exception as e:
+        logger.exception("Could not preload the models: %s", str(e))
+    model_registry.start_watching()
+
+
+def start_training_worker():
+    """
+    Start the background trainer that consumes the training job queue.
+    """
+    if TRAIN_ASYNC:
+        training_worker.start()
+
+
+def start_background_services():
+    """
+    Start the threads of a serving process: the model watcher and the background trainer.
+    """
+    model_registry.start_watching()
+    start_training_worker()
+
+
+# Categories cycled through by the warmup rows
+_WARMUP_CATEGORIES = {
+    'cut': ['Ideal', 'Premium', 'Very Good', 'Good', 'Fair'],
+    'color': ['D', 'E', 'F', 'G', 'H', 'I', 'J'],
+    'clarity': ['IF', 'VVS1', 'VVS2', 'VS1', 'VS2', 'SI1', 'SI2', 'I1'],
+}
+
+
+def warmup_payload(n_rows=64):
+    """
+    Build a column oriented payload of plausible diamonds, from 0.3 to 2.5 carats.
+    """
+    carat = np.linspace(0.3, 2.5, n_rows)
+    # Round brilliant proportions: the diameter grows with the cube root of the weight
+    diameter = 6.45 * np.cbrt(carat)
+    payload = {
+        'carat': carat.tolist(),
+        'depth': [61.5] * n_rows,
+        'table': [57.0] * n_rows,
+        'x': diameter.tolist(),
+        'y': (1.005 * diameter).tolist(),
+        'z': (0.615 * diameter).tolist(),
+    }
+    for column, categories in _WARMUP_CATEGORIES.items():
+        payload[column] = [categories[i % len(categories)] for i in range(n_rows)]
+    return payload
+
+
+def warmup(n_rows=64):
+    """
+    Run synthetic predictions through every path a /predict request can take, so the first
+    requests don't pay for the first calls of the preprocessing and the models (lazy
+    initialization, thread pools, the micro-batching thread). The latency budget cost model
+    is calibrated on the way. The prediction cache is not used and the counters are reset.
+    """
+    payload = warmup_payload(n_rows)
+    row = {column: values[0] for column, values in payload.items()}
+
+    pipeline = PredictPipeline(policy=degradation_policy)
+    for features in (decode_features(row), decode_features(payload)):
+        for _ in range(2):
+            pipeline.predict_with_path(features)
+    if MICRO_BATCHING:
+        micro_batcher.predict_with_path(decode_features(row))
+        micro_batcher.stats.reset()
+    degradation_policy.stats.reset()
+
+
+def format_predictions(predictions, valid, reasons):
+    """
+    Build the prediction response. Rejected rows keep their position with a null price,
+    and their index and rejection reason are reported.
+    """
+    prices = predictions.tolist()
+    rejected = np.flatnonzero(~valid)
+    for i in rejected:
+        prices[i] = None
+
+    if len(prices) > 1:
+        result = {'predicted_prices': prices}
+        if len(rejected) > 0:
+            result['rejected'] = [{'index': int(i), 'reason': reasons[i]} for i in rejected]
+    else:
+        result = {'predicted_price': prices[0] if prices else None}
+        if len(rejected) > 0:
+            result['reason'] = reasons[0]
+
+    return result
+
+
+def stats():
+    return {
+        'micro_batching': micro_batcher.stats.as_dict(),
+        'prediction_cache': prediction_cache.as_dict(),
+        'degradation': degradation_policy.as_dict(),
+    }
+
+
+def _collect_metrics():
+    # Values kept by the registry and the cache, read on every scrape
+    cache = prediction_cache.stats.as_dict()
+    degradation = degradation_policy.stats.as_dict()
+    return [
+        ('xtream_model_info', 'gauge', 'Version of the models being served.',
+         [({'version': model_registry.version or 'none'}, 1)]),
+        ('xtream_prediction_cache_hits_total', 'counter', 'Rows answered by the prediction cache.',
+         [({}, cache['hits'])]),
+        ('xtream_prediction_cache_misses_total', 'counter', 'Rows sent to the models by the prediction cache.',
+         [({}, cache['misses'])]),
+        ('xtream_prediction_cache_entries', 'gauge', 'Rows held by the prediction cache.',
+         [({}, len(prediction_cache))]),
+        ('xtream_serving_path_batches_total', 'counter', 'Batches scored per serving path (full ensemble, pruned forest, XGBoost only).',
+         [({'path': path}, degradation['batches'][path]) for path in SERVING_PATHS]),
+        ('xtream_serving_path_rows_total', 'counter', 'Rows scored per serving path.',
+         [({'path': path}, degradation['rows'][path]) for path in SERVING_PATHS]),
+        ('xtream_degraded_batches_total', 'counter', 'Batches served without the full ensemble, per cause.',
+         [({'reason': reason}, count) for reason, count in degradation['degraded_by'].items()]),
+        ('xtream_requests_in_flight', 'gauge', 'Prediction requests being served.',
+         [({}, degradation_policy.in_flight)]),
+    ]
+
+
+metrics.add_collector(_collect_metrics)
+
+
+def _finish_request(endpoint, started_at, status='ok', rows=None, **fields):
+    # Record the latency of a request and log its summary
+    latency = time.perf_counter() - started_at
+    metrics.observe_request(endpoint, status, latency, rows)
+    if rows is not None:
+        fields['rows'] = rows
+    log_request(logger, endpoint, latency, status=status, **fields)
+
+
+def predict(input_data, budget_ms=None):
+    """
+    Parameters:
+    input_data: Decoded JSON payload, one object or a list of them.
+    budget_ms (float, optional): Latency budget of the request, LATENCY_BUDGET_MS by default. It
+        runs from the start of the handler, past it the ensemble is degraded.
+    """
+    started_at = time.perf_counter()
+    budget_ms = budget_ms if budget_ms is not None else LATENCY_BUDGET_MS
+    deadline = started_at + budget_ms / 1000 if budget_ms is not None else None
+
+    try:
+        with degradation_policy.track():
+            # Decode the whole batch into typed columns at once
+            with metrics.stage('predict_request', 'decode'):
+                features_df = decode_features(input_data)
+
+            # Make predictions, keeping them aligned with the input rows.
+            # Small requests are batched together with the concurrent ones.
+            if MICRO_BATCHING and features_df.shape[0] < micro_batcher.max_batch_size:
+                prediction_pipeline = micro_batcher
+            else:
+                prediction_pipeline = PredictPipeline(policy=degradation_policy)
+            # Only the rows missing from the prediction cache reach the models.
+            with metrics.stage('predict_request', 'score'):
+                if PREDICTION_CACHE:
+                    predictions, valid, reasons, path = prediction_cache.predict_with_path(
+                        features_df, prediction_pipeline, deadline=deadline)
+                else:
+                    predictions, valid, reasons, path = prediction_pipeline.predict_with_path(
+                        features_df, deadline=deadline)
+
+        # Return the predictions, tagged with the models that computed them
+        with metrics.stage('predict_request', 'format'):
+            result = format_predictions(predictions, valid, reasons)
+            result['serving_path'] = path
+
+        _finish_request('predict', started_at, rows=len(valid), payload=input_data, response=result,
+                        rejected=int(len(valid) - valid.sum()), batch=is_batch_payload(input_data),
+                        serving_path=path, budget_ms=budget_ms, model_version=model_registry.version)
+        return result
+
+    except Exception as e:
+        logger.exception("An error occurred: %s", str(e))
+        _finish_request('predict', started_at, status='error', payload=input_data, error=str(e),
+                        model_version=model_registry.version)
+        return {'error': str(e)}
+
+
+def predict_bulk(stream, content_type=None, chunk_size=None):
+    """
+    Score a CSV or NDJSON request body chunk by chunk.
+
+    Parameters:
+    stream (file): Binary file object with the request body, read sequentially.
+    content_type (str): Content type of the body, CSV if it contains 'csv', NDJSON otherwise.
+    chunk_size (int, optional): Rows scored at a time.
+
+    Returns:
+    generator: The NDJSON result lines, chunk by chunk. A failure ends the stream with an error line.
+    """
+    input_format = bulk_scoring.detect_format(content_type)
+    chunk_size = chunk_size or bulk_scoring.DEFAULT_CHUNK_SIZE
+
+    def generate():
+        started_at = time.perf_counter()
+        n_rows = 0
+        try:
+            for lines in bulk_scoring.stream_ndjson(stream, input_format, chunk_size):
+                n_rows += lines.count(b'\n')
+                yield lines
+            _finish_request('predict_bulk', started_at, rows=n_rows, format=input_format, chunk_size=chunk_size,
+                            model_version=model_registry.version)
+        except Exception as e:
+            logger.exception("An error occurred: %s", str(e))
+            _finish_request('predict_bulk', started_at, status='error', rows=n_rows, format=input_format,
+                            chunk_size=chunk_size, error=str(e), model_version=model_registry.version)
+            yield (json.dumps({'error': str(e)}) + '\n').encode('utf-8')
+
+    return generate()
+
+
+def train(input_data):
+    started_at = time.perf_counter()
+
+    try:
+        # Decode the whole batch into typed columns at once
+        with metrics.stage('train_request', 'decode'):
+            features_df = decode_train_features(input_data)
+
+        # Check if the 'price' feature is present
+        if 'price' not in features_df.columns:
+            error = "The 'price' feature is missing from the input data."
+            _finish_request('train', started_at, status='error', payload=input_data, error=error)
+            return {'error': error}
+
+        # Refuse the samples that would break the model updates, before they are queued
+        check_training_samples(features_df)
+
+        if TRAIN_ASYNC:
+            # Queue the samples, the background trainer will include them in its next update
+            with metrics.stage('train_request', 'enqueue'):
+                job_id = training_queue.enqueue(features_df)
+            result = {
+                'message': f"{features_df.shape[0]} samples have been queued for training.",
+                'job_id': job_id,
+                'status': 'queued',
+            }
+            _finish_request('train', started_at, rows=features_df.shape[0], payload=input_data, response=result,
+                            job_id=job_id)
+            return result
+
+        # Train the model
+        train_metrics = training_pipeline.train(features_df)
+
+        # Return a success message
+        if not train_metrics['updated']:
+            message = f"{features_df.shape[0]} samples have been buffered for the next model update."
+        elif train_metrics['promoted']:
+            message = f"The model has been partially trained with {train_metrics['buffered_samples']} samples successfully."
+        else:
+            message = f"The model has been trained with {train_metrics['buffered_samples']} samples but the update was rejected, the holdout RMSE regressed."
+        result = {'message': message, 'metrics': train_metrics}
+        _finish_request('train', started_at, rows=features_df.shape[0], payload=input_data, response=result,
+                        updated=train_metrics['updated'], promoted=train_metrics.get('promoted', False),
+                        model_version=model_registry.version)
+        return result
+
+    except Exception as e:
+        logger.exception("An error occurred: %s", str(e))
+        _finish_request('train', started_at, status='error', payload=input_data, error=str(e))
+        return {'error': str(e)}
+
+
+def train_status(job_id):
+    """
+    Return the status and metrics of a training job, or None if it does not exist.
+    """
+    return training_queue.get(job_id)
@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import mmap
+import numpy as np
+from src.exception import CustomException
+from src.utils import atomic_write, load_object, save_object
+from src.forest_engine import ForestEngine
+
+
+# Artifact formats, picked from the file extension:
+#   .pkl    -> pickle (save_object/load_object)
+#   .ubj    -> XGBoost booster in its native Universal Binary JSON format
+#   .json   -> XGBoost booster in its native JSON format
+#   .forest -> RandomForestRegressor node arrays in an array container
+#   .prep   -> CompiledPreprocessor parameters in an array container
+#
+# The array container is a small header followed by raw, aligned NumPy buffers, so it can be
+# memory-mapped: the arrays are views on the page cache instead of copies in every process.
+
+ARRAYS_MAGIC = b'XTREAMARRAYS1\n'
+ARRAYS_ALIGNMENT = 64
+
+# Serve the native random forests with ForestEngine (0: rebuild a sklearn RandomForestRegressor)
+FOREST_ENGINE = os.environ.get('XTREAM_FOREST_ENGINE', '1') == '1'
+
+# Native counterpart of every pickled artifact served by the API
+NATIVE_FILE_NAMES = {
+    'XGRegressorModel_v2.pkl': 'XGRegressorModel_v2.ubj',
+    'RandomForestRegressorModel.pkl': 'RandomForestRegressorModel.forest',
+    'preprocessor_predict.pkl': 'preprocessor_predict.prep',
+}
+
+
+# Compacted counterpart of the artifacts that have one (see src/pipelines/compaction.py)
+LITE_FILE_NAMES = {
+    'RandomForestRegressorModel.pkl': 'RandomForestRegressorModel_lite.forest',
+}
+
+# Artifacts every derived artifact is built from. A version replacing one of them does not carry the
+# derived artifact over: the lite forest is compacted from the forest, with trees selected against the booster.
+DERIVED_FROM = {
+    **{native: (file_name,) for file_name, native in NATIVE_FILE_NAMES.items()},
+    'RandomForestRegressorModel_lite.forest': (
+        'RandomForestRegressorModel.pkl', 'RandomForestRegressorModel.forest',
+        'XGRegressorModel_v2.pkl', 'XGRegressorModel_v2.ubj',
+    ),
+}
+
+
+def native_file_name(file_name):
+    """
+    Return the native file name of a pickled artifact, or None if it has no native format.
+    """
+    return NATIVE_FILE_NAMES.get(file_name)
+
+
+def lite_file_name(file_name):
+    """
+    Return the file name of the compacted version of an artifact, or None if it has none.
+    """
+    return LITE_FILE_NAMES.get(file_name)
+
+
+# ARRAY CONTAINER
+
+def save_arrays(file_path, arrays, meta=None):
+    """
+    Save NumPy arrays and JSON metadata in a memory-mappable container.
+
+    Parameters:
+    file_path (str): Destination file.
+    arrays (dict): Mapping of name to array. Object arrays are not supported.
+    meta (dict, optional): JSON-serializable metadata.
+    """
+    entries = {}
+    offset = 0
+    buffers = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError(f"Array '{name}' has an object dtype and cannot be stored.")
+        offset = -(-offset // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        buffers.append((offset, array))
+        offset += array.nbytes
+
+    header = json.dumps({'meta': meta or {}, 'arrays': entries}).encode('utf-8')
+    # Data starts aligned after the magic, the header length and the header
+    data_start = -(-(len(ARRAYS_MAGIC) + 8 + len(header)) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+
+    def write(file_obj):
+        file_obj.write(ARRAYS_MAGIC)
+        file_obj.write(len(header).to_bytes(8, 'little'))
+        file_obj.write(header)
+        for array_offset, array in buffers:
+            file_obj.seek(data_start + array_offset)
+            file_obj.write(array.tobytes())
+        file_obj.truncate(data_start + offset)
+
+    atomic_write(file_path, write)
+
+
+def load_arrays(file_path, mmap_mode=True):
+    """
+    Load an array container.
+
+    Parameters:
+    file_path (str): The container file.
+    mmap_mode (bool): If True, the arrays are read-only views on a memory map of the file.
+        Otherwise they are read into memory.
+
+    Returns:
+    tuple: The dict of arrays and the metadata dict.
+    """
+    with open(file_path, 'rb') as file_obj:
+        if file_obj.read(len(ARRAYS_MAGIC)) != ARRAYS_MAGIC:
+            raise ValueError(f"'{file_path}' is not an array container.")
+        header_length = int.from_bytes(file_obj.read(8), 'little')
+        header = json.loads(file_obj.read(header_length).decode('utf-8'))
+        data_start = -(-(len(ARRAYS_MAGIC) + 8 + header_length) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+
+        if mmap_mode:
+            buffer = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            file_obj.seek(0)
+            buffer = file_obj.read()
+
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                     offset=data_start + entry['offset']).reshape(entry['shape'])
+    return arrays, header['meta']
+
+
+# XGBOOST BOOSTER
+
+def save_booster(file_path, model):
+    """
+    Save an XGBoost booster (or XGBRegressor) in its native format, UBJ or JSON depending on the extension.
+    """
+    booster = model.get_booster() if hasattr(model, 'get_booster') else model
+    raw_format = 'json' if file_path.endswith('.json') else 'ubj'
+    raw = booster.save_raw(raw_format=raw_format)
+    atomic_write(file_path, lambda file_obj: file_obj.write(bytes(raw)))
+
+
+def load_booster(file_path):
+    import xgboost as xgb
+
+    booster = xgb.Booster()
+    booster.load_model(file_path)
+    return booster
+
+
+# RANDOM FOREST
+
+_TREE_FIELDS = ['left_child', 'right_child', 'feature', 'threshold', 'impurity',
+                'n_node_samples', 'weighted_n_node_samples']
+
+
+def _json_params(params):
+    return {name: value for name, value in params.items()
+            if value is None or isinstance(value, (bool, int, float, str))}
+
+
+def forest_to_arrays(forest):
+    """
+    Flatten the trees of a fitted RandomForestRegressor into concatenated node arrays.
+
+    Returns:
+    tuple: The dict of arrays and the metadata needed to rebuild the forest.
+    """
+    estimators = forest.estimators_
+    node_counts = np.array([estimator.tree_.node_count for estimator in estimators], dtype=np.int64)
+    tree_offsets = np.concatenate([[0], np.cumsum(node_counts)])
+
+    states = [estimator.tree_.__getstate__() for estimator in estimators]
+    arrays = {
+        field: np.concatenate([state['nodes'][field] for state in states])
+        for field in _TREE_FIELDS
+    }
+    arrays['value'] = np.concatenate([state['values'].reshape(state['node_count'], -1) for state in states])
+    arrays['tree_offsets'] = tree_offsets
+    arrays['max_depth'] = np.array([state['max_depth'] for state in states], dtype=np.int64)
+
+    first = estimators[0]
+    meta = {
+        'kind': 'random_forest_regressor',
+        'params': _json_params(forest.get_params()),
+        'estimator_params': _json_params({name: getattr(first, name) for name in forest.estimator_params}),
+        'random_states': [int(estimator.random_state) for estimator in estimators],
+        'max_features_': int(first.max_features_),
+        'n_features_in_': int(forest.n_features_in_),
+        'n_outputs_': int(forest.n_outputs_),
+    }
+    if hasattr(forest, 'feature_names_in_'):
+        meta['feature_names_in_'] = [str(name) for name in forest.feature_names_in_]
+
+    return arrays, meta
+
+
+def arrays_to_forest(arrays, meta):
+    """
+    Rebuild a RandomForestRegressor from the node arrays of forest_to_arrays.
+    """
+    if meta.get('kind') != 'random_forest_regressor':
+        raise ValueError(f"A '{meta.get('kind')}' forest can only be evaluated with ForestEngine.")
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.tree import DecisionTreeRegressor
+    from sklearn.tree._tree import Tree, NODE_DTYPE
+
+    n_features = meta['n_features_in_']
+    n_outputs = meta['n_outputs_']
+    tree_offsets = arrays['tree_offsets']
+
+    estimators = []
+    for i, random_state in enumerate(meta['random_states']):
+        start, end = int(tree_offsets[i]), int(tree_offsets[i + 1])
+
+        nodes = np.empty(end - start, dtype=NODE_DTYPE)
+        for field in _TREE_FIELDS:
+            nodes[field] = arrays[field][start:end]
+
+        tree = Tree(n_features, np.ones(n_outputs, dtype=np.intp), n_outputs)
+        tree.__setstate__({
+            'max_depth': int(arrays['max_depth'][i]),
+            'node_count': end - start,
+            'nodes': nodes,
+            'values': np.ascontiguousarray(arrays['value'][start:end]).reshape(end - start, n_outputs, 1),
+        })
+
+        estimator = DecisionTreeRegressor(**meta['estimator_params'])
+        estimator.set_params(random_state=random_state)
+        estimator.n_features_in_ = n_features
+        estimator.n_outputs_ = n_outputs
+        estimator.max_features_ = meta['max_features_']
+        estimator.tree_ = tree
+        estimators.append(estimator)
+
+    forest = RandomForestRegressor()
+    forest.set_params(**{name: value for name, value in meta['params'].items() if name in forest.get_params()})
+    forest.estimator_ = DecisionTreeRegressor(**meta['estimator_params'])
+    forest.estimators_ = estimators
+    forest.n_features_in_ = n_features
+    forest.n_outputs_ = n_outputs
+    if 'feature_names_in_' in meta:
+        forest.feature_names_in_ = np.asarray(meta['feature_names_in_'], dtype=object)
+
+    return forest
+
+
+def save_forest(file_path, forest):
+    """
+    Save a RandomForestRegressor, or the node arrays of a ForestEngine (e.g. a compacted forest).
+    """
+    arrays, meta = forest.to_arrays() if isinstance(forest, ForestEngine) else forest_to_arrays(forest)
+    save_arrays(file_path, arrays, meta)
+
+
+def load_forest(file_path, as_sklearn=None):
+    """
+    Load a forest artifact.
+
+    Parameters:
+    file_path (str): The .forest container.
+    as_sklearn (bool, optional): If True, rebuild a RandomForestRegressor (copies the nodes). Otherwise
+        a ForestEngine predicts straight from the memory-mapped node arrays, shared by all processes.
+        By default a ForestEngine, unless XTREAM_FOREST_ENGINE=0.
+    """
+    arrays, meta = load_arrays(file_path)
+    if as_sklearn is None:
+        # Compacted forests can only be evaluated by the engine
+        as_sklearn = not FOREST_ENGINE and meta.get('kind') == 'random_forest_regressor'
+    if as_sklearn:
+        return arrays_to_forest(arrays, meta)
+    return ForestEngine(arrays, meta)
+
+
+# PREPROCESSOR
+
+def save_compiled_preprocessor(file_path, compiled):
+    """
+    Save the parameters of a CompiledPreprocessor (or a fitted predict preprocessor, compiled on the fly).
+    """
+    from src.compiled_preprocessor import CompiledPreprocessor
+
+    if not isinstance(compiled, CompiledPreprocessor):
+        compiled = CompiledPreprocessor.from_column_transformer(compiled)
+
+    arrays = {'numeric_fill': compiled.numeric_fill, 'means': compiled.means, 'scales': compiled.scales}
+    meta = {
+        'kind': 'compiled_preprocessor',
+        'numeric_features': compiled.numeric_features,
+        'categorical_features': compiled.categorical_features,
+        'categorical_fill': [None if fill is None else str(fill) for fill in compiled.categorical_fill],
+        'categories': [categories.tolist() for categories in compiled.categories],
+        'sparse_output': compiled.sparse_output,
+    }
+    save_arrays(file_path, arrays, meta)
+
+
+def load_compiled_preprocessor(file_path):
+    from src.compiled_preprocessor import CompiledPreprocessor
+
+    arrays, meta = load_arrays(file_path)
+    return CompiledPreprocessor(
+        numeric_features=meta['numeric_features'],
+        numeric_fill=arrays['numeric_fill'],
+        means=arrays['means'],
+        scales=arrays['scales'],
+        categorical_features=meta['categorical_features'],
+        categorical_fill=meta['categorical_fill'],
+        categories=meta['categories'],
+        sparse_output=meta['sparse_output'],
+    )
+
+
+# DISPATCH
+
+def save_artifact(file_path, obj):
+    """
+    Save an artifact in the format given by the file extension.
+    """
+    try:
+        if file_path.endswith(('.ubj', '.json')):
+            save_booster(file_path, obj)
+        elif file_path.endswith('.forest'):
+            save_forest(file_path, obj)
+        elif file_path.endswith('.prep'):
+            save_compiled_preprocessor(file_path, obj)
+        else:
+            save_object(file_path, obj)
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def load_artifact(file_path):
+    """
+    Load an artifact in the format given by the file extension.
+    """
+    try:
+        if file_path.endswith(('.ubj', '.json')):
+            return load_booster(file_path)
+        elif file_path.endswith('.forest'):
+            return load_forest(file_path)
+        elif file_path.endswith('.prep'):
+            return load_compiled_preprocessor(file_path)
+        return load_object(file_path)
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def export_native(source_dir, target_dir=None):
+    """
+    Write the native counterpart of every pickled serving artifact found in source_dir.
+
+    Returns:
+    dict: Mapping of pickled file name to the native file written.
+    """
+    target_dir = target_dir or source_dir
+    written = {}
+    for file_name, native_name in NATIVE_FILE_NAMES.items():
+        source_path = os.path.join(source_dir, file_name)
+        if os.path.exists(source_path):
+            save_artifact(os.path.join(target_dir, native_name), load_object(source_path))
+            written[file_name] = native_name
+    return written
+
+
+if __name__ == '__main__':
+    # Publish a new model version with the native artifacts: python -m src.artifact_format
+    from src.model_registry import model_store
+
+    version = model_store.current_version()
+    source_dir = model_store.version_path(version) if version else model_store.legacy_dir
+    objects = {
+        NATIVE_FILE_NAMES[file_name]: load_object(os.path.join(source_dir, file_name))
+        for file_name in NATIVE_FILE_NAMES
+        if os.path.exists(os.path.join(source_dir, file_name))
+    }
+    new_version = model_store.publish(objects, save=save_artifact)
+    print(f"Published version {new_version} with {sorted(objects)}")
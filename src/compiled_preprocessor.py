@@ -0,0 +1,315 @@
+import sys
+import logging
+import numpy as np
+from src.exception import CustomException
+from src.utils import OUTLIER_CONDITIONS, outlier_conditions, outlier_reasons, preprocess_data_to_predict
+
+
+logger = logging.getLogger(__name__)
+
+
+def _pipeline_steps(transformer):
+    """
+    Return the steps of a fitted sklearn Pipeline (or a single estimator) as a dict keyed by class name.
+    """
+    steps = getattr(transformer, 'steps', None)
+    if steps is None:
+        steps = [(type(transformer).__name__, transformer)]
+    return {type(step).__name__: step for _, step in steps if step not in (None, 'passthrough')}
+
+
+class CompiledPreprocessor:
+    """
+    Fused, DataFrame-free version of the prediction preprocessing.
+
+    It holds the parameters of the fitted ColumnTransformer (imputer statistics, scaler
+    means/scales and one-hot category tables) as NumPy arrays and turns the raw feature
+    arrays into the model matrix in one vectorized pass: feature engineering, outlier
+    filtering, scaling and one-hot encoding.
+    """
+
+    def __init__(self, numeric_features, numeric_fill, means, scales,
+                 categorical_features, categorical_fill, categories, sparse_output=False):
+        self.numeric_features = list(numeric_features)
+        self.numeric_fill = np.asarray(numeric_fill, dtype=np.float64)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.scales = np.asarray(scales, dtype=np.float64)
+        self.categorical_features = list(categorical_features)
+        self.categorical_fill = list(categorical_fill)
+        self.categories = [np.asarray(c).astype(str) for c in categories]
+        # Sorted lookup tables, mapped back to the one-hot column of each category
+        self._lookup_order = [np.argsort(c, kind='stable') for c in self.categories]
+        self._lookup_tables = [c[order] for c, order in zip(self.categories, self._lookup_order)]
+        # Sparse outputs leave the zeros out, which XGBoost reads as missing values
+        self.sparse_output = bool(sparse_output)
+        self.n_output_features = len(self.numeric_features) + sum(len(c) for c in self.categories)
+
+    @property
+    def missing(self):
+        """
+        Value that XGBoost must treat as missing to match the sklearn output.
+        """
+        return 0.0 if self.sparse_output else np.nan
+
+    @classmethod
+    def from_column_transformer(cls, preprocessor):
+        """
+        Extract the fitted parameters of the predict preprocessor.
+
+        Parameters:
+        preprocessor (ColumnTransformer): A fitted transformer made of a numeric pipeline
+            (median imputer + StandardScaler) and a categorical pipeline (constant imputer + OneHotEncoder).
+
+        Returns:
+        CompiledPreprocessor: The compiled preprocessor.
+        """
+        try:
+            numeric = categorical = None
+            for name, transformer, features in preprocessor.transformers_:
+                if isinstance(transformer, str) and transformer == 'drop':
+                    continue
+                steps = _pipeline_steps(transformer)
+                if 'StandardScaler' in steps and numeric is None and categorical is None:
+                    numeric = (features, steps)
+                elif 'OneHotEncoder' in steps and numeric is not None and categorical is None:
+                    categorical = (features, steps)
+                else:
+                    raise ValueError(f"Unsupported transformer '{name}' in the preprocessor.")
+
+            # The outputs are stacked in declaration order: numeric block first, then one-hot block
+            if numeric is None or categorical is None:
+                raise ValueError("The preprocessor must have a numeric transformer followed by a categorical one.")
+
+            numeric_features, numeric_steps = numeric
+            scaler = numeric_steps['StandardScaler']
+            n_numeric = len(numeric_features)
+            means = scaler.mean_ if scaler.with_mean else np.zeros(n_numeric)
+            scales = scaler.scale_ if scaler.with_std else np.ones(n_numeric)
+            numeric_imputer = numeric_steps.get('SimpleImputer')
+            numeric_fill = numeric_imputer.statistics_ if numeric_imputer is not None else np.full(n_numeric, np.nan)
+
+            categorical_features, categorical_steps = categorical
+            encoder = categorical_steps['OneHotEncoder']
+            if encoder.drop is not None or getattr(encoder, 'infrequent_categories_', None) is not None:
+                raise ValueError("Only plain one-hot encoding is supported.")
+            if encoder.handle_unknown != 'ignore':
+                raise ValueError("The one-hot encoder must ignore unknown categories.")
+            categorical_imputer = categorical_steps.get('SimpleImputer')
+            if categorical_imputer is not None:
+                categorical_fill = list(categorical_imputer.statistics_)
+            else:
+                categorical_fill = [None] * len(categorical_features)
+
+            return cls(
+                numeric_features=numeric_features,
+                numeric_fill=numeric_fill,
+                means=means,
+                scales=scales,
+                categorical_features=categorical_features,
+                categorical_fill=categorical_fill,
+                categories=encoder.categories_,
+                sparse_output=getattr(preprocessor, 'sparse_output_', False),
+            )
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    @staticmethod
+    def engineer_features(columns):
+        """
+        Fused version of feature_engineering: compute the volume and density of the diamonds
+        without adding the auxiliary beta/alpha columns to a DataFrame.
+
+        Parameters:
+        columns (dict or DataFrame): Raw features, accessed by name.
+
+        Returns:
+        tuple: Arrays with the volume and the density.
+        """
+        carat = np.asarray(columns['carat'], dtype=np.float64)
+        depth = np.asarray(columns['depth'], dtype=np.float64)
+        table = np.asarray(columns['table'], dtype=np.float64)
+        x = np.asarray(columns['x'], dtype=np.float64)
+        y = np.asarray(columns['y'], dtype=np.float64)
+        z = np.asarray(columns['z'], dtype=np.float64)
+
+        # Same operations and order as feature_engineering, so the results are identical
+        beta = depth / 100
+        alpha = (1 - beta) * (1 + (table / 100)**2)
+        volume = 0.5 * z * x * y * (alpha + beta)
+        density = carat / volume
+
+        return volume, density
+
+    @staticmethod
+    def outlier_conditions(columns, density):
+        """
+        Fused version of removing_outliers: evaluate the outlier conditions on the raw arrays.
+        """
+        features = {feature: columns[feature] for feature, _, _ in OUTLIER_CONDITIONS if feature != 'density'}
+        features['density'] = density
+        return outlier_conditions(features)
+
+    def _encode(self, values, feature_index):
+        """
+        One-hot encode a categorical column through a sorted category lookup table.
+        Unknown categories are left as all-zero rows, like handle_unknown='ignore'.
+        """
+        values = np.asarray(values, dtype=object)
+        fill = self.categorical_fill[feature_index]
+        if fill is not None:
+            missing = (values == None) | (values != values)  # noqa: E711, None or NaN
+            if missing.any():
+                values = values.copy()
+                values[missing] = fill
+        values = values.astype(str)
+
+        table = self._lookup_tables[feature_index]
+        positions = np.searchsorted(table, values)
+        np.minimum(positions, len(table) - 1, out=positions)
+        known = table[positions] == values
+
+        return self._lookup_order[feature_index][positions], known
+
+    def transform_features(self, columns, rows=None):
+        """
+        Build the model matrix from features that already include the engineered ones.
+
+        Parameters:
+        columns (dict or DataFrame): Features accessed by name, including 'volume'.
+        rows (ndarray, optional): Indexes of the rows to be transformed. All rows by default.
+
+        Returns:
+        ndarray: Dense model matrix with the same column layout as the sklearn preprocessor.
+        """
+        n_rows = len(columns[self.numeric_features[0]])
+        if rows is None:
+            rows = slice(None)
+        else:
+            n_rows = len(rows)
+
+        X = np.zeros((n_rows, self.n_output_features), dtype=np.float64)
+
+        # Numeric block: impute, then standardize
+        for j, feature in enumerate(self.numeric_features):
+            values = np.asarray(columns[feature], dtype=np.float64)[rows]
+            values = np.where(np.isnan(values), self.numeric_fill[j], values)
+            values -= self.means[j]
+            values /= self.scales[j]
+            X[:, j] = values
+
+        # Categorical block: one-hot through the lookup tables
+        offset = len(self.numeric_features)
+        row_index = np.arange(n_rows)
+        for j, feature in enumerate(self.categorical_features):
+            codes, known = self._encode(np.asarray(columns[feature], dtype=object)[rows], j)
+            X[row_index[known], offset + codes[known]] = 1.0
+            offset += len(self.categories[j])
+
+        return X
+
+    def transform(self, columns, return_mask=False):
+        """
+        Run the whole prediction preprocessing on the raw features: feature engineering,
+        outlier removal and transformation.
+
+        Parameters:
+        columns (dict or DataFrame): Raw features ('carat', 'cut', 'color', 'clarity', 'depth', 'table', 'x', 'y', 'z').
+        return_mask (bool): If True, also return which input rows were kept and why the others were rejected.
+
+        Returns:
+        ndarray: The model matrix for the rows that are not outliers.
+        valid (ndarray): Only with return_mask. Boolean mask of the input rows present in the matrix.
+        reasons (ndarray): Only with return_mask. Rejection reason of every input row, None for valid ones.
+        """
+        try:
+            volume, density = self.engineer_features(columns)
+            conditions = self.outlier_conditions(columns, density)
+            valid = ~np.any(conditions, axis=0)
+
+            features = {name: columns[name] for name in self.numeric_features + self.categorical_features
+                        if name != 'volume'}
+            features['volume'] = volume
+
+            X = self.transform_features(features, rows=np.flatnonzero(valid))
+
+            if return_mask:
+                return X, valid, outlier_reasons(conditions)
+            return X
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+
+def synthetic_batch(compiled, n_rows=64, seed=0):
+    """
+    Build a batch of raw features that covers every known category, an unknown one and an outlier.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {
+        'carat': rng.uniform(0.2, 3.0, n_rows),
+        'depth': rng.uniform(55.0, 70.0, n_rows),
+        'table': rng.uniform(50.0, 70.0, n_rows),
+        'x': rng.uniform(3.5, 9.0, n_rows),
+        'y': rng.uniform(3.5, 9.0, n_rows),
+        'z': rng.uniform(2.5, 5.5, n_rows),
+    }
+    for feature, categories in zip(compiled.categorical_features, compiled.categories):
+        values = np.resize(categories, n_rows).astype(object)
+        values[-1] = 'unknown'
+        columns[feature] = values
+    columns['z'][0] = 1.0
+    return columns
+
+
+def check_parity(compiled, preprocessor, columns, atol=1e-9):
+    """
+    Compare the compiled preprocessing against the sklearn one (preprocess_data_to_predict).
+
+    Parameters:
+    compiled (CompiledPreprocessor): The compiled preprocessor.
+    preprocessor (ColumnTransformer): The fitted sklearn preprocessor it was extracted from.
+    columns (dict or DataFrame): Raw features to run through both paths.
+    atol (float): Maximum absolute difference allowed.
+
+    Returns:
+    float: The maximum absolute difference between both model matrices.
+    """
+    import pandas as pd
+    from scipy import sparse
+
+    df = pd.DataFrame({name: np.asarray(values) for name, values in dict(columns).items()})
+    expected, expected_valid, _ = preprocess_data_to_predict(df=df, preprocessor=preprocessor, return_mask=True)
+    if expected is None:
+        expected = np.zeros((0, compiled.n_output_features))
+    elif sparse.issparse(expected):
+        expected = expected.toarray()
+
+    actual, actual_valid, _ = compiled.transform(columns, return_mask=True)
+    if not np.array_equal(actual_valid, expected_valid):
+        raise ValueError("The compiled outlier filter differs from sklearn.")
+    if actual.shape != expected.shape:
+        raise ValueError(f"Shape mismatch between the compiled {actual.shape} and sklearn {expected.shape} preprocessing.")
+
+    max_diff = float(np.max(np.abs(actual - expected))) if actual.size else 0.0
+    if max_diff > atol:
+        raise ValueError(f"The compiled preprocessing differs from sklearn by {max_diff}.")
+    return max_diff
+
+
+def compile_preprocessor(preprocessor):
+    """
+    Compile a fitted predict preprocessor and check it against sklearn on a synthetic batch.
+
+    Returns:
+    CompiledPreprocessor or None: None if the preprocessor cannot be compiled, so the
+    caller falls back to the sklearn path.
+    """
+    try:
+        compiled = CompiledPreprocessor.from_column_transformer(preprocessor)
+        check_parity(compiled, preprocessor, synthetic_batch(compiled))
+        return compiled
+
+    except Exception as e:
+        logger.warning("Using the sklearn preprocessing, the preprocessor could not be compiled: %s", e)
+        return None
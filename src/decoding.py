@@ -0,0 +1,141 @@
+import sys
+import numpy as np
+import pandas as pd
+from src.exception import CustomException
+
+
+# Features expected in every request
+NUMERIC_FEATURES = ['carat', 'depth', 'table', 'x', 'y', 'z']
+CATEGORICAL_FEATURES = ['cut', 'color', 'clarity']
+FEATURE_COLUMNS = ['carat', 'cut', 'color', 'clarity', 'depth', 'table', 'x', 'y', 'z']
+
+# Features expected in a training request
+TRAIN_NUMERIC_FEATURES = NUMERIC_FEATURES + ['price']
+TRAIN_COLUMNS = FEATURE_COLUMNS + ['price']
+
+
+def is_column_oriented(payload):
+    """
+    Check whether a payload is column oriented, i.e. a dict mapping every feature to a list of values.
+    """
+    return isinstance(payload, dict) and len(payload) > 0 and all(
+        isinstance(values, (list, tuple, np.ndarray)) for values in payload.values()
+    )
+
+
+def is_batch_payload(payload):
+    """
+    Check whether a payload holds a batch of samples (row or column oriented) instead of a single one.
+    """
+    return isinstance(payload, list) or is_column_oriented(payload)
+
+
+def _missing_feature(column):
+    return ValueError(f"The '{column}' feature is missing from the input data.")
+
+
+def _invalid_values(column, invalid):
+    rows = np.flatnonzero(invalid)
+    return ValueError(f"The '{column}' feature is missing or invalid in {len(rows)} samples "
+                      f"(first one at index {rows[0]}).")
+
+
+def _to_typed_columns(values, columns, numeric_columns):
+    """
+    Convert lists of raw values into typed NumPy columns. Missing values (null, NaN) and
+    infinite numbers are refused, the models would silently score them.
+    """
+    typed = {}
+    for column in columns:
+        if column in numeric_columns:
+            try:
+                typed[column] = np.asarray(values[column], dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError(f"The '{column}' feature must be numeric.")
+            invalid = ~np.isfinite(typed[column])
+        else:
+            typed[column] = np.asarray(values[column], dtype=object)
+            invalid = pd.isna(typed[column])
+        if invalid.any():
+            raise _invalid_values(column, invalid)
+    return typed
+
+
+def decode_columns(payload, columns=FEATURE_COLUMNS, numeric_columns=NUMERIC_FEATURES):
+    """
+    Validate a request payload and convert it into typed NumPy columns.
+
+    The payload can be a single sample (dict of scalars), a list of samples (row oriented)
+    or a dict mapping every feature to a list of values (column oriented). A dict mixing
+    scalars and lists is refused.
+
+    Parameters:
+    payload (dict or list): The decoded JSON payload.
+    columns (list): Features that must be present in every sample.
+    numeric_columns (list): Features that are converted to float64. The rest are kept as objects.
+
+    Returns:
+    dict: Mapping of feature name to a NumPy array, all of them with the same length.
+    """
+    try:
+        if is_column_oriented(payload):
+            values = {}
+            for column in columns:
+                if column not in payload:
+                    raise _missing_feature(column)
+                values[column] = payload[column]
+
+            lengths = {len(column_values) for column_values in values.values()}
+            if len(lengths) > 1:
+                raise ValueError("All the features must have the same number of values.")
+
+        else:
+            if isinstance(payload, dict):
+                # Neither a single sample nor columns: the lists would end up as cell values
+                lists = [name for name, value in payload.items() if isinstance(value, (list, tuple, np.ndarray))]
+                if lists:
+                    raise ValueError(f"The input data mixes single values and lists of values (lists in "
+                                     f"{', '.join(repr(name) for name in lists)}): send every feature as a "
+                                     f"single value or every feature as a list of values.")
+                rows = [payload]
+            elif isinstance(payload, list):
+                rows = payload
+            else:
+                raise ValueError("The input data must be a JSON object or a list of JSON objects.")
+
+            # Fill every column in a single pass over the rows
+            values = {column: [None] * len(rows) for column in columns}
+            for i, row in enumerate(rows):
+                try:
+                    for column in columns:
+                        values[column][i] = row[column]
+                except KeyError as missing:
+                    raise _missing_feature(missing.args[0])
+                except TypeError:
+                    raise ValueError("The input data must be a JSON object or a list of JSON objects.")
+
+        return _to_typed_columns(values, columns, numeric_columns)
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def columns_to_data_frame(columns):
+    """
+    Build a single DataFrame from decoded columns, keeping their order.
+    """
+    return pd.DataFrame(columns, columns=list(columns.keys()), copy=False)
+
+
+def decode_features(payload):
+    """
+    Decode a prediction payload into a DataFrame with the features expected by PredictPipeline.
+    """
+    return columns_to_data_frame(decode_columns(payload, FEATURE_COLUMNS, NUMERIC_FEATURES))
+
+
+def decode_train_features(payload):
+    """
+    Decode a training payload into a DataFrame with the features and target expected by TrainPipeline.
+    """
+    return columns_to_data_frame(decode_columns(payload, TRAIN_COLUMNS, TRAIN_NUMERIC_FEATURES))
@@ -0,0 +1,196 @@
+import os
+import sys
+import copy
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from src.exception import CustomException
+from src.metrics import metrics
+
+
+def _parse_weights(value):
+    return tuple(float(weight) for weight in value.split(','))
+
+
+# Weights of the XGBoost and random forest predictions
+ENSEMBLE_WEIGHTS = _parse_weights(os.environ.get('XTREAM_ENSEMBLE_WEIGHTS', '0.5,0.5'))
+# Threads of every member (unset: XGBoost keeps its own default, the forest its n_jobs)
+XGB_THREADS = int(os.environ['XTREAM_XGB_THREADS']) if os.environ.get('XTREAM_XGB_THREADS') else None
+RF_THREADS = int(os.environ['XTREAM_RF_THREADS']) if os.environ.get('XTREAM_RF_THREADS') else None
+# Evaluate the two members at the same time on the shared pool (pointless with a single CPU)
+ENSEMBLE_CONCURRENT = os.environ.get('XTREAM_ENSEMBLE_CONCURRENT', '1' if (os.cpu_count() or 1) > 1 else '0') == '1'
+ENSEMBLE_POOL_SIZE = int(os.environ.get('XTREAM_ENSEMBLE_POOL_SIZE', os.cpu_count() or 1))
+
+
+# Threads running the random forest member while the calling thread runs XGBoost, created on first use
+_member_pool = None
+_member_pool_lock = threading.Lock()
+
+
+def get_member_pool():
+    global _member_pool
+    with _member_pool_lock:
+        if _member_pool is None:
+            _member_pool = ThreadPoolExecutor(max_workers=ENSEMBLE_POOL_SIZE, thread_name_prefix='ensemble')
+        return _member_pool
+
+
+def _reset_member_pool():
+    # The threads of the pool don't survive a fork
+    global _member_pool, _member_pool_lock
+    _member_pool = None
+    _member_pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_member_pool)
+
+
+class EnsembleEngine:
+    """
+    Weighted average of the XGBoost and random forest predictions, computed on the preprocessed
+    matrix as it is.
+
+    XGBoost predicts in place (Booster.inplace_predict), without building a DMatrix. When both
+    members are used, the forest is evaluated on the shared member pool while the calling thread
+    runs XGBoost: both release the GIL while predicting. Each member keeps its native
+    multithreading, limited by its own thread budget (nthread for XGBoost, n_jobs for the forest).
+
+    Parameters:
+    xgb_model: XGBoost Booster (or XGBRegressor).
+    rf_model: RandomForestRegressor or ForestEngine.
+    weights (tuple, optional): (XGBoost, random forest) weights, normalized to sum to 1.
+        XTREAM_ENSEMBLE_WEIGHTS by default. A member with a zero weight is not evaluated.
+    xgb_threads, rf_threads (int, optional): Thread budgets of the members.
+    concurrent (bool, optional): Evaluate the members at the same time. XTREAM_ENSEMBLE_CONCURRENT by default.
+    """
+
+    def __init__(self, xgb_model, rf_model, weights=None, xgb_threads=None, rf_threads=None, concurrent=None):
+        try:
+            self.booster = xgb_model.get_booster() if hasattr(xgb_model, 'get_booster') else xgb_model
+            self.rf_model = rf_model
+
+            weights = tuple(float(weight) for weight in (weights if weights is not None else ENSEMBLE_WEIGHTS))
+            if len(weights) != 2 or min(weights) < 0 or sum(weights) <= 0:
+                raise ValueError(f"The ensemble weights must be two non-negative numbers, got {weights}.")
+            self.weights = (weights[0] / sum(weights), weights[1] / sum(weights))
+
+            self.concurrent = ENSEMBLE_CONCURRENT if concurrent is None else concurrent
+            self._pruned_forests = {}
+            self.xgb_threads = None
+            self.rf_threads = None
+            self.set_thread_budget(xgb_threads if xgb_threads is not None else XGB_THREADS,
+                                   rf_threads if rf_threads is not None else RF_THREADS)
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def set_thread_budget(self, xgb_threads=None, rf_threads=None):
+        """
+        Limit the threads of the members. A None budget leaves the member as it is.
+        """
+        if xgb_threads is not None:
+            self.booster.set_param({'nthread': int(xgb_threads)})
+            self.xgb_threads = int(xgb_threads)
+        if rf_threads is not None and hasattr(self.rf_model, 'n_jobs'):
+            self.rf_model.n_jobs = int(rf_threads)
+            self.rf_threads = int(rf_threads)
+
+    @property
+    def rf_n_estimators(self):
+        estimators = getattr(self.rf_model, 'estimators_', None)
+        return len(estimators) if estimators is not None else self.rf_model.n_estimators
+
+    def _pruned_forest(self, n_trees):
+        # sklearn forest restricted to its first n_trees trees, sharing them with the full one
+        pruned = self._pruned_forests.get(n_trees)
+        if pruned is None:
+            pruned = copy.copy(self.rf_model)
+            pruned.estimators_ = self.rf_model.estimators_[:n_trees]
+            pruned.n_estimators = n_trees
+            self._pruned_forests[n_trees] = pruned
+        return pruned
+
+    def predict_xgb(self, X, missing=np.nan, timings=None):
+        started_at = time.perf_counter()
+        with metrics.stage('predict', 'xgb_predict'):
+            predictions = self.booster.inplace_predict(X, missing=missing)
+        if timings is not None:
+            timings['xgb'] = time.perf_counter() - started_at
+        return predictions
+
+    def predict_rf(self, X, n_trees=None, timings=None):
+        """
+        Predict with the forest, or with the average of its first n_trees trees.
+        """
+        started_at = time.perf_counter()
+        with metrics.stage('predict', 'rf_predict'):
+            if n_trees is None or n_trees >= self.rf_n_estimators:
+                n_trees = self.rf_n_estimators
+                predictions = self.rf_model.predict(X)
+            elif hasattr(self.rf_model, 'estimators_'):
+                predictions = self._pruned_forest(n_trees).predict(X)
+            else:
+                predictions = self.rf_model.predict(X, trees=np.arange(n_trees))
+        if timings is not None:
+            timings['rf'] = time.perf_counter() - started_at
+            timings['rf_trees'] = n_trees
+        return predictions
+
+    def predict_members(self, X, missing=np.nan, n_trees=None, timings=None):
+        """
+        Predict with every member that has a non-zero weight.
+
+        Parameters:
+        n_trees (int, optional): Random forest trees to use, all by default. 0 skips the forest.
+        timings (dict, optional): Filled with the seconds taken by every member ('xgb', 'rf') and the trees used.
+
+        Returns:
+        tuple: XGBoost and random forest predictions, None for a member that was not evaluated.
+        """
+        xgb_weight, rf_weight = self.weights
+        use_xgb = xgb_weight > 0
+        use_rf = rf_weight > 0 and n_trees != 0
+        if use_xgb and use_rf and self.concurrent:
+            rf_future = get_member_pool().submit(self.predict_rf, X, n_trees, timings)
+            try:
+                xgb_predictions = self.predict_xgb(X, missing, timings)
+            finally:
+                rf_predictions = rf_future.result()
+            return xgb_predictions, rf_predictions
+
+        xgb_predictions = self.predict_xgb(X, missing, timings) if use_xgb else None
+        rf_predictions = self.predict_rf(X, n_trees, timings) if use_rf else None
+        return xgb_predictions, rf_predictions
+
+    def predict(self, X, missing=np.nan, n_trees=None, timings=None):
+        """
+        Predict with the weighted average of the members.
+
+        Parameters:
+        X (ndarray or sparse matrix): Preprocessed features (valid rows only).
+        missing (float): Value that XGBoost must treat as missing.
+        n_trees (int, optional): Random forest trees to use, all by default. With 0 only XGBoost is evaluated.
+        timings (dict, optional): Filled with the seconds taken by every member, see predict_members.
+
+        Returns:
+        ndarray: One float64 prediction per row.
+        """
+        try:
+            xgb_predictions, rf_predictions = self.predict_members(X, missing, n_trees, timings)
+            xgb_weight, rf_weight = self.weights
+            if rf_predictions is None:
+                xgb_weight = 1.0
+            elif xgb_predictions is None:
+                rf_weight = 1.0
+
+            ensemble_prediction = np.zeros(X.shape[0], dtype=np.float64)
+            if xgb_predictions is not None:
+                ensemble_prediction += xgb_weight * np.asarray(xgb_predictions, dtype=np.float64)
+            if rf_predictions is not None:
+                ensemble_prediction += rf_weight * np.asarray(rf_predictions, dtype=np.float64)
+            return ensemble_prediction
+
+        except Exception as e:
+            raise CustomException(e, sys)
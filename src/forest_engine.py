@@ -0,0 +1,246 @@
+import os
+import sys
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from src.exception import CustomException
+
+
+# Marker of the leaves in the child arrays (sklearn.tree._tree.TREE_LEAF)
+TREE_LEAF = -1
+
+# Batches above this many rows are evaluated tree by tree, faster on large batches (see ForestEngine)
+FOREST_ENGINE_MAX_ROWS = int(os.environ.get('XTREAM_FOREST_ENGINE_MAX_ROWS', 256))
+
+# Threads evaluating groups of trees when n_jobs > 1, created on first use
+_tree_pool = None
+_tree_pool_lock = threading.Lock()
+
+
+def _get_tree_pool():
+    global _tree_pool
+    with _tree_pool_lock:
+        if _tree_pool is None:
+            _tree_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='forest')
+        return _tree_pool
+
+
+def _reset_tree_pool():
+    # The threads of the pool don't survive a fork
+    global _tree_pool, _tree_pool_lock
+    _tree_pool = None
+    _tree_pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_tree_pool)
+
+
+class ForestEngine:
+    """
+    Random forest regressor evaluated straight from flat node arrays.
+
+    The arrays (as written by src.artifact_format.forest_to_arrays) are used as they are, so
+    when they are views on a memory-mapped artifact every API worker process shares the same
+    physical pages: the forest takes memory once, not once per worker.
+
+    The evaluation walks all the trees at once, one tree level per step, and reproduces the
+    sklearn decision rule (float32 features compared with the float64 thresholds).
+
+    Like sklearn, n_jobs sets the threads used by predict: the trees are split into n_jobs groups
+    summed in parallel, then added up in group order. With n_jobs=1 (the default) the trees are
+    summed one by one, in the same order as sklearn.
+
+    The level-by-level walk wins on small batches but loses to sklearn on large ones, where the
+    numpy passes over the (rows x trees) arrays cost more than the compiled tree walk. Batches of
+    more than max_engine_rows rows are evaluated one tree at a time instead: the nodes of the tree
+    are copied into a sklearn Tree, its compiled apply finds the leaves of every row, and the tree
+    is dropped before the next one. Only one tree is copied at a time, so the forest still takes
+    memory once. Forests with quantized thresholds always use the level-by-level walk.
+
+    Compacted forests (see src/pipelines/compaction.py) may store narrower node arrays (int32
+    children, int16 features, float32 thresholds) and quantized ones:
+
+    - thresholds as uint16 codes into per-feature codebooks (bin_edges, split by bin_offsets):
+      every feature is replaced by the number of its thresholds below the value before the walk,
+      which takes the same branches as the thresholds themselves.
+    - leaf values as uint16 codes, mapped back by the value_offset and value_scale of the metadata.
+    """
+
+    def __init__(self, arrays, meta, max_block_nodes=2**20, n_jobs=1, max_engine_rows=FOREST_ENGINE_MAX_ROWS):
+        self.meta = meta
+        self.left_child = arrays['left_child']
+        self.right_child = arrays['right_child']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.value = arrays['value']
+        self.bin_edges = arrays.get('bin_edges')
+        self.bin_offsets = arrays.get('bin_offsets')
+        self.tree_offsets = np.asarray(arrays['tree_offsets'], dtype=np.int64)
+        self._max_depths = arrays['max_depth']
+        self.max_depth = int(np.max(arrays['max_depth'])) if len(arrays['max_depth']) else 0
+        self.n_features_in_ = int(meta['n_features_in_'])
+        self.n_outputs_ = int(meta['n_outputs_'])
+        self.n_estimators = len(self.tree_offsets) - 1
+        self.value_offset = float(meta.get('value_offset', 0.0))
+        self.value_scale = float(meta['value_scale']) if 'value_scale' in meta else None
+        # Rows evaluated together are limited so the (rows x trees) work arrays stay small
+        self.max_block_nodes = max_block_nodes
+        self.n_jobs = n_jobs
+        # None to always walk the node arrays level by level
+        self.max_engine_rows = max_engine_rows
+
+    @property
+    def nbytes(self):
+        arrays = self.to_arrays()[0]
+        return sum(arrays[name].nbytes for name in arrays if name != 'max_depth')
+
+    def to_arrays(self):
+        """
+        Return the node arrays and the metadata of the forest, as taken by the constructor.
+        """
+        arrays = {
+            'left_child': self.left_child,
+            'right_child': self.right_child,
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'value': self.value,
+            'tree_offsets': self.tree_offsets,
+            'max_depth': self._max_depths,
+        }
+        if self.bin_edges is not None:
+            arrays.update(bin_edges=self.bin_edges, bin_offsets=self.bin_offsets)
+        return arrays, dict(self.meta)
+
+    def _leaves(self, X, trees):
+        """
+        Return the global index of the leaf reached by every row in every tree of `trees`.
+        """
+        offsets = self.tree_offsets[trees]
+        nodes = np.broadcast_to(offsets, (X.shape[0], len(trees))).copy()
+        # Features are gathered from the flattened matrix: row * n_features + feature
+        X_flat = X.ravel()
+        row_starts = (np.arange(X.shape[0], dtype=np.int64) * X.shape[1])[:, None]
+
+        for _ in range(self.max_depth):
+            left = np.take(self.left_child, nodes)
+            internal = left != TREE_LEAF
+            if not internal.any():
+                break
+
+            # Leaves have a negative feature, their comparison is discarded below
+            values = np.take(X_flat, row_starts + np.take(self.feature, nodes), mode='clip')
+            go_left = values <= np.take(self.threshold, nodes)
+            children = np.where(go_left, left, np.take(self.right_child, nodes))
+            children = children + offsets
+            nodes = np.where(internal, children, nodes)
+
+        return nodes
+
+    def _sum_trees_compiled(self, X, trees):
+        """
+        Same as _sum_trees, walking the trees one by one with the compiled sklearn Tree.apply.
+        """
+        from sklearn.tree._tree import Tree, NODE_DTYPE
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        sums = np.zeros((X.shape[0], self.value.shape[1]), dtype=np.float64)
+        for t in trees:
+            start, end = int(self.tree_offsets[t]), int(self.tree_offsets[t + 1])
+            # Only the fields read by apply, the node statistics are left at zero
+            nodes = np.zeros(end - start, dtype=NODE_DTYPE)
+            nodes['left_child'] = self.left_child[start:end]
+            nodes['right_child'] = self.right_child[start:end]
+            nodes['feature'] = self.feature[start:end]
+            nodes['threshold'] = self.threshold[start:end]
+            tree = Tree(self.n_features_in_, np.ones(self.n_outputs_, dtype=np.intp), self.n_outputs_)
+            tree.__setstate__({'max_depth': int(self._max_depths[t]), 'node_count': end - start, 'nodes': nodes,
+                               'values': np.zeros((end - start, self.n_outputs_, 1))})
+            sums += self.value[start + tree.apply(X)]
+        return sums
+
+    def _sum_trees(self, X, trees):
+        """
+        Sum the values of the leaves reached by every row in the trees of `trees`.
+        """
+        sums = np.zeros((X.shape[0], self.value.shape[1]), dtype=np.float64)
+        block_rows = max(1, self.max_block_nodes // max(len(trees), 1))
+        for start in range(0, X.shape[0], block_rows):
+            block = slice(start, start + block_rows)
+            leaves = self._leaves(X[block], trees)
+            # Accumulate tree by tree, in the same order as sklearn
+            for t in range(len(trees)):
+                sums[block] += self.value[leaves[:, t]]
+        return sums
+
+    def _prepare(self, X):
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+        # Same precision as sklearn: features are float32, thresholds float64
+        X = np.ascontiguousarray(np.asarray(X, dtype=np.float32), dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[-1]} features, but the forest expects {self.n_features_in_}.")
+        if self.bin_edges is not None:
+            # Quantized thresholds: x <= threshold k of the feature iff fewer than k + 1 of its thresholds are below x
+            binned = np.empty_like(X)
+            for feature in range(self.n_features_in_):
+                edges = self.bin_edges[self.bin_offsets[feature]:self.bin_offsets[feature + 1]]
+                binned[:, feature] = np.searchsorted(edges, X[:, feature], side='left')
+            X = binned
+        return X
+
+    def apply(self, X, trees=None):
+        """
+        Return the leaf reached by every row in every tree, like the sklearn forests.
+
+        Returns:
+        ndarray: (rows, trees) indexes into the node arrays (global, not relative to the tree).
+        """
+        try:
+            X = self._prepare(X)
+            trees = np.arange(self.n_estimators) if trees is None else np.asarray(trees, dtype=np.int64)
+            block_rows = max(1, self.max_block_nodes // max(len(trees), 1))
+            blocks = [self._leaves(X[start:start + block_rows], trees) for start in range(0, X.shape[0], block_rows)]
+            return np.concatenate(blocks) if blocks else np.empty((0, len(trees)), dtype=np.int64)
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def predict(self, X, trees=None):
+        """
+        Predict with the average of the trees.
+
+        Parameters:
+        X (ndarray or sparse matrix): Preprocessed features.
+        trees (array-like, optional): Indexes of the trees to use. All of them by default.
+
+        Returns:
+        ndarray: One prediction per row (or per row and output for multi-output forests).
+        """
+        try:
+            X = self._prepare(X)
+            sum_trees = self._sum_trees
+            if self.max_engine_rows is not None and X.shape[0] > self.max_engine_rows and self.bin_edges is None:
+                sum_trees = self._sum_trees_compiled
+            trees = np.arange(self.n_estimators) if trees is None else np.asarray(trees, dtype=np.int64)
+            n_jobs = self.n_jobs or 1
+            if n_jobs < 0:
+                # Same convention as joblib: -1 is every CPU, -2 all but one...
+                n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+            n_groups = min(n_jobs, len(trees))
+            if n_groups > 1:
+                partial_sums = list(_get_tree_pool().map(lambda group: sum_trees(X, group),
+                                                         np.array_split(trees, n_groups)))
+                predictions = partial_sums[0]
+                for partial_sum in partial_sums[1:]:
+                    predictions += partial_sum
+            else:
+                predictions = sum_trees(X, trees)
+
+            predictions /= len(trees)
+            if self.value_scale is not None:
+                predictions = self.value_offset + self.value_scale * predictions
+            return predictions[:, 0] if self.n_outputs_ == 1 else predictions
+
+        except Exception as e:
+            raise CustomException(e, sys)
@@ -1,16 +1,220 @@
-import logging
+"""
+Logging setup shared by the API, the pipelines and the scripts.
+
+Log records are put on an in-memory queue and written to their files by a background thread
+(one QueueListener per file), so the request threads never wait on the disk. The messages are
+formatted by the writer thread too: the arguments of a log call must not be modified after it.
+
+Every record goes to the run log (LOG_DIR/<start time>.log); get_logger can give a logger its
+own file as well (the API and the training pipeline have one).
+
+Settings (environment variables):
+    XTREAM_LOG_DIR: Directory of the log files (default 'log').
+    XTREAM_LOG_LEVEL: Level of the loggers (default INFO).
+    XTREAM_LOG_PAYLOAD_SAMPLE: Fraction of the requests logged with their payload and response (default 0).
+    XTREAM_LOG_PAYLOAD_MAX_CHARS: Size limit of a logged payload or response (default 2000).
+"""
+
 import os
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import threading
+import multiprocessing.util
 from datetime import datetime
 
 
-LOG_FILE = f"{datetime.now().strftime('%m_%d_%Y_%H_%M_%S')}.log"
-logs_path = os.path.join(os.getcwd(),"logs",LOG_FILE)
-os.makedirs(logs_path, exist_ok=True)
+LOG_DIR = os.environ.get('XTREAM_LOG_DIR', 'log')
+LOG_LEVEL = os.environ.get('XTREAM_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+RUN_LOG_FILE = f"{datetime.now().strftime('%m_%d_%Y_%H_%M_%S')}.log"
+RUN_LOG_FORMAT = "[%(asctime)s] %(lineno)d %(name)s - %(levelname)s - %(message)s"
+
+PAYLOAD_SAMPLE_RATE = float(os.environ.get('XTREAM_LOG_PAYLOAD_SAMPLE', 0))
+PAYLOAD_MAX_CHARS = int(os.environ.get('XTREAM_LOG_PAYLOAD_MAX_CHARS', 2000))
+
+
+class _FileHandler(logging.FileHandler):
+    """
+    FileHandler that creates its directory when the first record is written.
+    """
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the formatting of the records to the writer thread.
+    """
+
+    def __init__(self, log_queue, file_name):
+        super().__init__(log_queue)
+        self.file_name = file_name
+
+    def prepare(self, record):
+        # The queue never leaves the process, so the record doesn't need to be made picklable
+        return record
+
+
+# (queue handler, file handler, listener) of every log file of the process
+_writers = []
+_lock = threading.Lock()
+
+
+def _start_listener(queue_handler, file_handler):
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _file_queue_handler(file_name, fmt=LOG_FORMAT):
+    """
+    Create the queue handler of a log file and start the thread that writes its records.
+    """
+    file_handler = _FileHandler(os.path.join(LOG_DIR, file_name), mode='a', encoding='utf-8', delay=True)
+    file_handler.setFormatter(logging.Formatter(fmt))
+
+    queue_handler = _DeferredQueueHandler(queue.SimpleQueue(), file_name)
+    _writers.append([queue_handler, file_handler, _start_listener(queue_handler, file_handler)])
+    return queue_handler
+
+
+def _restart_writers():
+    # Threads don't survive a fork: a child process (e.g. a scoring worker) gets new queues and writers
+    for writer in _writers:
+        queue_handler, file_handler, _ = writer
+        queue_handler.queue = queue.SimpleQueue()
+        writer[2] = _start_listener(queue_handler, file_handler)
+
+
+def flush():
+    """
+    Write the queued records and stop the writer threads. Called at exit.
+    """
+    with _lock:
+        for writer in _writers:
+            listener = writer[2]
+            if listener._thread is not None:
+                listener.stop()
+
+
+def _flush_at_child_exit(_):
+    # multiprocessing children end with os._exit, which skips the atexit functions
+    multiprocessing.util.Finalize(None, flush, exitpriority=0)
+
+
+atexit.register(flush)
+multiprocessing.util.register_after_fork(flush, _flush_at_child_exit)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_writers)
+
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    Send the records of every logger to the run log file. Only the first call has an effect, and
+    none if the root logger is already configured (e.g. by a server or a test runner).
+    """
+    root = logging.getLogger()
+    with _lock:
+        if root.handlers:
+            return
+        root.setLevel(level)
+        root.addHandler(_file_queue_handler(RUN_LOG_FILE, RUN_LOG_FORMAT))
+
+
+def get_logger(name, file_name=None, level=LOG_LEVEL):
+    """
+    Return a logger whose records are written in the background.
+
+    Parameters:
+    name (str): Name of the logger.
+    file_name (str, optional): Log file of its own in LOG_DIR, on top of the run log.
+    level (str or int): Level of the logger.
+    """
+    configure_logging()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if file_name is not None:
+        with _lock:
+            if not any(getattr(handler, 'file_name', None) == file_name for handler in logger.handlers):
+                logger.addHandler(_file_queue_handler(file_name))
+    return logger
+
+
+def add_console_handler(logger):
+    """
+    Report the records of a logger on the console too (command line scripts).
+    """
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(console)
+    return logger
+
+
+class _Json:
+    """
+    Log argument serialized to JSON only when the record is written, by the writer thread.
+    """
+
+    def __init__(self, value, max_chars=None):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self):
+        text = json.dumps(self.value, default=str)
+        if self.max_chars is not None and len(text) > self.max_chars:
+            text = json.dumps(text[:self.max_chars] + f"... ({len(text)} chars)")
+        return text
+
+
+class _JsonSummary(_Json):
+    # The payload and response are already serialized (and truncated) JSON
+    def __str__(self):
+        fields = (f'{json.dumps(key)}: {value if isinstance(value, _Json) else json.dumps(value, default=str)}'
+                  for key, value in self.value.items())
+        return '{' + ', '.join(fields) + '}'
+
+
+def sample_payload(rate=None):
+    """
+    Draw whether a request is logged with its payload, with probability XTREAM_LOG_PAYLOAD_SAMPLE.
+    """
+    rate = PAYLOAD_SAMPLE_RATE if rate is None else rate
+    return rate > 0 and random.random() < rate
+
+
+def log_request(logger, endpoint, latency, status='ok', payload=None, response=None, **fields):
+    """
+    Log the summary of a request as a single JSON line, e.g.
+    {"endpoint": "predict", "status": "ok", "latency_ms": 3.2, "rows": 100, "model_version": "v000004"}
+
+    Parameters:
+    logger (Logger): Logger of the API.
+    endpoint (str): Name of the endpoint.
+    latency (float): Time spent on the request, in seconds.
+    status (str): 'ok' or 'error'.
+    payload, response (optional): Request and response, only logged (truncated to
+        XTREAM_LOG_PAYLOAD_MAX_CHARS) for the sampled requests and the failed ones.
+    **fields: Other fields of the summary (rows, model_version...).
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    summary = {'endpoint': endpoint, 'status': status, 'latency_ms': round(latency * 1000, 3)}
+    summary.update(fields)
+    if status != 'ok' or sample_payload():
+        if payload is not None:
+            summary['payload'] = _Json(payload, PAYLOAD_MAX_CHARS)
+        if response is not None:
+            summary['response'] = _Json(response, PAYLOAD_MAX_CHARS)
+
+    logger.info("request %s", _JsonSummary(summary))
 
-LOG_FILE_PATH = os.path.join(logs_path, LOG_FILE)
 
-logging.basicConfig(
-    filename = LOG_FILE_PATH,
-    format = "[%(asctime)s] %(lineno)d %(name)s - %(levelname)s - %(message)s",
-    level = logging.INFO,
-)
\ No newline at end of file
+configure_logging()
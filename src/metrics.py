@@ -0,0 +1,187 @@
+"""
+In-process metrics of the API and the pipelines, exposed in the Prometheus text format.
+
+The stages of the prediction and training pipelines are timed with metrics.stage(), e.g.
+
+    with metrics.stage('predict', 'xgb_predict'):
+        xgb_predictions = XGB_model.predict(DX)
+
+and aggregated into histograms, like the request latencies and batch sizes. When the metrics are
+disabled (XTREAM_METRICS=0), stage() returns a shared no-op context manager and the observations
+return right away.
+
+Metrics are kept per process: with several server workers (or the ASGI process pool) every
+process reports its own.
+"""
+
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+
+METRICS_ENABLED = os.environ.get('XTREAM_METRICS', '1') == '1'
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROWS_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, labelvalues, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Thread-safe histogram with fixed buckets, one series per combination of label values.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Counts per bucket (the last one above every bound) and the sum of the values
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+
+        lines = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class _StageTimer:
+    __slots__ = ('histogram', 'labelvalues', 'started_at')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, *self.labelvalues)
+        return False
+
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+class Metrics:
+    """
+    Registry of the metrics of the process.
+
+    Parameters:
+    enabled (bool): If False, nothing is timed nor recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._metrics = []
+        self._collectors = []
+
+        self.stage_seconds = self.register(Histogram(
+            'xtream_stage_duration_seconds', 'Time spent in every stage of the pipelines and request handlers.',
+            LATENCY_BUCKETS, ('pipeline', 'stage')))
+        self.request_seconds = self.register(Histogram(
+            'xtream_request_duration_seconds', 'Latency of the API requests.',
+            LATENCY_BUCKETS, ('endpoint', 'status')))
+        self.request_rows = self.register(Histogram(
+            'xtream_request_rows', 'Rows per API request.', ROWS_BUCKETS, ('endpoint',)))
+        self.batch_rows = self.register(Histogram(
+            'xtream_batch_rows', 'Rows per batch sent to the models (after micro-batching and the prediction cache).',
+            ROWS_BUCKETS, ('pipeline',)))
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Add a function called on every scrape, which returns (name, kind, documentation, samples)
+        tuples, samples being a list of (labels dict, value) pairs. Used for the values that already
+        live elsewhere (model version, cache counters...).
+        """
+        self._collectors.append(collector)
+
+    def stage(self, pipeline, stage):
+        """
+        Context manager timing a stage of a pipeline.
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return _StageTimer(self.stage_seconds, (pipeline, stage))
+
+    def observe_request(self, endpoint, status, latency, rows=None):
+        if not self.enabled:
+            return
+        self.request_seconds.observe(latency, endpoint, status)
+        if rows is not None:
+            self.request_rows.observe(rows, endpoint)
+
+    def observe_batch(self, pipeline, rows):
+        if self.enabled:
+            self.batch_rows.observe(rows, pipeline)
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the process, shared by the API and the pipelines
+metrics = Metrics(enabled=METRICS_ENABLED)
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import logging
+import threading
+from src.exception import CustomException
+from src.utils import ModelStore
+from src.compiled_preprocessor import compile_preprocessor, CompiledPreprocessor
+from src.artifact_format import DERIVED_FROM, load_artifact, native_file_name, lite_file_name
+from src.ensemble_engine import EnsembleEngine
+
+
+logger = logging.getLogger(__name__)
+
+# Artifacts needed to serve predictions
+ARTIFACT_FILES = {
+    'xgb_model': 'XGRegressorModel_v2.pkl',
+    'rf_model': 'RandomForestRegressorModel.pkl',
+    'preprocessor': 'preprocessor_predict.pkl',
+}
+
+# Versioned store shared by the predict and train pipelines
+model_store = ModelStore(root='artifacts/store', legacy_dir='artifacts', derived_files=DERIVED_FROM)
+
+# Served variant of the models: 'full', or 'lite' for the compacted artifacts when the version has them
+MODEL_VARIANTS = ('full', 'lite')
+MODEL_VARIANT = os.environ.get('XTREAM_MODEL_VARIANT', 'full')
+
+
+def artifact_signature(paths):
+    """
+    Build a signature of the artifact files based on their modification time and size.
+
+    Parameters:
+    paths (dict): Mapping of artifact name to file path.
+
+    Returns:
+    tuple: One (name, mtime_ns, size) entry per artifact. Missing files are reported with None values.
+    """
+    signature = []
+    for name, path in sorted(paths.items()):
+        try:
+            stat = os.stat(path)
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((name, None, None))
+    return tuple(signature)
+
+
+class ModelSnapshot:
+    """
+    Immutable set of loaded artifacts. A request keeps the snapshot it started with,
+    so a reload never changes the models in the middle of a prediction.
+    """
+
+    def __init__(self, artifacts, signature, version=None):
+        self._artifacts = dict(artifacts)
+        self.signature = signature
+        self.version = version
+        self.loaded_at = time.time()
+
+    def __getitem__(self, name):
+        return self._artifacts[name]
+
+    def __contains__(self, name):
+        return name in self._artifacts
+
+    def get(self, name, default=None):
+        return self._artifacts.get(name, default)
+
+
+class ModelRegistry:
+    """
+    Process-wide holder of the serving artifacts.
+
+    The artifacts are unpickled once and shared by every request. A background watcher
+    polls the model store pointer (or the legacy files, until a version is published) and,
+    when it changes, loads the new versions and swaps the snapshot reference. Readers never
+    wait on a reload: they keep using the previous snapshot until the swap happens.
+    """
+
+    def __init__(self, artifact_files=None, poll_interval=2.0, store=None, prefer_native=True, variant='full'):
+        if variant not in MODEL_VARIANTS:
+            raise ValueError(f"Unknown model variant '{variant}', expected one of {MODEL_VARIANTS}.")
+        self.artifact_files = dict(artifact_files or ARTIFACT_FILES)
+        self.poll_interval = poll_interval
+        self.store = store if store is not None else model_store
+        self.prefer_native = prefer_native
+        self.variant = variant
+        self._snapshot = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._stop_event = threading.Event()
+
+    def _resolve(self, file_name, version):
+        """
+        Path of an artifact, in its native format when available (see src/artifact_format.py).
+        The lite variant takes the compacted artifact instead, when the version has one.
+        """
+        lite_name = lite_file_name(file_name) if self.variant == 'lite' else None
+        if lite_name is not None:
+            lite_path = self.store.resolve(lite_name, version)
+            if os.path.exists(lite_path):
+                return lite_path
+
+        native_name = native_file_name(file_name) if self.prefer_native else None
+        if native_name is not None:
+            native_path = self.store.resolve(native_name, version)
+            if os.path.exists(native_path):
+                return native_path
+        return self.store.resolve(file_name, version)
+
+    @property
+    def artifact_paths(self):
+        version = self.store.current_version()
+        return {name: self._resolve(file_name, version) for name, file_name in self.artifact_files.items()}
+
+    def _signature(self):
+        """
+        Published versions are immutable, so the version is enough. Legacy files are checked by mtime and size.
+        """
+        version = self.store.current_version()
+        if version is not None:
+            return ('version', version)
+        return artifact_signature(self.artifact_paths)
+
+    def load(self):
+        """
+        Load every artifact from disk and publish the new snapshot.
+
+        Returns:
+        ModelSnapshot: The snapshot that has been published.
+        """
+        try:
+            with self._reload_lock:
+                signature = self._signature()
+                version = signature[1] if signature[0] == 'version' else None
+                paths = {name: self._resolve(file_name, version) for name, file_name in self.artifact_files.items()}
+                artifacts = {name: load_artifact(path) for name, path in paths.items()}
+
+                # Fused NumPy version of the preprocessor, None if it falls back to sklearn.
+                # The native preprocessor artifact is already the compiled one.
+                if isinstance(artifacts.get('preprocessor'), CompiledPreprocessor):
+                    artifacts['compiled_preprocessor'] = artifacts['preprocessor']
+                elif 'preprocessor' in artifacts:
+                    artifacts['compiled_preprocessor'] = compile_preprocessor(artifacts['preprocessor'])
+
+                # Inference engine of the two models, with the ensemble weights and thread budgets
+                if 'xgb_model' in artifacts and 'rf_model' in artifacts:
+                    artifacts['ensemble'] = EnsembleEngine(artifacts['xgb_model'], artifacts['rf_model'])
+
+                # Legacy files changed while we were reading them, the next poll will pick them up again
+                if version is None and self._signature() != signature:
+                    signature = None
+
+                self._snapshot = ModelSnapshot(artifacts, signature, version=version)
+                logger.info("Model artifacts loaded (version %s, %s variant): %s", version or 'legacy', self.variant,
+                            list(paths.values()))
+                return self._snapshot
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def get(self):
+        """
+        Return the current snapshot, loading the artifacts on first use.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.load()
+        return snapshot
+
+    @property
+    def version(self):
+        """
+        Version of the models being served: the published version, 'legacy' for the legacy files, None until they are loaded.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        return snapshot.version or 'legacy'
+
+    def is_stale(self):
+        """
+        Check whether the artifact files changed since the current snapshot was loaded.
+        """
+        snapshot = self._snapshot
+        return snapshot is None or snapshot.signature != self._signature()
+
+    def refresh(self):
+        """
+        Reload the artifacts if they changed on disk. A failed reload (e.g. a file that is
+        still being written) keeps the previous snapshot in service.
+
+        Returns:
+        bool: True if a new snapshot was published.
+        """
+        if not self.is_stale():
+            return False
+
+        try:
+            self.load()
+            return True
+        except CustomException as e:
+            logger.warning("Artifact reload failed, keeping the current models: %s", e)
+            return False
+
+    def start_watching(self):
+        """
+        Start the background thread that hot reloads the artifacts.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._watcher = threading.Thread(target=self._watch, name='model-registry-watcher', daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop_event.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self.refresh()
+
+
+# Registry shared by the whole process
+model_registry = ModelRegistry(variant=MODEL_VARIANT)
+
+_registries = {MODEL_VARIANT: model_registry}
+_registries_lock = threading.Lock()
+
+
+def get_model_registry(variant=None):
+    """
+    Return the process-wide registry serving a variant of the models, model_registry by default.
+    """
+    variant = variant or MODEL_VARIANT
+    with _registries_lock:
+        if variant not in _registries:
+            _registries[variant] = ModelRegistry(variant=variant)
+        return _registries[variant]
@@ -0,0 +1,256 @@
+"""
+Streaming bulk scoring of CSV or NDJSON files.
+
+The input is read in fixed-size chunks, every chunk goes through the preprocessing and the
+ensemble and its results are written out before the next chunk is read, so the memory is
+bounded by the chunk size rather than by the file size.
+
+Usage:
+    python -m src.pipelines.bulk_scoring datasets/diamonds/diamonds.csv --output prices.csv
+    python -m src.pipelines.bulk_scoring requests.ndjson --chunk-size 5000 > prices.ndjson
+"""
+
+import io
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from src.exception import CustomException
+from src.decoding import FEATURE_COLUMNS, NUMERIC_FEATURES, decode_columns, columns_to_data_frame
+from src.pipelines.predict_pipeline import PredictPipeline
+
+
+logger = logging.getLogger(__name__)
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def detect_format(name):
+    """
+    Input format from a file name or a content type: 'csv' or 'ndjson' (the default).
+    """
+    return CSV if name and 'csv' in name.lower() else NDJSON
+
+
+def iter_csv_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a CSV file (same schema as datasets/diamonds/diamonds.csv, extra columns are ignored)
+    in chunks of decoded feature columns. Yields (columns, errors) like iter_ndjson_chunks.
+
+    Parameters:
+    source (str or file): Path or binary/text file object, it is read sequentially.
+    chunk_size (int): Rows per chunk.
+    """
+    reader = pd.read_csv(source, usecols=FEATURE_COLUMNS, chunksize=chunk_size,
+                         dtype={column: str for column in FEATURE_COLUMNS if column not in NUMERIC_FEATURES})
+    for chunk in reader:
+        yield _decode_csv_columns({column: chunk[column].to_numpy() for column in FEATURE_COLUMNS})
+
+
+def _decode_csv_columns(columns):
+    """
+    Decode the columns of a CSV chunk. If some rows are invalid (e.g. an empty cell), the others
+    are still decoded. Returns the same (columns, errors) as _decode_ndjson_rows.
+    """
+    try:
+        return decode_columns(columns), {}
+    except Exception:
+        pass
+
+    # Find the faulty rows one by one
+    rows, errors = [], {}
+    for i in range(len(columns[FEATURE_COLUMNS[0]])):
+        try:
+            decode_columns({column: values[i:i + 1] for column, values in columns.items()})
+            rows.append(i)
+        except Exception as e:
+            errors[i] = str(e)
+    return (decode_columns({column: values[rows] for column, values in columns.items()}) if rows else None), errors
+
+
+def iter_ndjson_chunks(lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read newline delimited JSON (one sample object per line) in chunks of decoded feature columns.
+    Yields the columns of the valid lines of every chunk and the errors of the invalid ones.
+
+    Parameters:
+    lines (iterable): Lines as str or bytes, e.g. an open file. Blank lines are skipped.
+    chunk_size (int): Rows per chunk.
+    """
+    rows = []
+    for line in lines:
+        if not line.strip():
+            continue
+        rows.append(line)
+        if len(rows) == chunk_size:
+            yield _decode_ndjson_rows(rows)
+            rows = []
+    if rows:
+        yield _decode_ndjson_rows(rows)
+
+
+def _decode_ndjson_rows(lines):
+    """
+    Decode the lines of a chunk. If some of them are invalid, the others are still decoded.
+
+    Returns:
+    tuple: The decoded columns of the valid lines (None if there are none) and a dict mapping
+    the position of every invalid line in the chunk to its error message.
+    """
+    try:
+        return decode_columns([json.loads(line) for line in lines]), {}
+    except Exception:
+        pass
+
+    # Find the faulty lines one by one
+    rows, errors = [], {}
+    for i, line in enumerate(lines):
+        try:
+            row = json.loads(line)
+            decode_columns([row])
+            rows.append(row)
+        except Exception as e:
+            errors[i] = str(e)
+    return (decode_columns(rows) if rows else None), errors
+
+
+def score_chunks(chunks, pipeline=None):
+    """
+    Score decoded chunks one at a time.
+
+    Parameters:
+    chunks (iterable): (columns, errors) pairs, as produced by iter_csv_chunks or iter_ndjson_chunks.
+    pipeline: Object with a predict_with_mask method, PredictPipeline by default.
+
+    Yields:
+    list: The result records of every chunk: index, predicted_price and the rejection reason if any.
+    """
+    pipeline = pipeline if pipeline is not None else PredictPipeline()
+    start = 0
+    for columns, errors in chunks:
+        scored = pipeline.predict_with_mask(columns_to_data_frame(columns)) if columns is not None else None
+        records = chunk_records(start, errors, scored)
+        yield records
+        start += len(records)
+
+
+def chunk_records(start, errors, scored):
+    """
+    Build the result records of a chunk.
+
+    Parameters:
+    start (int): Index of the first row of the chunk in the input.
+    errors (dict): Error message of the rows that could not be decoded, by position in the chunk.
+    scored (tuple): The (predictions, valid, reasons) of the other rows, None if there are none.
+
+    Returns:
+    list: One record per row of the chunk: index, predicted_price and the rejection reason or decoding error if any.
+    """
+    predictions, valid, reasons = scored if scored is not None else (np.empty(0), [], [])
+    prices = predictions.tolist()
+    n_rows = len(prices) + len(errors)
+
+    records = []
+    j = 0
+    for i in range(n_rows):
+        if i in errors:
+            records.append({'index': start + i, 'predicted_price': None, 'error': errors[i]})
+            continue
+        if valid[j]:
+            records.append({'index': start + i, 'predicted_price': prices[j]})
+        else:
+            records.append({'index': start + i, 'predicted_price': None, 'reason': reasons[j]})
+        j += 1
+
+    if errors:
+        logger.warning("%d rows between %d and %d could not be decoded", len(errors), start, start + n_rows - 1)
+    return records
+
+
+def iter_chunks(source, input_format, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a CSV or NDJSON input in chunks of (columns, errors), see iter_ndjson_chunks.
+    """
+    if input_format == CSV:
+        return iter_csv_chunks(source, chunk_size)
+    return iter_ndjson_chunks(source, chunk_size)
+
+
+def iter_results(source, input_format, chunk_size=DEFAULT_CHUNK_SIZE, pipeline=None):
+    """
+    Read and score a CSV or NDJSON input chunk by chunk.
+
+    Yields:
+    list: The result records of every chunk, in input order.
+    """
+    try:
+        n_rows = 0
+        started_at = time.perf_counter()
+        for records in score_chunks(iter_chunks(source, input_format, chunk_size), pipeline):
+            n_rows += len(records)
+            yield records
+
+        elapsed = time.perf_counter() - started_at
+        logger.info("Bulk scoring: %d rows in %.2fs (%.0f rows/s)", n_rows, elapsed, n_rows / elapsed if elapsed else 0.0)
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def stream_ndjson(source, input_format, chunk_size=DEFAULT_CHUNK_SIZE, pipeline=None):
+    """
+    Score an input and stream the results as NDJSON, one encoded chunk at a time.
+
+    Yields:
+    bytes: The result lines of a chunk.
+    """
+    for records in iter_results(source, input_format, chunk_size, pipeline):
+        yield ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+
+def write_results(records_iter, output, output_format):
+    """
+    Write the result records to a text file, as CSV or NDJSON.
+    """
+    if output_format == CSV:
+        writer = csv.DictWriter(output, fieldnames=['index', 'predicted_price', 'reason', 'error'],
+                                extrasaction='ignore')
+        writer.writeheader()
+        for records in records_iter:
+            writer.writerows(records)
+    else:
+        for records in records_iter:
+            output.writelines(json.dumps(record) + '\n' for record in records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="CSV or NDJSON file to score, '-' for stdin")
+    parser.add_argument('--output', default='-', help="Output file (default: stdout). Written as CSV if its name ends with .csv")
+    parser.add_argument('--input-format', choices=[CSV, NDJSON], help='Format of the input (default: from its extension)')
+    parser.add_argument('--output-format', choices=[CSV, NDJSON], help='Format of the output (default: from its extension)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows scored at a time')
+    args = parser.parse_args(argv)
+
+    input_format = args.input_format or detect_format(args.input)
+    output_format = args.output_format or detect_format(args.output)
+
+    source = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        write_results(iter_results(source, input_format, args.chunk_size), output, output_format)
+    finally:
+        source.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+"""
+Compaction of the served models into a "lite" variant.
+
+The random forest is most of the size of the artifacts and of the prediction latency. The
+lite forest is built from the served one with:
+
+- fewer trees, chosen by marginal contribution: starting from an empty forest, the tree whose
+  addition lowers the most the RMSE of the ensemble (on a sample of the evaluation data) is
+  added, until n_trees are selected. The trees are stored in selection order, so the first
+  ones are also the best subset for the pruned serving path (src/pipelines/degradation.py).
+- a depth limit: the nodes below max_depth are cut and the node at max_depth becomes a leaf,
+  predicting the mean of its training samples (the value sklearn keeps in every node).
+- narrower node arrays: int32 children, int16 features and float32 thresholds rounded down,
+  which splits the float32 features exactly like the float64 ones. With the 'quantized'
+  precision the thresholds are uint16 codes into per-feature codebooks (same splits again)
+  and the leaf values uint16 codes on the range of the leaves.
+
+The XGBoost booster is kept as it is: its thresholds and leaf values are already float32 and
+the continual training keeps appending rounds to the served one.
+
+The report gives the RMSE and R² of the full and lite ensembles on the evaluation data
+(datasets/diamonds/diamonds_clean.csv, also used to train the models, so the deltas measure
+how far the lite models are from the full ones) next to the prediction latency, the size and
+the load time of the forest. With --publish, the lite forest is published in a new model
+version next to the full artifacts (RandomForestRegressorModel_lite.forest), and served with
+XTREAM_MODEL_VARIANT=lite or PredictPipeline(variant='lite').
+
+Usage:
+    python -m src.pipelines.compaction --trees 20 --max-depth 12 --precision float32 --publish
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_error, r2_score
+from src.exception import CustomException
+from src.logger import add_console_handler
+from src.utils import preprocess_data_to_predict
+from src.decoding import FEATURE_COLUMNS
+from src.forest_engine import ForestEngine, TREE_LEAF
+from src.ensemble_engine import EnsembleEngine
+from src.model_registry import ARTIFACT_FILES, get_model_registry, model_store
+from src.artifact_format import forest_to_arrays, lite_file_name, load_artifact, save_artifact
+
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ('float64', 'float32', 'quantized')
+LATENCY_BATCH_SIZES = (1, 100, 1000)
+
+# Leaf values are quantized on the whole uint16 range
+_QUANTIZATION_LEVELS = np.iinfo(np.uint16).max
+
+
+def forest_arrays(forest):
+    """
+    Node arrays and metadata of a RandomForestRegressor or a ForestEngine.
+    """
+    return forest.to_arrays() if isinstance(forest, ForestEngine) else forest_to_arrays(forest)
+
+
+def round_down(values, dtype):
+    """
+    Convert floats to a narrower dtype, rounding every value down to the closest representable one.
+    A float32 feature x satisfies x <= t exactly when it satisfies x <= round_down(t, np.float32).
+    """
+    narrow = np.asarray(values).astype(dtype)
+    above = narrow.astype(np.float64) > values
+    narrow[above] = np.nextafter(narrow[above], dtype(-np.inf))
+    return narrow
+
+
+def quantize_thresholds(thresholds, features, n_features):
+    """
+    Replace the thresholds by their index in the sorted float32 thresholds of their feature.
+
+    Returns:
+    tuple: The uint16 threshold codes (0 for the leaves), the concatenated codebooks and their offsets per feature.
+    """
+    codes = np.zeros(len(thresholds), dtype=np.uint16)
+    edges, offsets = [], [0]
+    for feature in range(n_features):
+        split = features == feature
+        codebook, inverse = np.unique(round_down(thresholds[split], np.float32), return_inverse=True)
+        if len(codebook) > np.iinfo(np.uint16).max:
+            raise ValueError(f"Feature {feature} has {len(codebook)} thresholds, too many to quantize on 16 bits.")
+        codes[split] = inverse
+        edges.append(codebook)
+        offsets.append(offsets[-1] + len(codebook))
+    return codes, np.concatenate(edges).astype(np.float32), np.asarray(offsets, dtype=np.int64)
+
+
+def truncate_tree(arrays, start, end, max_depth=None):
+    """
+    Cut a tree of the node arrays at max_depth.
+
+    Parameters:
+    arrays (dict): Node arrays of the forest (see forest_to_arrays).
+    start, end (int): Node range of the tree.
+    max_depth (int, optional): Depth of the deepest leaves kept, the tree is only copied if None.
+
+    Returns:
+    dict: The node arrays of the tree (children relative to the tree) and its 'depth'.
+    """
+    left = np.asarray(arrays['left_child'][start:end])
+    right = np.asarray(arrays['right_child'][start:end])
+
+    # Depth-first walk in the sklearn node order, stopping at max_depth
+    kept, depths = [], []
+    stack = [(0, 0)]
+    while stack:
+        node, depth = stack.pop()
+        kept.append(node)
+        depths.append(depth)
+        if left[node] != TREE_LEAF and (max_depth is None or depth < max_depth):
+            stack.append((right[node], depth + 1))
+            stack.append((left[node], depth + 1))
+    kept = np.asarray(kept, dtype=np.int64)
+    depths = np.asarray(depths, dtype=np.int64)
+
+    renumber = np.full(end - start, TREE_LEAF, dtype=np.int64)
+    renumber[kept] = np.arange(len(kept))
+    leaf = left[kept] == TREE_LEAF
+    if max_depth is not None:
+        leaf |= depths >= max_depth
+
+    return {
+        'left_child': np.where(leaf, TREE_LEAF, renumber[left[kept]]),
+        'right_child': np.where(leaf, TREE_LEAF, renumber[right[kept]]),
+        # sklearn marks the leaves with feature and threshold -2 (TREE_UNDEFINED)
+        'feature': np.where(leaf, -2, np.asarray(arrays['feature'][start:end])[kept]),
+        'threshold': np.where(leaf, -2.0, np.asarray(arrays['threshold'][start:end])[kept]),
+        'value': np.asarray(arrays['value'][start:end])[kept],
+        'depth': int(depths.max()),
+    }
+
+
+def stack_trees(trees, meta, precision='float64'):
+    """
+    Build a ForestEngine from per-tree node arrays, stored with the given precision.
+    """
+    node_counts = [len(tree['left_child']) for tree in trees]
+    arrays = {
+        'left_child': np.concatenate([tree['left_child'] for tree in trees]),
+        'right_child': np.concatenate([tree['right_child'] for tree in trees]),
+        'feature': np.concatenate([tree['feature'] for tree in trees]),
+        'threshold': np.concatenate([tree['threshold'] for tree in trees]).astype(np.float64),
+        'value': np.concatenate([tree['value'] for tree in trees]).astype(np.float64),
+        'tree_offsets': np.concatenate([[0], np.cumsum(node_counts)]).astype(np.int64),
+        'max_depth': np.array([tree['depth'] for tree in trees], dtype=np.int64),
+    }
+    meta = dict(meta, precision=precision)
+
+    if precision != 'float64':
+        # Children are relative to their tree, features fit in 16 bits
+        arrays['left_child'] = arrays['left_child'].astype(np.int32)
+        arrays['right_child'] = arrays['right_child'].astype(np.int32)
+        if meta['n_features_in_'] < np.iinfo(np.int16).max:
+            arrays['feature'] = arrays['feature'].astype(np.int16)
+
+    if precision == 'float32':
+        arrays['threshold'] = round_down(arrays['threshold'], np.float32)
+        arrays['value'] = arrays['value'].astype(np.float32)
+    elif precision == 'quantized':
+        arrays['threshold'], arrays['bin_edges'], arrays['bin_offsets'] = quantize_thresholds(
+            arrays['threshold'], arrays['feature'], meta['n_features_in_'])
+        low, high = float(arrays['value'].min()), float(arrays['value'].max())
+        scale = (high - low) / _QUANTIZATION_LEVELS if high > low else 1.0
+        arrays['value'] = np.round((arrays['value'] - low) / scale).astype(np.uint16)
+        meta.update(value_offset=low, value_scale=scale)
+
+    return ForestEngine(arrays, meta)
+
+
+def select_trees(tree_predictions, y, base, rf_weight, n_trees):
+    """
+    Greedy forward selection of the trees by marginal contribution to the ensemble.
+
+    Parameters:
+    tree_predictions (ndarray): (rows, trees) prediction of every tree.
+    y (ndarray): Target of the rows.
+    base (ndarray): Weighted XGBoost part of the ensemble prediction of the rows.
+    rf_weight (float): Weight of the forest in the ensemble.
+    n_trees (int): Trees to select.
+
+    Returns:
+    list: The selected trees, best first.
+    """
+    residual = y - base
+    total = np.zeros(len(y))
+    available = np.ones(tree_predictions.shape[1], dtype=bool)
+    selected = []
+    for k in range(min(n_trees, tree_predictions.shape[1])):
+        errors = residual[:, None] - rf_weight * (total[:, None] + tree_predictions) / (k + 1)
+        rmse = np.sqrt(np.mean(errors ** 2, axis=0))
+        rmse[~available] = np.inf
+        best = int(np.argmin(rmse))
+        selected.append(best)
+        available[best] = False
+        total += tree_predictions[:, best]
+    return selected
+
+
+def compact_forest(forest, X, y, base, rf_weight, n_trees=20, max_depth=None, precision='float32'):
+    """
+    Build the lite version of a forest.
+
+    Parameters:
+    forest: RandomForestRegressor or ForestEngine.
+    X, y (ndarray): Preprocessed rows the trees are selected on, and their target.
+    base (ndarray): Weighted XGBoost part of the ensemble prediction of these rows.
+    rf_weight (float): Weight of the forest in the ensemble.
+    n_trees (int): Trees to keep.
+    max_depth (int, optional): Depth limit of the trees.
+    precision (str): 'float64', 'float32' or 'quantized', see the module docstring.
+
+    Returns:
+    ForestEngine: The lite forest.
+    """
+    try:
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}.")
+
+        arrays, meta = forest_arrays(forest)
+        offsets = np.asarray(arrays['tree_offsets'])
+        trees = [truncate_tree(arrays, int(offsets[i]), int(offsets[i + 1]), max_depth)
+                 for i in range(len(offsets) - 1)]
+        lite_meta = {
+            'kind': 'random_forest_regressor_lite',
+            'n_features_in_': int(meta['n_features_in_']),
+            'n_outputs_': int(meta['n_outputs_']),
+            'source_trees': len(trees),
+            'max_depth_limit': max_depth,
+        }
+
+        # Prediction of every (truncated) tree, to select them on
+        truncated = stack_trees(trees, lite_meta)
+        tree_predictions = truncated.value[truncated.apply(X), 0]
+        selected = select_trees(tree_predictions, y, base, rf_weight, n_trees)
+        logger.info("Selected trees %s out of %d", selected, len(trees))
+
+        lite_meta['selected_trees'] = selected
+        return stack_trees([trees[i] for i in selected], lite_meta, precision)
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def evaluation_matrix(models, df):
+    """
+    Preprocess the evaluation rows like the prediction pipeline.
+
+    Returns:
+    tuple: The preprocessed valid rows, their target and the value XGBoost treats as missing.
+    """
+    compiled_preprocessor = models.get('compiled_preprocessor')
+    if compiled_preprocessor is not None:
+        X, valid, _ = compiled_preprocessor.transform(df[FEATURE_COLUMNS], return_mask=True)
+        missing = compiled_preprocessor.missing
+    else:
+        X, valid, _ = preprocess_data_to_predict(df=df[FEATURE_COLUMNS],
+                                                 preprocessor=models['preprocessor'],
+                                                 numeric_features=['volume', 'carat', 'depth', 'table'],
+                                                 categorical_features=['color', 'cut', 'clarity'],
+                                                 return_mask=True)
+        missing = np.nan
+    return X, df['price'].to_numpy(dtype=np.float64)[valid], missing
+
+
+def _scores(y, predictions):
+    return {'rmse': float(mean_squared_error(y, predictions, squared=False)), 'r2': float(r2_score(y, predictions))}
+
+
+def evaluate(ensemble, X, y, missing):
+    """
+    RMSE and R² of the ensemble and of its forest alone.
+    """
+    result = _scores(y, ensemble.predict(X, missing=missing))
+    forest = _scores(y, ensemble.predict_rf(X))
+    result.update(rf_rmse=forest['rmse'], rf_r2=forest['r2'])
+    return result
+
+
+def time_predictions(ensemble, X, missing, batch_sizes=LATENCY_BATCH_SIZES, repeats=20):
+    """
+    Median latency (ms) of the ensemble prediction for every batch size.
+    """
+    latencies = {}
+    for batch_size in batch_sizes:
+        batch = X[:batch_size]
+        durations = []
+        for _ in range(repeats):
+            started_at = time.perf_counter()
+            ensemble.predict(batch, missing=missing)
+            durations.append(time.perf_counter() - started_at)
+        latencies[str(batch.shape[0])] = 1000 * float(np.median(durations))
+    return latencies
+
+
+def _artifact_stats(path, forest):
+    started_at = time.perf_counter()
+    load_artifact(path)
+    arrays, _ = forest_arrays(forest)
+    return {
+        'file': os.path.basename(path),
+        'trees': len(arrays['tree_offsets']) - 1,
+        'nodes': int(arrays['tree_offsets'][-1]),
+        'file_bytes': os.path.getsize(path),
+        # Arrays used by the predictions
+        'array_bytes': int(sum(np.asarray(arrays[name]).nbytes for name in
+                               ('left_child', 'right_child', 'feature', 'threshold', 'value', 'tree_offsets',
+                                'bin_edges', 'bin_offsets') if name in arrays)),
+        'load_ms': 1000 * (time.perf_counter() - started_at),
+    }
+
+
+def _deltas(full, lite):
+    deltas = {name: lite['scores'][name] - full['scores'][name] for name in full['scores']}
+    deltas['file_bytes_saved'] = 1 - lite['size']['file_bytes'] / full['size']['file_bytes']
+    deltas['array_bytes_saved'] = 1 - lite['size']['array_bytes'] / full['size']['array_bytes']
+    deltas['speedup'] = {batch: full['latency_ms'][batch] / lite['latency_ms'][batch] for batch in full['latency_ms']}
+    return deltas
+
+
+def run_compaction(n_trees=20, max_depth=None, precision='float32', data_path='datasets/diamonds/diamonds_clean.csv',
+                   selection_rows=2000, seed=42, publish=False):
+    """
+    Build the lite forest from the served models and compare the two ensembles.
+
+    Returns:
+    dict: The report, with the published version if publish is True.
+    """
+    try:
+        registry = get_model_registry('full')
+        models = registry.get()
+        full_ensemble = models['ensemble']
+        rf_path = registry.artifact_paths['rf_model']
+
+        X, y, missing = evaluation_matrix(models, pd.read_csv(data_path))
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(X.shape[0], size=min(selection_rows, X.shape[0]), replace=False))
+        X_select = X[rows]
+        base = full_ensemble.weights[0] * full_ensemble.predict_xgb(X_select, missing)
+
+        lite_forest = compact_forest(full_ensemble.rf_model, X_select, y[rows], base, full_ensemble.weights[1],
+                                     n_trees, max_depth, precision)
+        lite_ensemble = EnsembleEngine(full_ensemble.booster, lite_forest, weights=full_ensemble.weights,
+                                       concurrent=full_ensemble.concurrent)
+
+        lite_name = lite_file_name(ARTIFACT_FILES['rf_model'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lite_path = os.path.join(tmp_dir, lite_name)
+            save_artifact(lite_path, lite_forest)
+            lite_size = _artifact_stats(lite_path, lite_forest)
+
+        full = {
+            'scores': evaluate(full_ensemble, X, y, missing),
+            'latency_ms': time_predictions(full_ensemble, X, missing),
+            'size': _artifact_stats(rf_path, full_ensemble.rf_model),
+        }
+        lite = {
+            'scores': evaluate(lite_ensemble, X, y, missing),
+            'latency_ms': time_predictions(lite_ensemble, X, missing),
+            'size': lite_size,
+        }
+        report = {
+            'settings': {'trees': n_trees, 'max_depth': max_depth, 'precision': precision, 'data': data_path,
+                         'evaluation_rows': int(X.shape[0]), 'selection_rows': int(len(rows)),
+                         'model_version': registry.version},
+            'full': full,
+            'lite': lite,
+            'delta': _deltas(full, lite),
+        }
+
+        if publish:
+            # Next to the full artifacts, served by the lite variant of the registry
+            report['published_version'] = model_store.publish({lite_name: lite_forest}, base_version=models.version,
+                                                              save=save_artifact)
+            logger.info("Lite forest published in version %s", report['published_version'])
+
+        return report
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trees', type=int, default=20, help='Random forest trees kept')
+    parser.add_argument('--max-depth', type=int, help='Depth limit of the trees (default: no limit)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='float32', help='Storage of the thresholds and leaf values')
+    parser.add_argument('--data', default='datasets/diamonds/diamonds_clean.csv', help='Evaluation data')
+    parser.add_argument('--selection-rows', type=int, default=2000, help='Evaluation rows sampled to select the trees')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the selection sample')
+    parser.add_argument('--publish', action='store_true', help='Publish the lite forest in a new model version')
+    parser.add_argument('--output', help='Where to write the JSON report')
+    args = parser.parse_args(argv)
+
+    add_console_handler(logger)
+
+    report = run_compaction(args.trees, args.max_depth, args.precision, args.data, args.selection_rows,
+                            args.seed, args.publish)
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as file_obj:
+            json.dump(report, file_obj, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import time
+import threading
+import contextlib
+
+
+# Serving paths of a prediction, from the most to the least accurate
+FULL = 'full'
+PRUNED = 'pruned'
+XGB_ONLY = 'xgb_only'
+SERVING_PATHS = (FULL, PRUNED, XGB_ONLY)
+
+
+class CostModel:
+    """
+    Running estimate of the time a member takes per row (and per tree for the forest).
+
+    The cost per row is not constant, small batches pay the fixed overhead of the call,
+    so it is tracked with an exponential moving average per power-of-two batch size.
+
+    An estimate that is not observed again halves every half_life seconds. A member skipped
+    because it looked too slow is then tried again once the estimate fits the budget, so a
+    transient slowdown does not keep it out for good.
+    """
+
+    def __init__(self, alpha=0.2, half_life=30.0):
+        self.alpha = alpha
+        self.half_life = half_life
+        # Cost per row and time of the last observation of every batch size
+        self._per_row = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, bucket, now):
+        cost, observed_at = self._per_row[bucket]
+        if not self.half_life:
+            return cost
+        return cost * 0.5 ** (max(now - observed_at, 0.0) / self.half_life)
+
+    def observe(self, n_rows, seconds, units=1):
+        """
+        Record a call on n_rows rows that took seconds, units being the trees evaluated (1 for XGBoost).
+        """
+        if n_rows <= 0 or units <= 0:
+            return
+        bucket = n_rows.bit_length()
+        cost = seconds / (n_rows * units)
+        now = time.monotonic()
+        with self._lock:
+            previous = self._decayed(bucket, now) if bucket in self._per_row else None
+            self._per_row[bucket] = (cost if previous is None else previous + self.alpha * (cost - previous), now)
+
+    def estimate(self, n_rows, units=1):
+        """
+        Estimated seconds of a call on n_rows rows, taken from the closest batch size observed.
+        None before the first observation.
+        """
+        bucket = n_rows.bit_length()
+        with self._lock:
+            if not self._per_row:
+                return None
+            closest = min(self._per_row, key=lambda observed: (abs(observed - bucket), -observed))
+            return self._decayed(closest, time.monotonic()) * n_rows * units
+
+    def as_dict(self):
+        with self._lock:
+            now = time.monotonic()
+            return {f'<{2 ** bucket}': 1e6 * self._decayed(bucket, now) for bucket in sorted(self._per_row)}
+
+
+class DegradationStats:
+    """
+    Thread-safe counters of the serving paths.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.batches = dict.fromkeys(SERVING_PATHS, 0)
+            self.rows = dict.fromkeys(SERVING_PATHS, 0)
+            self.reasons = {'budget': 0, 'in_flight': 0}
+
+    def record(self, path, n_rows, reason=None):
+        with self._lock:
+            self.batches[path] += 1
+            self.rows[path] += n_rows
+            if reason is not None:
+                self.reasons[reason] += 1
+
+    def as_dict(self):
+        with self._lock:
+            degraded = sum(self.batches.values()) - self.batches[FULL]
+            return {
+                'batches': dict(self.batches),
+                'rows': dict(self.rows),
+                'degraded_batches': degraded,
+                'degraded_by': dict(self.reasons),
+            }
+
+
+class DegradationPolicy:
+    """
+    Choice of the serving path of every batch sent to the ensemble.
+
+    The random forest is the expensive member. When the time left before the request deadline
+    can't pay for all of its trees, the batch is scored with the first trees that fit (the trees
+    of a forest are interchangeable, any subset is an unbiased smaller forest), and with XGBoost
+    alone when fewer than min_trees fit. When more than max_in_flight requests are being served,
+    the forest is cut to overload_trees trees (0: XGBoost only) to drain the queue. The costs
+    come from the timings of the previous batches (see CostModel). The forest is not timed while
+    it is skipped, so its cost estimate decays with cost_half_life until the forest fits again.
+
+    Parameters:
+    max_in_flight (int): Requests in flight above which the service is overloaded, 0 to disable.
+    min_trees (int): Fewest trees worth serving as a pruned forest.
+    overload_trees (int): Trees served while overloaded, 0 for XGBoost only.
+    safety (float): Factor applied to the cost estimates.
+    cost_half_life (float): Seconds after which a cost estimate not observed again is halved, 0 to keep it.
+    """
+
+    def __init__(self, max_in_flight=0, min_trees=10, overload_trees=0, safety=1.2, alpha=0.2, cost_half_life=30.0):
+        self.max_in_flight = max_in_flight
+        self.min_trees = min_trees
+        self.overload_trees = overload_trees
+        self.safety = safety
+        self.xgb_cost = CostModel(alpha, cost_half_life)
+        self.tree_cost = CostModel(alpha, cost_half_life)
+        self.stats = DegradationStats()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        Context manager counting a request in flight.
+        """
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _affordable_trees(self, n_rows, ensemble, deadline):
+        # Trees of the forest that can be evaluated before the deadline, None if unknown
+        tree_cost = self.tree_cost.estimate(n_rows)
+        if tree_cost is None:
+            return None
+        available = (deadline - time.perf_counter()) / self.safety
+        if not ensemble.concurrent:
+            # The members run one after the other
+            available -= self.xgb_cost.estimate(n_rows) or 0.0
+        return max(int(available // tree_cost), 0) if tree_cost > 0 else None
+
+    def choose(self, n_rows, ensemble, deadline=None):
+        """
+        Choose the serving path of a batch.
+
+        Parameters:
+        n_rows (int): Rows sent to the models.
+        ensemble (EnsembleEngine): Ensemble that will score the batch.
+        deadline (float, optional): time.perf_counter() value by which the predictions are due.
+
+        Returns:
+        tuple: The serving path and the number of random forest trees to evaluate (None for all of them).
+        """
+        n_estimators = ensemble.rf_n_estimators
+        n_trees = n_estimators
+        reason = None
+
+        if self.max_in_flight and self.in_flight > self.max_in_flight and self.overload_trees < n_trees:
+            n_trees = self.overload_trees
+            reason = 'in_flight'
+
+        if deadline is not None:
+            affordable = self._affordable_trees(n_rows, ensemble, deadline)
+            if affordable is not None and affordable < n_trees:
+                n_trees = affordable
+                reason = 'budget'
+
+        if n_trees >= n_estimators or ensemble.weights[1] == 0:
+            path, n_trees = FULL, None
+        elif n_trees >= self.min_trees or ensemble.weights[0] == 0:
+            # A forest-only ensemble can't fall back to XGBoost
+            path, n_trees = PRUNED, max(n_trees, min(self.min_trees, n_estimators), 1)
+        else:
+            path, n_trees = XGB_ONLY, 0
+
+        self.stats.record(path, n_rows, reason if path != FULL else None)
+        return path, n_trees
+
+    def observe(self, n_rows, timings):
+        """
+        Update the cost estimates with the member timings of a batch (see EnsembleEngine.predict).
+        """
+        if 'xgb' in timings:
+            self.xgb_cost.observe(n_rows, timings['xgb'])
+        if 'rf' in timings:
+            self.tree_cost.observe(n_rows, timings['rf'], timings['rf_trees'])
+
+    def as_dict(self):
+        result = self.stats.as_dict()
+        result.update({
+            'in_flight': self.in_flight,
+            'xgb_us_per_row': self.xgb_cost.as_dict(),
+            'rf_us_per_row_tree': self.tree_cost.as_dict(),
+        })
+        return result
@@ -0,0 +1,230 @@
+import sys
+import time
+import os
+import queue
+import logging
+import weakref
+import threading
+import numpy as np
+from concurrent.futures import Future
+from src.exception import CustomException
+from src.decoding import FEATURE_COLUMNS, columns_to_data_frame
+from src.pipelines.predict_pipeline import PredictPipeline
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (rows) of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+# Every scheduler of the process, reset in the children it forks
+_batchers = weakref.WeakSet()
+
+
+def _reset_batchers():
+    # The scheduler thread doesn't survive a fork, and the queue still lists it as a waiter
+    for batcher in list(_batchers):
+        batcher._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_batchers)
+
+
+class BatchingStats:
+    """
+    Thread-safe counters of the micro-batching scheduler: batch sizes and queue delays.
+    """
+
+    def __init__(self, buckets=BATCH_SIZE_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = list(buckets)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.batches = 0
+            self.requests = 0
+            self.rows = 0
+            self.batch_size_counts = [0] * (len(self.buckets) + 1)
+            self.queue_delay_sum = 0.0
+            self.queue_delay_max = 0.0
+
+    def record(self, n_requests, n_rows, queue_delays):
+        with self._lock:
+            self.batches += 1
+            self.requests += n_requests
+            self.rows += n_rows
+            bucket = int(np.searchsorted(self.buckets, n_rows))
+            self.batch_size_counts[bucket] += 1
+            self.queue_delay_sum += sum(queue_delays)
+            self.queue_delay_max = max(self.queue_delay_max, max(queue_delays))
+
+    def as_dict(self):
+        with self._lock:
+            labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'rows': self.rows,
+                'mean_batch_rows': self.rows / self.batches if self.batches else 0.0,
+                'mean_requests_per_batch': self.requests / self.batches if self.batches else 0.0,
+                'batch_rows_histogram': dict(zip(labels, self.batch_size_counts)),
+                'mean_queue_delay_ms': 1000 * self.queue_delay_sum / self.requests if self.requests else 0.0,
+                'max_queue_delay_ms': 1000 * self.queue_delay_max,
+            }
+
+
+class _PendingRequest:
+
+    def __init__(self, columns, n_rows, deadline=None):
+        self.columns = columns
+        self.n_rows = n_rows
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Request coalescer in front of PredictPipeline.
+
+    Concurrent requests are queued and a single scheduler thread groups them until the
+    batch reaches max_batch_size rows or the oldest request has waited max_wait seconds.
+    The batch is scored with one ensemble prediction and the results are fanned back out
+    to every request, in order.
+    """
+
+    def __init__(self, pipeline=None, max_batch_size=64, max_wait=0.002):
+        self.pipeline = pipeline if pipeline is not None else PredictPipeline()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = BatchingStats()
+        self._reset()
+        _batchers.add(self)
+
+    def _reset(self):
+        # Empty queue and no scheduler thread, it is started by the next request
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the scheduler thread.
+        """
+        with self._start_lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread once the queued requests have been served.
+        """
+        with self._start_lock:
+            if self._worker is None:
+                return
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def submit(self, features, deadline=None):
+        """
+        Queue a request to be scored in the next batch.
+
+        Parameters:
+        features (DataFrame or dict): Raw features, one row per sample.
+        deadline (float, optional): time.perf_counter() value by which the predictions are due.
+            A batch is due by the earliest deadline of its requests.
+
+        Returns:
+        Future: Resolves to the (predictions, valid, reasons, path) of PredictPipeline.predict_with_path for these rows.
+        """
+        self.start()
+        columns = {column: np.asarray(features[column]) for column in FEATURE_COLUMNS}
+        request = _PendingRequest(columns, len(columns[FEATURE_COLUMNS[0]]), deadline)
+        self._queue.put(request)
+        return request.future
+
+    def predict_with_mask(self, features):
+        """
+        Same interface as PredictPipeline.predict_with_mask, going through the batching queue.
+        """
+        return self.submit(features).result()[:3]
+
+    def predict_with_path(self, features, deadline=None):
+        """
+        Same interface as PredictPipeline.predict_with_path, going through the batching queue.
+        """
+        return self.submit(features, deadline).result()
+
+    def _collect(self, first):
+        """
+        Group queued requests with the first one until the batch is full or the wait is over.
+        """
+        batch = [first]
+        n_rows = first.n_rows
+        deadline = first.enqueued_at + self.max_wait
+
+        while n_rows < self.max_batch_size:
+            # Once the wait is over, only take the requests that are already queued
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Stop signal, serve what we have and let the loop exit afterwards
+                self._queue.put(None)
+                break
+            batch.append(request)
+            n_rows += request.n_rows
+
+        return batch, n_rows
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch, n_rows = self._collect(first)
+            started_at = time.perf_counter()
+            self.stats.record(len(batch), n_rows, [started_at - request.enqueued_at for request in batch])
+
+            try:
+                self._score(batch)
+            except Exception as e:
+                logger.exception("Micro-batch of %d requests failed", len(batch))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _score(self, batch):
+        """
+        Score the whole batch at once and split the results back per request.
+        """
+        try:
+            if len(batch) == 1:
+                columns = batch[0].columns
+            else:
+                columns = {column: np.concatenate([request.columns[column] for request in batch])
+                           for column in FEATURE_COLUMNS}
+
+            deadlines = [request.deadline for request in batch if request.deadline is not None]
+            predictions, valid, reasons, path = self.pipeline.predict_with_path(
+                columns_to_data_frame(columns), deadline=min(deadlines) if deadlines else None)
+
+            start = 0
+            for request in batch:
+                end = start + request.n_rows
+                request.future.set_result((predictions[start:end], valid[start:end], reasons[start:end], path))
+                start = end
+
+        except Exception as e:
+            raise CustomException(e, sys)
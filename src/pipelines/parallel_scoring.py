@@ -0,0 +1,169 @@
+"""
+Offline batch scoring across CPU cores, for the full catalog re-pricing.
+
+The input (CSV or NDJSON, see src/pipelines/bulk_scoring.py) is split into chunks that are
+scored by a pool of processes. Every worker loads the artifacts once, when it starts, and the
+results are merged back in input order.
+
+The output does not depend on the number of workers or on the chunk size: every row is scored
+independently, XGBoost predictions don't depend on the batch and the random forest averages its
+trees sequentially (n_jobs=1) in every process, so the sums are always done in the same order.
+`--workers 0` scores in the current process and gives the reference output.
+
+Usage:
+    python -m src.pipelines.parallel_scoring datasets/diamonds/diamonds.csv --output prices.csv --workers 8
+"""
+
+import os
+import sys
+import time
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from src.exception import CustomException
+from src.decoding import columns_to_data_frame
+from src.model_registry import model_registry
+from src.pipelines.predict_pipeline import PredictPipeline
+from src.pipelines import bulk_scoring
+
+
+# Pipeline of the current worker process, set up once by _init_worker
+_worker_pipeline = None
+
+
+def limit_threads(models, n_threads=1):
+    """
+    Restrict the threads used by the models of a snapshot, so that the workers don't oversubscribe the cores.
+    The random forest always predicts on a single thread: its trees are then summed in a fixed order.
+    The members are evaluated one after the other, every worker process already takes a core.
+    """
+    ensemble = models['ensemble']
+    ensemble.set_thread_budget(xgb_threads=n_threads, rf_threads=1)
+    ensemble.concurrent = False
+
+
+def _init_worker(threads_per_worker):
+    global _worker_pipeline
+    # Load the artifacts once per worker (nothing to load if they were already loaded before the fork)
+    limit_threads(model_registry.get(), threads_per_worker)
+    _worker_pipeline = PredictPipeline()
+
+
+def _score_chunk(columns):
+    return _worker_pipeline.predict_with_mask(columns_to_data_frame(columns))
+
+
+class ScoringReport:
+    """
+    Throughput of a scoring run.
+    """
+
+    def __init__(self, workers, chunk_size):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.chunks = 0
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'workers': self.workers,
+            'chunk_size': self.chunk_size,
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'seconds': self.elapsed,
+            'rows_per_second': self.rows_per_second,
+        }
+
+
+def score_parallel(chunks, workers=None, threads_per_worker=1, max_pending=None, report=None):
+    """
+    Score chunks in a process pool and yield their results in input order.
+
+    Parameters:
+    chunks (iterable): (columns, errors) pairs, see bulk_scoring.iter_chunks.
+    workers (int, optional): Worker processes, the number of CPUs by default. 0 scores in the current process.
+    threads_per_worker (int): XGBoost threads of every worker.
+    max_pending (int, optional): Chunks read ahead of the one being merged, 2 per worker by default.
+        It bounds the memory used by the run.
+    report (ScoringReport, optional): Updated with the rows and time of the run.
+
+    Yields:
+    list: The result records of every chunk, as bulk_scoring.chunk_records.
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    report = report if report is not None else ScoringReport(workers, None)
+
+    try:
+        start = 0
+        if workers == 0:
+            _init_worker(threads_per_worker)
+            for columns, errors in chunks:
+                records = bulk_scoring.chunk_records(start, errors, _score_chunk(columns) if columns is not None else None)
+                start += len(records)
+                report.rows, report.chunks = start, report.chunks + 1
+                yield records
+        else:
+            max_pending = max_pending or 2 * workers
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(threads_per_worker,)) as executor:
+                pending = collections.deque()
+
+                def merge_oldest():
+                    nonlocal start
+                    future, errors = pending.popleft()
+                    records = bulk_scoring.chunk_records(start, errors, future.result() if future is not None else None)
+                    start += len(records)
+                    report.rows, report.chunks = start, report.chunks + 1
+                    return records
+
+                for columns, errors in chunks:
+                    future = executor.submit(_score_chunk, columns) if columns is not None else None
+                    pending.append((future, errors))
+                    if len(pending) >= max_pending:
+                        yield merge_oldest()
+                while pending:
+                    yield merge_oldest()
+
+        report.elapsed = time.perf_counter() - report.started_at
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='CSV or NDJSON file to score')
+    parser.add_argument('--output', default='-', help="Output file (default: stdout). Written as CSV if its name ends with .csv")
+    parser.add_argument('--input-format', choices=[bulk_scoring.CSV, bulk_scoring.NDJSON], help='Format of the input (default: from its extension)')
+    parser.add_argument('--output-format', choices=[bulk_scoring.CSV, bulk_scoring.NDJSON], help='Format of the output (default: from its extension)')
+    parser.add_argument('--chunk-size', type=int, default=bulk_scoring.DEFAULT_CHUNK_SIZE, help='Rows per chunk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes, 0 to score in this process')
+    parser.add_argument('--threads-per-worker', type=int, default=1, help='XGBoost threads of every worker')
+    args = parser.parse_args(argv)
+
+    input_format = args.input_format or bulk_scoring.detect_format(args.input)
+    output_format = args.output_format or bulk_scoring.detect_format(args.output)
+    report = ScoringReport(args.workers, args.chunk_size)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        with open(args.input, 'r', encoding='utf-8') as source:
+            chunks = bulk_scoring.iter_chunks(source, input_format, args.chunk_size)
+            bulk_scoring.write_results(score_parallel(chunks, args.workers, args.threads_per_worker, report=report),
+                                       output, output_format)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"Scored {report.rows} rows in {report.elapsed:.2f}s with {args.workers} workers: "
+          f"{report.rows_per_second:.0f} rows/s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,102 @@
-import pickle
 import numpy as np
 import pandas as pd
-import xgboost as xgb
-import os
 import sys
 from src.exception import CustomException
-from src.utils import load_object
 #from src.pipelines.predict_pipeline import  PredictPipeline
 from src.utils import preprocess_data_to_predict
+from src.model_registry import get_model_registry
+from src.metrics import metrics
+from src.ensemble_engine import EnsembleEngine
+from src.pipelines.degradation import FULL
 
 
 class PredictPipeline:
 
-    def __init__(self):
-        pass
+    def __init__(self, registry=None, policy=None, variant=None):
+        # Artifacts are loaded once per process and hot reloaded by the registry.
+        # variant='lite' serves the compacted models of src/pipelines/compaction.py.
+        self.registry = registry if registry is not None else get_model_registry(variant)
+        # DegradationPolicy that may skip random forest trees to meet a deadline, None to always serve the full ensemble
+        self.policy = policy
 
-    def predict(self,features):
+    def predict_with_mask(self,features):
+        """
+        Make predictions keeping them aligned with the input rows. Outliers are not sent to the models.
+
+        Args:
+            features (DataFrame or dict): Raw features, one row per sample.
+
+        Returns:
+            predictions (ndarray): One prediction per input row, NaN for the rejected rows.
+            valid (ndarray): Boolean mask of the rows that have been scored.
+            reasons (ndarray): Rejection reason of every row, None for the valid ones.
+        """
+        ensemble_prediction, valid, reasons, _ = self.predict_with_path(features)
+        return ensemble_prediction, valid, reasons
+
+    def predict_with_path(self, features, deadline=None):
+        """
+        Same as predict_with_mask, also returning the serving path chosen by the degradation policy.
+
+        Args:
+            features (DataFrame or dict): Raw features, one row per sample.
+            deadline (float, optional): time.perf_counter() value by which the predictions are due.
+
+        Returns:
+            predictions, valid, reasons: See predict_with_mask.
+            path (str): 'full', 'pruned' (subset of the random forest trees) or 'xgb_only'.
+        """
         try: 
-            # Define the model and preprocessor paths
-            xgb_model_path = 'artifacts/XGRegressorModel_v2.pkl'
-            rf_model_path = 'artifacts/RandomForestRegressorModel.pkl'
-            preprocessor_path = 'artifacts/preprocessor_predict.pkl'
+            # Use the same snapshot for the whole request, even if a reload happens meanwhile
+            models = self.registry.get()
 
-            XGB_model = load_object(xgb_model_path)
-            RF_model = load_object(rf_model_path)
-            preprocessor = load_object(preprocessor_path)
+            # XGBoost and random forest, evaluated together without a DMatrix
+            ensemble = models.get('ensemble') or EnsembleEngine(models['xgb_model'], models['rf_model'])
+            preprocessor = models['preprocessor']
+            compiled_preprocessor = models.get('compiled_preprocessor')
 
             # Preprocess the data
-            X_preprocessed = preprocess_data_to_predict(    df  =   features,
-                                                            preprocessor =  preprocessor,
-                                                            numeric_features = ['volume', 'carat', 'depth', 'table'],
-                                                            categorical_features = ['color', 'cut', 'clarity']
-                                                        )
-            DX = xgb.DMatrix(X_preprocessed)
-        
-            # Make predictions
-            xgb_predictions = XGB_model.predict(DX)
-            rf_predictions = RF_model.predict(X_preprocessed)
-        
-            # Combine predictions (you can choose a different strategy)
-            ensemble_prediction = (xgb_predictions + rf_predictions) / 2.0
-            
-            return ensemble_prediction
+            if compiled_preprocessor is not None:
+                # Fused NumPy path straight from the raw feature arrays
+                with metrics.stage('predict', 'preprocess'):
+                    X_preprocessed, valid, reasons = compiled_preprocessor.transform(features, return_mask=True)
+                missing = compiled_preprocessor.missing
+            else:
+                X_preprocessed, valid, reasons = preprocess_data_to_predict(    df  =   features,
+                                                                                preprocessor =  preprocessor,
+                                                                                numeric_features = ['volume', 'carat', 'depth', 'table'],
+                                                                                categorical_features = ['color', 'cut', 'clarity'],
+                                                                                return_mask = True
+                                                                            )
+                missing = np.nan
+
+            ensemble_prediction = np.full(len(valid), np.nan)
+            metrics.observe_batch('predict', len(valid))
+
+            # Only the valid rows go through the models
+            path = FULL
+            if valid.any():
+                if self.policy is None:
+                    ensemble_prediction[valid] = ensemble.predict(X_preprocessed, missing=missing)
+                else:
+                    n_rows = X_preprocessed.shape[0]
+                    path, n_trees = self.policy.choose(n_rows, ensemble, deadline)
+                    timings = {}
+                    ensemble_prediction[valid] = ensemble.predict(X_preprocessed, missing=missing,
+                                                                  n_trees=n_trees, timings=timings)
+                    self.policy.observe(n_rows, timings)
+
+            return ensemble_prediction, valid, reasons, path
     
         except Exception as e:
             raise CustomException(e,sys)
+
+    def predict(self,features):
+        """
+        Make predictions for the rows that are not outliers.
+        """
+        ensemble_prediction, valid, _ = self.predict_with_mask(features)
+        return ensemble_prediction[valid]
         
 
 
@@ -0,0 +1,239 @@
+import sys
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from src.exception import CustomException
+from src.decoding import FEATURE_COLUMNS, NUMERIC_FEATURES, columns_to_data_frame
+from src.model_registry import model_registry
+from src.pipelines.degradation import FULL
+
+
+def canonical_keys(features):
+    """
+    Build the cache key of every row: the (carat, cut, color, clarity, depth, table, x, y, z) tuple
+    with float numerics and string categories.
+
+    Parameters:
+    features (DataFrame or dict): Raw features, one row per sample.
+
+    Returns:
+    list: One key per row, None for the rows that cannot be cached (missing or non-string values).
+    """
+    columns = []
+    cacheable = None
+    for column in FEATURE_COLUMNS:
+        if column in NUMERIC_FEATURES:
+            values = np.asarray(features[column], dtype=np.float64)
+            # NaN never compares equal, so it can't be part of a key
+            ok = ~np.isnan(values)
+        else:
+            values = np.asarray(features[column], dtype=object)
+            ok = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+        cacheable = ok if cacheable is None else cacheable & ok
+        columns.append(values.tolist())
+
+    return [key if ok else None for key, ok in zip(zip(*columns), cacheable.tolist())]
+
+
+class CacheStats:
+    """
+    Thread-safe counters of the prediction cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+
+    def record(self, hits=0, misses=0, evictions=0, expirations=0, invalidations=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+            self.expirations += expirations
+            self.invalidations += invalidations
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of row predictions with a time to live.
+
+    Entries are keyed on the canonical feature tuple (see canonical_keys) and belong to the
+    model version that computed them: when the registry serves a new version (e.g. after a
+    /train update) the whole cache is dropped on the next lookup. The rejection of outliers is
+    deterministic too, so rejected rows are cached with their reason.
+    """
+
+    def __init__(self, max_entries=100000, ttl=3600.0, registry=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.registry = registry if registry is not None else model_registry
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._model_key = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_key(snapshot):
+        """
+        Identity of the models of a snapshot: the published version, or the legacy file signature.
+        """
+        return snapshot.version if snapshot.version is not None else snapshot.signature
+
+    def _check_model(self, model_key):
+        # Called with the lock held. Entries of another model version are all dropped.
+        if model_key != self._model_key:
+            if self._entries:
+                self.stats.record(invalidations=1)
+                self._entries.clear()
+            self._model_key = model_key
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_many(self, keys, model_key):
+        """
+        Look up several rows at once.
+
+        Parameters:
+        keys (list): Row keys, None for the rows that are not cacheable.
+        model_key: Identity of the models the predictions must come from.
+
+        Returns:
+        list: The cached (prediction, valid, reason) of every row, None for the misses.
+        """
+        results = [None] * len(keys)
+        if model_key is None:
+            self.stats.record(misses=len(keys))
+            return results
+
+        now = time.monotonic()
+        hits = expirations = 0
+        with self._lock:
+            self._check_model(model_key)
+            for i, key in enumerate(keys):
+                if key is None:
+                    continue
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._entries[key]
+                    expirations += 1
+                    continue
+                self._entries.move_to_end(key)
+                results[i] = entry[1]
+                hits += 1
+
+        self.stats.record(hits=hits, misses=len(keys) - hits, expirations=expirations)
+        return results
+
+    def put_many(self, keys, values, model_key):
+        """
+        Store the results of several rows computed with the models identified by model_key.
+        """
+        if model_key is None:
+            return
+
+        expires_at = time.monotonic() + self.ttl
+        evictions = 0
+        with self._lock:
+            # Results of a snapshot that has been replaced meanwhile are not worth keeping
+            if model_key != self._model_key and self._model_key is not None:
+                return
+            self._model_key = model_key
+            for key, value in zip(keys, values):
+                if key is None:
+                    continue
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evictions += 1
+
+        if evictions:
+            self.stats.record(evictions=evictions)
+
+    def as_dict(self):
+        result = self.stats.as_dict()
+        result.update({'size': len(self._entries), 'max_entries': self.max_entries, 'ttl_s': self.ttl})
+        return result
+
+    def predict_with_mask(self, features, pipeline):
+        """
+        Same interface as PredictPipeline.predict_with_mask: the cached rows are answered
+        directly and only the misses are sent to the pipeline, in a single call.
+
+        Parameters:
+        features (DataFrame or dict): Raw features, one row per sample.
+        pipeline: Object with a predict_with_path method (PredictPipeline or MicroBatcher).
+        """
+        return self.predict_with_path(features, pipeline)[:3]
+
+    def predict_with_path(self, features, pipeline, deadline=None):
+        """
+        Same interface as PredictPipeline.predict_with_path. Only the predictions of the full
+        ensemble are cached, a degraded one is not served again once the load is gone.
+        The path is 'full' when every row comes from the cache.
+        """
+        try:
+            n_rows = len(features[FEATURE_COLUMNS[0]])
+            model_key = self.model_key(self.registry.get())
+            keys = canonical_keys(features)
+            cached = self.get_many(keys, model_key)
+
+            predictions = np.full(n_rows, np.nan)
+            valid = np.zeros(n_rows, dtype=bool)
+            reasons = np.full(n_rows, None, dtype=object)
+
+            path = FULL
+            misses = [i for i, result in enumerate(cached) if result is None]
+            for i, result in enumerate(cached):
+                if result is not None:
+                    predictions[i], valid[i], reasons[i] = result
+
+            if misses:
+                if len(misses) == n_rows:
+                    miss_features = features
+                else:
+                    miss_features = columns_to_data_frame(
+                        {column: np.asarray(features[column])[misses] for column in FEATURE_COLUMNS})
+                miss_predictions, miss_valid, miss_reasons, path = pipeline.predict_with_path(miss_features,
+                                                                                             deadline=deadline)
+
+                predictions[misses] = miss_predictions
+                valid[misses] = miss_valid
+                reasons[misses] = miss_reasons
+                if path == FULL:
+                    self.put_many([keys[i] for i in misses],
+                                  list(zip(miss_predictions.tolist(), miss_valid.tolist(), miss_reasons.tolist())),
+                                  model_key)
+
+            return predictions, valid, reasons, path
+
+        except Exception as e:
+            raise CustomException(e, sys)
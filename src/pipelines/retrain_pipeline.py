@@ -0,0 +1,392 @@
+"""
+Full retraining of the ensemble on data that does not fit in memory.
+
+The training CSV files (same columns as datasets/diamonds/diamonds_clean.csv) are read in
+chunks of chunk_rows rows and every chunk goes through preprocess_data_to_train:
+
+- XGBoost is trained from an external memory DMatrix fed by a data iterator, its pages are
+  cached on disk under cache_dir.
+- Every random forest tree is fitted on a bounded subsample (at most rf_samples_per_tree rows)
+  drawn by reservoir sampling while streaming the data. As many trees as fit in max_memory_mb
+  are sampled per pass over the data.
+
+A fixed fraction of every chunk is held out to report the RMSE of both models and of the
+ensemble. The models are then published as a new version of the model store, in the pickled
+and native formats, next to the current preprocessor.
+
+Usage:
+    python -m src.pipelines.retrain_pipeline datasets/diamonds/diamonds_clean.csv --max-memory-mb 512
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.tree import DecisionTreeRegressor
+from sklearn.ensemble import RandomForestRegressor
+from src.exception import CustomException
+from src.logger import add_console_handler
+from src.utils import load_object, preprocess_data_to_train, FeatureMatrixCache
+from src.model_registry import model_registry, model_store
+from src.artifact_format import native_file_name, save_artifact
+
+
+logger = logging.getLogger(__name__)
+
+XGB_MODEL_FILE = 'XGRegressorModel_v2.pkl'
+RF_MODEL_FILE = 'RandomForestRegressorModel.pkl'
+
+# Used when there is no served model to take the hyperparameters from
+DEFAULT_XGB_PARAMS = {'objective': 'reg:squarederror', 'eta': 0.1, 'max_depth': 6}
+DEFAULT_NUM_BOOST_ROUND = 200
+DEFAULT_RF_PARAMS = {'n_estimators': 100, 'max_depth': None, 'min_samples_split': 2, 'min_samples_leaf': 1,
+                     'max_features': 1.0, 'bootstrap': True, 'random_state': 42}
+
+# Booster parameters carried over from the served model
+_XGB_PARAM_NAMES = ['eta', 'max_depth', 'min_child_weight', 'subsample', 'colsample_bytree',
+                    'colsample_bylevel', 'colsample_bynode', 'lambda', 'alpha', 'gamma', 'max_bin']
+
+
+class TrainingChunks:
+    """
+    Re-iterable stream of preprocessed training chunks read from CSV files.
+
+    Every row is assigned to the training or the validation part with a random generator seeded
+    by the chunk number, so all the passes over the data see the same split.
+    """
+
+    def __init__(self, paths, preprocessor, chunk_rows=50000, validation_fraction=0.1, seed=42, feature_cache=None):
+        self.paths = list(paths)
+        # Optional FeatureMatrixCache: the passes over the data read the preprocessed chunks from it
+        self.feature_cache = feature_cache
+        self.preprocessor = preprocessor
+        self.chunk_rows = chunk_rows
+        self.validation_fraction = validation_fraction
+        self.seed = seed
+
+    def __iter__(self):
+        """
+        Yields:
+        tuple: (X_train, y_train, X_valid, y_valid) of every chunk, X as returned by the preprocessor.
+        """
+        chunk_number = 0
+        for path in self.paths:
+            for chunk in pd.read_csv(path, chunksize=self.chunk_rows):
+                preprocess = self.feature_cache.preprocess if self.feature_cache is not None else preprocess_data_to_train
+                X, y = preprocess(                  df  =   chunk,
+                                                    preprocessor =  self.preprocessor,
+                                                    numeric_features = ['volume', 'carat', 'depth', 'table'],
+                                                    categorical_features = ['color', 'cut', 'clarity'],
+                                                    target = 'price'
+                                                    )
+                y = np.asarray(y, dtype=np.float64)
+                rng = np.random.default_rng([self.seed, chunk_number])
+                valid = rng.random(X.shape[0]) < self.validation_fraction
+                chunk_number += 1
+                yield X[~valid], y[~valid], X[valid], y[valid]
+
+
+class _ChunkIterator(xgb.DataIter):
+    """
+    XGBoost data iterator over one part (training or validation) of the chunks.
+    """
+
+    def __init__(self, chunks, part, cache_prefix):
+        self.chunks = chunks
+        self.part = part
+        self._iterator = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._iterator is None:
+            self._iterator = iter(self.chunks)
+        for X_train, y_train, X_valid, y_valid in self._iterator:
+            X, y = (X_train, y_train) if self.part == 'train' else (X_valid, y_valid)
+            if X.shape[0] > 0:
+                input_data(data=X, label=y)
+                return True
+        return False
+
+    def reset(self):
+        self._iterator = None
+
+
+class _Reservoir:
+    """
+    Uniform sample without replacement of at most `size` rows of a stream (reservoir sampling).
+    """
+
+    def __init__(self, size, n_features, rng):
+        self.X = np.empty((size, n_features), dtype=np.float32)
+        self.y = np.empty(size, dtype=np.float64)
+        self.size = size
+        self.seen = 0
+        self.rng = rng
+
+    def add(self, X, y):
+        index = self.seen + np.arange(X.shape[0])
+        self.seen += X.shape[0]
+
+        # Fill the reservoir first, then replace a random row with a decreasing probability
+        fill = index < self.size
+        self.X[index[fill]] = X[fill]
+        self.y[index[fill]] = y[fill]
+
+        rest = np.flatnonzero(~fill)
+        if len(rest) > 0:
+            slots = self.rng.integers(0, index[rest] + 1)
+            keep = slots < self.size
+            self.X[slots[keep]] = X[rest[keep]]
+            self.y[slots[keep]] = y[rest[keep]]
+
+    def sample(self):
+        n_rows = min(self.seen, self.size)
+        return self.X[:n_rows], self.y[:n_rows]
+
+
+def _to_dense(X):
+    return np.asarray(X.toarray() if hasattr(X, 'toarray') else X, dtype=np.float32)
+
+
+class RetrainPipeline:
+    """
+    Retrain the XGBoost and random forest models from scratch with a bounded memory footprint.
+
+    Parameters:
+    chunk_rows (int): Rows read and preprocessed at a time.
+    max_memory_mb (float): Memory available for the random forest samples. It sets how many trees are
+        sampled per pass over the data (at least one).
+    rf_samples_per_tree (int): Maximum rows every random forest tree is fitted on.
+    xgb_params (dict, optional): Booster parameters, those of the served booster by default.
+    num_boost_round (int, optional): Boosting rounds, those of the served booster by default.
+    rf_params (dict, optional): RandomForestRegressor parameters, those of the served forest by default.
+    cache_dir (str, optional): Directory of the XGBoost external memory pages, a temporary one by default.
+    validation_fraction (float): Fraction of the rows held out to evaluate the models.
+    feature_cache (FeatureMatrixCache, optional): On-disk cache of the preprocessed rows, so the passes over the
+        data (and the next retrainings) only preprocess the new rows.
+    """
+
+    def __init__(self, chunk_rows=50000, max_memory_mb=512, rf_samples_per_tree=100000, xgb_params=None,
+                 num_boost_round=None, rf_params=None, cache_dir=None, validation_fraction=0.1, seed=42,
+                 feature_cache=None):
+        self.chunk_rows = chunk_rows
+        self.max_memory_mb = max_memory_mb
+        self.rf_samples_per_tree = rf_samples_per_tree
+        self.xgb_params = xgb_params
+        self.num_boost_round = num_boost_round
+        self.rf_params = rf_params
+        self.cache_dir = cache_dir
+        self.validation_fraction = validation_fraction
+        self.seed = seed
+        self.feature_cache = feature_cache
+
+    def _default_params(self):
+        """
+        Hyperparameters of the served models, used for the ones that were not given.
+        """
+        xgb_params, num_boost_round, rf_params = dict(DEFAULT_XGB_PARAMS), DEFAULT_NUM_BOOST_ROUND, dict(DEFAULT_RF_PARAMS)
+        try:
+            snapshot = model_registry.get()
+            booster = snapshot['xgb_model']
+            config = json.loads(booster.save_config())
+            tree_params = config['learner']['gradient_booster'].get('tree_train_param', {})
+            xgb_params.update({name: float(tree_params[name]) for name in _XGB_PARAM_NAMES if name in tree_params})
+            xgb_params['max_depth'] = int(xgb_params['max_depth'])
+            if 'max_bin' in xgb_params:
+                xgb_params['max_bin'] = int(xgb_params['max_bin'])
+            num_boost_round = booster.num_boosted_rounds()
+
+            forest = snapshot['rf_model']
+            if hasattr(forest, 'get_params'):
+                rf_params.update({name: value for name, value in forest.get_params().items() if name in rf_params})
+            else:
+                rf_params['n_estimators'] = forest.n_estimators
+        except Exception as e:
+            logger.warning("Could not read the parameters of the served models, using the defaults: %s", e)
+
+        xgb_params = self.xgb_params or xgb_params
+        # External memory needs the histogram tree method
+        xgb_params = dict(xgb_params, tree_method='hist', eval_metric='rmse')
+        return xgb_params, self.num_boost_round or num_boost_round, self.rf_params or rf_params
+
+    def train_xgb(self, chunks, params, num_boost_round, cache_dir):
+        """
+        Train the booster from external memory DMatrices built chunk by chunk.
+        """
+        dtrain = xgb.DMatrix(_ChunkIterator(chunks, 'train', os.path.join(cache_dir, 'train')))
+        dvalid = xgb.DMatrix(_ChunkIterator(chunks, 'valid', os.path.join(cache_dir, 'valid')))
+        evals = [(dvalid, 'valid')] if dvalid.num_row() > 0 else []
+        return xgb.train(params, dtrain, num_boost_round=num_boost_round, evals=evals, verbose_eval=False)
+
+    def trees_per_pass(self, n_features):
+        """
+        Number of random forest trees whose samples fit in max_memory_mb at once.
+        """
+        bytes_per_tree = self.rf_samples_per_tree * (n_features * 4 + 8)
+        return max(1, int(self.max_memory_mb * 2**20 // bytes_per_tree))
+
+    def train_rf(self, chunks, params, n_features):
+        """
+        Fit every tree on its own bounded sample of the training rows and assemble the forest.
+        """
+        params = dict(params)
+        n_estimators = params.pop('n_estimators')
+        bootstrap = params.pop('bootstrap', True)
+        random_state = params.pop('random_state', None)
+        rng = np.random.default_rng(random_state if random_state is not None else self.seed)
+        tree_params = {name: value for name, value in params.items()
+                       if name in DecisionTreeRegressor().get_params()}
+
+        group_size = self.trees_per_pass(n_features)
+        logger.info("Random forest: %d trees, %d per pass over the data", n_estimators, group_size)
+
+        trees = []
+        for first in range(0, n_estimators, group_size):
+            reservoirs = [_Reservoir(self.rf_samples_per_tree, n_features, np.random.default_rng(rng.integers(2**32)))
+                          for _ in range(min(group_size, n_estimators - first))]
+            for X_train, y_train, _, _ in chunks:
+                if X_train.shape[0] == 0:
+                    continue
+                X_train = _to_dense(X_train)
+                for reservoir in reservoirs:
+                    reservoir.add(X_train, y_train)
+
+            for reservoir in reservoirs:
+                X, y = reservoir.sample()
+                # Same bootstrap as RandomForestRegressor: draw the rows with replacement as sample weights
+                weights = np.bincount(reservoir.rng.integers(0, len(y), len(y)), minlength=len(y)) if bootstrap else None
+                tree = DecisionTreeRegressor(**tree_params, random_state=int(reservoir.rng.integers(2**31)))
+                trees.append(tree.fit(X, y, sample_weight=weights))
+
+        forest = RandomForestRegressor(n_estimators=n_estimators, bootstrap=bootstrap, random_state=random_state, **params)
+        forest.estimator_ = DecisionTreeRegressor(**tree_params)
+        forest.estimators_ = trees
+        forest.n_features_in_ = n_features
+        forest.n_outputs_ = 1
+        return forest
+
+    @staticmethod
+    def evaluate(chunks, booster, forest):
+        """
+        RMSE of both models and of the ensemble on the held out rows, computed chunk by chunk.
+        """
+        squared_errors = {'xgb_rmse': 0.0, 'rf_rmse': 0.0, 'ensemble_rmse': 0.0}
+        n_rows = 0
+        for _, _, X_valid, y_valid in chunks:
+            if X_valid.shape[0] == 0:
+                continue
+            xgb_predictions = booster.predict(xgb.DMatrix(X_valid))
+            rf_predictions = forest.predict(X_valid)
+            for name, predictions in (('xgb_rmse', xgb_predictions), ('rf_rmse', rf_predictions),
+                                      ('ensemble_rmse', (xgb_predictions + rf_predictions) / 2.0)):
+                squared_errors[name] += float(np.sum((predictions - y_valid) ** 2))
+            n_rows += X_valid.shape[0]
+
+        metrics = {name: float(np.sqrt(total / n_rows)) if n_rows else None for name, total in squared_errors.items()}
+        metrics['n_validation_samples'] = n_rows
+        return metrics
+
+    def run(self, paths, publish=True, make_current=True):
+        """
+        Retrain both models on the CSV files and publish them as a new model version.
+
+        Returns:
+        dict: The new version (None if not published), the sample counts and the validation metrics.
+        """
+        try:
+            started_at = time.perf_counter()
+            preprocessor = load_object(model_store.resolve('preprocessor.pkl'))
+            chunks = TrainingChunks(paths, preprocessor, self.chunk_rows, self.validation_fraction, self.seed,
+                                    feature_cache=self.feature_cache)
+            xgb_params, num_boost_round, rf_params = self._default_params()
+
+            cache_dir = self.cache_dir or tempfile.mkdtemp(prefix='xtream-retrain-')
+            os.makedirs(cache_dir, exist_ok=True)
+            try:
+                logger.info("Training XGBoost: %d rounds, %s", num_boost_round, xgb_params)
+                booster = self.train_xgb(chunks, xgb_params, num_boost_round, cache_dir)
+            finally:
+                if self.cache_dir is None:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+
+            n_features = booster.num_features()
+            logger.info("Training the random forest: %s", rf_params)
+            forest = self.train_rf(chunks, rf_params, n_features)
+
+            metrics = self.evaluate(chunks, booster, forest)
+            logger.info("Validation metrics: %s", metrics)
+
+            version = None
+            if publish:
+                # The preprocessor is not retrained, the current one is carried over with the other artifacts
+                version = model_store.publish(
+                    {
+                        XGB_MODEL_FILE: booster, native_file_name(XGB_MODEL_FILE): booster,
+                        RF_MODEL_FILE: forest, native_file_name(RF_MODEL_FILE): forest,
+                    },
+                    make_current=make_current,
+                    save=save_artifact,
+                )
+                logger.info("Retrained models published as version %s", version)
+                if make_current:
+                    model_registry.refresh()
+
+            metrics.update({
+                'model_version': version,
+                'seconds': time.perf_counter() - started_at,
+            })
+            return metrics
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='Training CSV files')
+    parser.add_argument('--chunk-rows', type=int, default=50000, help='Rows read and preprocessed at a time')
+    parser.add_argument('--max-memory-mb', type=float, default=512, help='Memory for the random forest samples')
+    parser.add_argument('--rf-samples-per-tree', type=int, default=100000, help='Maximum rows per random forest tree')
+    parser.add_argument('--num-boost-round', type=int, help='Boosting rounds (default: those of the served booster)')
+    parser.add_argument('--n-estimators', type=int, help='Random forest trees (default: those of the served forest)')
+    parser.add_argument('--params-file', help='Best configurations written by src/pipelines/tuning.py')
+    parser.add_argument('--cache-dir', help='Directory of the XGBoost external memory cache (default: temporary)')
+    parser.add_argument('--feature-cache', nargs='?', const='artifacts/feature_cache',
+                        help='Cache the preprocessed rows on disk (default directory: artifacts/feature_cache)')
+    parser.add_argument('--no-publish', action='store_true', help='Train and evaluate without publishing the models')
+    parser.add_argument('--no-promote', action='store_true', help='Publish the models without serving them')
+    args = parser.parse_args(argv)
+
+    # Report the progress on the console too
+    add_console_handler(logger)
+
+    # The feature cache keeps every row of the data, the next runs read them all back
+    pipeline = RetrainPipeline(chunk_rows=args.chunk_rows, max_memory_mb=args.max_memory_mb,
+                               rf_samples_per_tree=args.rf_samples_per_tree, num_boost_round=args.num_boost_round,
+                               cache_dir=args.cache_dir,
+                               feature_cache=FeatureMatrixCache(args.feature_cache, max_rows=None) if args.feature_cache else None)
+    if args.params_file:
+        with open(args.params_file) as file_obj:
+            tuned = json.load(file_obj)
+        _, _, rf_params = pipeline._default_params()
+        if 'xgb' in tuned:
+            pipeline.xgb_params = dict(DEFAULT_XGB_PARAMS, **tuned['xgb']['params'])
+            pipeline.num_boost_round = pipeline.num_boost_round or tuned['xgb']['extra']['num_boost_round']
+        if 'rf' in tuned:
+            pipeline.rf_params = dict(rf_params, **tuned['rf']['params'], **tuned['rf']['extra'])
+    if args.n_estimators:
+        _, _, rf_params = pipeline._default_params()
+        pipeline.rf_params = dict(rf_params, n_estimators=args.n_estimators)
+
+    print(json.dumps(pipeline.run(args.paths, publish=not args.no_publish, make_current=not args.no_promote), indent=2))
+
+
+if __name__ == '__main__':
+    main()
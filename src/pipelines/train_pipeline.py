@@ -4,86 +4,347 @@ import pandas as pd
 import xgboost as xgb
 import os
 import sys
-import logging
+import time
+import threading
+from contextlib import contextmanager
 from src.exception import CustomException
-from src.utils import load_object, save_object
+from src.logger import get_logger
+from src.metrics import metrics
+from src.utils import load_object, save_object, FeatureMatrixCache
 #from src.pipelines.predict_pipeline import  PredictPipeline
 from src.utils import preprocess_data_to_train
+from src.model_registry import model_registry, model_store
+from src.artifact_format import native_file_name, save_artifact
+from src.decoding import TRAIN_COLUMNS, TRAIN_NUMERIC_FEATURES
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on Windows
+    fcntl = None
 
 
-# Initialize the logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
-# Set up the file handler
-log_dir = 'log'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-handler = logging.FileHandler(filename=os.path.join(log_dir, 'TrainPipeline.log'), mode='a')
-handler.setLevel(logging.INFO)
+# The evaluations of the training updates have a log file of their own
+logger = get_logger(__name__, 'TrainPipeline.log')
 
-# Set up the formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
 
-# Add the handler to the logger
-logger.addHandler(handler)
+def check_training_samples(features):
+    """
+    Raise a ValueError if some samples can't be trained on: a missing feature or target, or a
+    numeric value that is not finite. One such sample would make every update of the buffer fail.
+    """
+    missing = [column for column in TRAIN_COLUMNS if column not in features.columns]
+    if missing:
+        raise ValueError(f"The '{missing[0]}' feature is missing from the input data.")
+
+    for column in TRAIN_COLUMNS:
+        values = features[column]
+        if column in TRAIN_NUMERIC_FEATURES:
+            invalid = ~np.isfinite(pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64))
+        else:
+            invalid = values.isna().to_numpy()
+        if invalid.any():
+            rows = np.flatnonzero(invalid)
+            raise ValueError(f"The '{column}' feature is missing or invalid in {len(rows)} samples "
+                             f"(first one at index {rows[0]}).")
+
+
+class FreshDataBuffer:
+    """
+    Local CSV buffer of the fresh training samples (same columns as datasets/diamonds/fresh_data.csv,
+    plus the time each sample was received). Samples are accumulated until there are enough of
+    them to train new boosting rounds.
+
+    The samples of a failed update are moved to a '.rejected.csv' file next to the buffer, so a
+    bad batch is never trained on again.
+    """
+
+    def __init__(self, path='artifacts/fresh_data_buffer.csv'):
+        self.path = path
+        self.rejected_path = os.path.splitext(path)[0] + '.rejected.csv'
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive access to the buffer, across the threads and the processes that share it.
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            dir_path = os.path.dirname(self.path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, features):
+        """
+        Add samples to the buffer.
+        """
+        dir_path = os.path.dirname(self.path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        rows = features.copy()
+        rows['received_at'] = time.time()
+        rows.to_csv(self.path, mode='a', header=not os.path.exists(self.path), index=False)
+
+    def read(self):
+        """
+        Return the buffered samples, without the reception time.
+        """
+        if not os.path.exists(self.path):
+            return pd.DataFrame()
+        return pd.read_csv(self.path).drop(columns='received_at')
+
+    def stats(self):
+        """
+        Return the number of buffered samples and the age in seconds of the oldest one (None if empty).
+        """
+        if not os.path.exists(self.path):
+            return 0, None
+        received_at = pd.read_csv(self.path, usecols=['received_at'])['received_at']
+        if received_at.empty:
+            return 0, None
+        return len(received_at), time.time() - received_at.min()
+
+    def drop(self, n_rows, rejected=False):
+        """
+        Remove the n_rows oldest samples, the ones returned by the last read. Samples appended
+        since then are kept. With rejected=True they are moved to the rejected samples file.
+        """
+        if not os.path.exists(self.path):
+            return
+        rows = pd.read_csv(self.path)
+        if rejected and n_rows > 0:
+            rows.iloc[:n_rows].to_csv(self.rejected_path, mode='a', header=not os.path.exists(self.rejected_path),
+                                      index=False)
+
+        kept = rows.iloc[n_rows:]
+        if kept.empty:
+            os.remove(self.path)
+        else:
+            temp_path = self.path + '.tmp'
+            kept.to_csv(temp_path, index=False)
+            os.replace(temp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 
 class TrainPipeline:
+    """
+    Continual training of the XGBoost model.
+
+    Fresh samples are accumulated in a FreshDataBuffer. Once it holds min_rows samples, or
+    its oldest sample is max_age seconds old, n_rounds new boosting rounds are appended to the
+    served booster on the buffered samples. The updated booster is scored on a fixed holdout
+    drawn from diamonds_clean.csv and it is only published if its RMSE does not regress.
+    """
+
+    def __init__(self, buffer=None, min_rows=100, max_age=3600.0, n_rounds=10,
+                 holdout_path='datasets/diamonds/diamonds_clean.csv', holdout_size=1000,
+                 max_rmse_increase=0.0, params=None, feature_cache=None):
+        self.buffer = buffer if buffer is not None else FreshDataBuffer()
+        # Preprocessed rows are cached on disk, so the holdout and re-sent samples are only transformed once
+        self.feature_cache = feature_cache if feature_cache is not None else FeatureMatrixCache()
+        self.min_rows = min_rows
+        self.max_age = max_age
+        self.n_rounds = n_rounds
+        self.holdout_path = holdout_path
+        self.holdout_size = holdout_size
+        self.max_rmse_increase = max_rmse_increase
+        self.params = params or {
+            'objective': 'reg:squarederror',
+            'eval_metric': 'rmse',
+            'eta': 0.1,
+        }
+        self._preprocessor = None
+        self._holdout = None
 
-    def __init__(self):
-        pass
+    def _load_preprocessor(self):
+        """
+        Training preprocessor and holdout, loaded once per pipeline (the preprocessor is never retrained).
+        """
+        if self._preprocessor is None:
+            self._preprocessor = load_object(model_store.resolve('preprocessor.pkl'))
+
+        if self._holdout is None:
+            holdout = pd.read_csv(self.holdout_path)
+            holdout = holdout.sample(n=min(self.holdout_size, holdout.shape[0]), random_state=42)
+            X_holdout, y_holdout = self.feature_cache.preprocess(  df  =   holdout,
+                                                                preprocessor =  self._preprocessor,
+                                                                numeric_features = ['volume', 'carat', 'depth', 'table'],
+                                                                categorical_features = ['color', 'cut', 'clarity'],
+                                                                target = 'price'
+                                                                )
+            self._holdout = xgb.DMatrix(X_holdout, label=y_holdout)
+
+        return self._preprocessor, self._holdout
+
+    def is_due(self):
+        """
+        Check whether the buffered samples reached the row or the age threshold.
+        """
+        n_rows, age = self.buffer.stats()
+        return n_rows > 0 and (n_rows >= self.min_rows or age >= self.max_age)
 
     def train(self,features):
+        """
+        Buffer the fresh samples and update the model if the buffer reached a threshold.
+        Invalid samples (see check_training_samples) are refused before they reach the buffer.
+
+        Returns:
+        dict: The buffer state and, if an update was attempted, its metrics and whether it was promoted.
+        """
         try:    
             logger.info("Training pipeline started")
+            check_training_samples(features)
+
+            # One training at a time: concurrent requests would publish from the same base version
+            with self.buffer.lock():
+                with metrics.stage('train', 'buffer'):
+                    self.buffer.append(features)
+                    n_rows, _ = self.buffer.stats()
+                logger.info("%d samples buffered, %d in the buffer", features.shape[0], n_rows)
 
-            # Define the model and preprocessor paths
-            xgb_model_path = 'artifacts/XGRegressorModel_v2.pkl'
-            preprocessor_path = 'artifacts/preprocessor.pkl'
+                if not self.is_due():
+                    return {
+                        'model_version': model_registry.get().version,
+                        'n_samples': int(features.shape[0]),
+                        'buffered_samples': int(n_rows),
+                        'updated': False,
+                    }
 
-            XGB_model = load_object(xgb_model_path)
-            preprocessor = load_object(preprocessor_path)
+                result = self._update()
+            result['n_samples'] = int(features.shape[0])
+            return result
+    
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def update(self):
+        """
+        Append new boosting rounds on the buffered samples and publish the model if it passes the holdout check.
+        The samples are removed from the buffer in both cases, and moved to the rejected samples if the update fails.
+        """
+        with self.buffer.lock():
+            return self._update()
+
+    def _update(self):
+        # Called with the buffer lock held
+        with metrics.stage('train', 'read_buffer'):
+            features = self.buffer.read()
+        if features.empty:
+            return {'model_version': model_registry.get().version, 'buffered_samples': 0, 'updated': False}
+
+        try:
+            result = self._train_update(features)
+        except Exception:
+            logger.exception("Update failed, its %d samples are moved to %s", features.shape[0],
+                             self.buffer.rejected_path)
+            self.buffer.drop(features.shape[0], rejected=True)
+            raise
+        self.buffer.drop(features.shape[0])
+        logger.info('Pipeline execution completed')
+        return result
+
+    def _train_update(self, features):
+        """
+        Train, evaluate and publish an update on the given samples.
+        """
+        try:
+
+            # Start from the booster being served, no need to load it from disk
+            snapshot = model_registry.get()
+            XGB_model = snapshot['xgb_model']
+            with metrics.stage('train', 'load_holdout'):
+                preprocessor, dholdout = self._load_preprocessor()
 
             # Preprocess the data
-            X_new_preprocessed, y_new  = preprocess_data_to_train(      df  =   features,
-                                                                        preprocessor =  preprocessor,
-                                                                        numeric_features = ['volume', 'carat', 'depth', 'table'],
-                                                                        categorical_features = ['color', 'cut', 'clarity'],
-                                                                        target = 'price'
-                                                                        )
-            dnew = xgb.DMatrix(X_new_preprocessed, label=y_new)
-            params = {
-                'objective': 'reg:squarederror',
-                'eval_metric': 'rmse',
-                'eta': 0.1,
-            }
-            params['nrounds'] = 0
-            updated_model = xgb.train(params, dnew, xgb_model=XGB_model, num_boost_round=0)
+            with metrics.stage('train', 'preprocess'):
+                X_new_preprocessed, y_new  = self.feature_cache.preprocess(  df  =   features,
+                                                                            preprocessor =  preprocessor,
+                                                                            numeric_features = ['volume', 'carat', 'depth', 'table'],
+                                                                            categorical_features = ['color', 'cut', 'clarity'],
+                                                                            target = 'price'
+                                                                            )
+            with metrics.stage('train', 'dmatrix'):
+                dnew = xgb.DMatrix(X_new_preprocessed, label=y_new)
+            metrics.observe_batch('train', X_new_preprocessed.shape[0])
+
+            # Append new trees on top of the current ones
+            with metrics.stage('train', 'xgb_train'):
+                updated_model = xgb.train(self.params, dnew, xgb_model=XGB_model, num_boost_round=self.n_rounds)
             
             # Evaluate the performance of the updated model
             logger.info("Evaluating model performance")
-            xgb_predictions = updated_model.predict(dnew)
-            xgb_rmse = mean_squared_error(y_new, xgb_predictions, squared=False)
-            xgb_r2 = r2_score(y_new, xgb_predictions)
+            with metrics.stage('train', 'evaluate'):
+                xgb_predictions = updated_model.predict(dnew)
+                xgb_rmse = mean_squared_error(y_new, xgb_predictions, squared=False)
+                xgb_r2 = r2_score(y_new, xgb_predictions)
+
+                holdout_rmse_before = mean_squared_error(dholdout.get_label(), XGB_model.predict(dholdout), squared=False)
+                holdout_rmse_after = mean_squared_error(dholdout.get_label(), updated_model.predict(dholdout), squared=False)
+            promoted = holdout_rmse_after <= holdout_rmse_before * (1 + self.max_rmse_increase)
 
             logger.info("XGBoost Metrics:")
             logger.info(f"Root Mean Squared Error (RMSE): {xgb_rmse:.2f}")
             logger.info(f"R-squared (R2): {xgb_r2:.2f}")
-            
-            # Overwrite the old model with the updated model
-            logger.info('Overwriting old model with updated model')
-            save_object(xgb_model_path, updated_model)
+            logger.info(f"Holdout RMSE: {holdout_rmse_before:.2f} -> {holdout_rmse_after:.2f}")
 
-            logger.info('Pipeline execution completed')
+            version = snapshot.version
+            if promoted:
+                # Publish the updated model as a new version, the old one is kept for rollback.
+                # The native copy keeps the served booster in sync with the pickled one.
+                xgb_model_name = 'XGRegressorModel_v2.pkl'
+                with metrics.stage('train', 'publish'):
+                    version = model_store.publish(
+                        {xgb_model_name: updated_model, native_file_name(xgb_model_name): updated_model},
+                        base_version=snapshot.version,
+                        save=save_artifact,
+                    )
+                logger.info('Updated model published as version %s', version)
+
+                # Swap the new booster into the serving models right away
+                with metrics.stage('train', 'reload'):
+                    model_registry.refresh()
+            else:
+                logger.warning('Updated model rejected, the holdout RMSE regressed')
+
+            return {
+                'model_version': version,
+                'buffered_samples': int(X_new_preprocessed.shape[0]),
+                'updated': True,
+                'promoted': bool(promoted),
+                'boosting_rounds': int(updated_model.num_boosted_rounds()),
+                'rmse': float(xgb_rmse),
+                'r2': float(xgb_r2),
+                'holdout_rmse_before': float(holdout_rmse_before),
+                'holdout_rmse_after': float(holdout_rmse_after),
+            }
 
-            return None
-    
         except Exception as e:
             raise CustomException(e,sys)
+
+    def update_if_due(self):
+        """
+        Update the model if the buffer reached a threshold (e.g. its age) without new samples.
+
+        Returns:
+        dict: The metrics of the update, None if nothing was due.
+        """
+        with self.buffer.lock():
+            return self._update() if self.is_due() else None
         
 
 
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import pandas as pd
+from contextlib import contextmanager
+from src.exception import CustomException
+from src.pipelines.train_pipeline import TrainPipeline
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+# Samples added to the training buffer, waiting for the update that will train them
+BUFFERED = 'buffered'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class TrainingJobQueue:
+    """
+    Durable queue of training samples stored in a local SQLite database.
+
+    Every /train request becomes a job holding its samples. Jobs survive restarts: the ones
+    that were running when the process stopped are queued again on start up.
+
+    A job goes from queued to running, then to succeeded once a model update trained its samples,
+    or to buffered if they were only added to the training buffer. Buffered jobs succeed (or fail)
+    with the update that takes their samples out of the buffer, see finish_buffered.
+    """
+
+    def __init__(self, db_path='artifacts/training_jobs.sqlite3'):
+        self.db_path = db_path
+        dir_path = os.path.dirname(db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    n_samples INTEGER NOT NULL,
+                    samples TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    batch_id TEXT,
+                    metrics TEXT,
+                    error TEXT
+                )
+                """
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per operation, so the queue can be shared by threads and processes
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, features):
+        """
+        Store the samples of a training request.
+
+        Parameters:
+        features (DataFrame): Training samples, including the 'price' target.
+
+        Returns:
+        str: The id of the new job.
+        """
+        try:
+            job_id = uuid.uuid4().hex
+            samples = json.dumps({column: features[column].tolist() for column in features.columns})
+
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT INTO jobs (id, status, n_samples, samples, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, QUEUED, int(features.shape[0]), samples, time.time()),
+                )
+            return job_id
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def get(self, job_id):
+        """
+        Return the status of a job, or None if it does not exist.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT id, status, n_samples, created_at, started_at, finished_at, batch_id, metrics, error "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        job = dict(zip(['job_id', 'status', 'n_samples', 'created_at', 'started_at', 'finished_at',
+                        'batch_id', 'metrics', 'error'], row))
+        job['metrics'] = json.loads(job['metrics']) if job['metrics'] else None
+        return job
+
+    def claim(self, max_samples=None):
+        """
+        Atomically mark the oldest queued jobs as running and return their samples.
+
+        Parameters:
+        max_samples (int, optional): Stop adding jobs once this many samples are claimed. At least one job is always claimed.
+
+        Returns:
+        tuple: The batch id, the claimed job ids and their samples as a single DataFrame (None if the queue is empty).
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    "SELECT id, n_samples, samples FROM jobs WHERE status = ? ORDER BY created_at",
+                    (QUEUED,),
+                ).fetchall()
+
+                claimed = []
+                n_samples = 0
+                for row in rows:
+                    if claimed and max_samples is not None and n_samples + row[1] > max_samples:
+                        break
+                    claimed.append(row)
+                    n_samples += row[1]
+
+                batch_id = uuid.uuid4().hex
+                connection.executemany(
+                    "UPDATE jobs SET status = ?, started_at = ?, batch_id = ? WHERE id = ?",
+                    [(RUNNING, time.time(), batch_id, row[0]) for row in claimed],
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        if not claimed:
+            return None, [], None
+
+        features = pd.concat([pd.DataFrame(json.loads(row[2])) for row in claimed], ignore_index=True)
+        return batch_id, [row[0] for row in claimed], features
+
+    def finish(self, job_ids, metrics=None, error=None):
+        """
+        Mark the jobs of a batch as succeeded (with the training metrics), buffered if the metrics
+        report no update, or failed.
+        """
+        if error is not None:
+            status = FAILED
+        elif metrics is not None and metrics.get('updated') is False:
+            status = BUFFERED
+        else:
+            status = SUCCEEDED
+        with self._connect() as connection:
+            connection.executemany(
+                "UPDATE jobs SET status = ?, finished_at = ?, metrics = ?, error = ? WHERE id = ?",
+                [(status, time.time(), json.dumps(metrics) if metrics is not None else None, error, job_id)
+                 for job_id in job_ids],
+            )
+
+    def finish_buffered(self, metrics=None, error=None):
+        """
+        Mark every buffered job as succeeded with the metrics of the update that trained their samples,
+        or as failed if the update failed and their samples were moved aside.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, metrics = ?, error = ? WHERE status = ?",
+                (FAILED if error is not None else SUCCEEDED, time.time(),
+                 json.dumps(metrics) if metrics is not None else None, error, BUFFERED),
+            )
+
+    def requeue_running(self):
+        """
+        Queue again the jobs left running by a process that stopped in the middle of a training.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, batch_id = NULL WHERE status = ?",
+                (QUEUED, RUNNING),
+            )
+
+    def count(self, status=QUEUED):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+class TrainingWorker:
+    """
+    Background trainer. It polls the job queue, coalesces every queued job into a single
+    training batch and hands it to TrainPipeline, which buffers the samples until there are
+    enough of them for an update. While idle, it lets the pipeline train an old buffer.
+
+    Only one process trains at a time: the training is guarded by a lock file next to the
+    database, so several API workers can share the same queue.
+    """
+
+    def __init__(self, job_queue, pipeline=None, poll_interval=1.0, max_samples_per_update=None):
+        self.job_queue = job_queue
+        self.pipeline = pipeline if pipeline is not None else TrainPipeline()
+        self.poll_interval = poll_interval
+        self.max_samples_per_update = max_samples_per_update
+        self._lock_path = job_queue.db_path + '.lock'
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @contextmanager
+    def _training_lock(self):
+        """
+        Try to become the (only) trainer. Yields False if another process is training.
+        """
+        if fcntl is None:
+            yield True
+            return
+
+        with open(self._lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run_once(self):
+        """
+        Train on the queued jobs, if any.
+
+        Returns:
+        int: Number of jobs processed.
+        """
+        with self._training_lock() as acquired:
+            if not acquired:
+                return 0
+
+            batch_id, job_ids, features = self.job_queue.claim(self.max_samples_per_update)
+            if not job_ids:
+                # No new samples, but the buffered ones may have waited long enough for an update
+                if hasattr(self.pipeline, 'update_if_due'):
+                    try:
+                        metrics = self.pipeline.update_if_due()
+                        if metrics is not None:
+                            logger.info("Buffered samples trained: %s", metrics)
+                            self.job_queue.finish_buffered(metrics=metrics)
+                    except Exception as e:
+                        logger.exception("Update of the buffered samples failed")
+                        self._buffer_failed(e)
+                return 0
+
+            logger.info("Training batch %s: %d jobs, %d samples", batch_id, len(job_ids), features.shape[0])
+            try:
+                metrics = self.pipeline.train(features)
+                if metrics.get('updated'):
+                    # The update trained the samples buffered by the previous jobs too
+                    self.job_queue.finish_buffered(metrics=metrics)
+                self.job_queue.finish(job_ids, metrics=metrics)
+            except Exception as e:
+                logger.exception("Training batch %s failed", batch_id)
+                self.job_queue.finish(job_ids, error=str(e))
+                self._buffer_failed(e)
+
+            return len(job_ids)
+
+    def _buffer_failed(self, error):
+        # A failed update moves the buffered samples aside: their jobs failed with it
+        buffer = getattr(self.pipeline, 'buffer', None)
+        if buffer is not None and buffer.stats()[0] == 0:
+            self.job_queue.finish_buffered(error=str(error))
+
+    def start(self):
+        """
+        Start the background thread, recovering the jobs interrupted by a previous process.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._training_lock() as acquired:
+            # Nobody else is training, so the running jobs were left by a stopped process
+            if acquired:
+                self.job_queue.requeue_running()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='training-worker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                processed = self.run_once()
+            except Exception:
+                logger.exception("Training worker error")
+                processed = 0
+
+            # Keep going while there is a backlog, otherwise wait for new jobs
+            if processed == 0:
+                self._stop_event.wait(self.poll_interval)
@@ -0,0 +1,364 @@
+"""
+Hyperparameter search for the XGBoost and random forest regressors.
+
+Candidate configurations are sampled from a search space and evaluated by K-fold cross
+validation in a pool of processes, with successive halving: every configuration first gets a
+small budget (boosting rounds or trees), then only the best 1/eta of them are evaluated again
+with eta times the budget, until the maximum budget is reached or one configuration is left.
+XGBoost trials also stop early on every fold when the validation RMSE stops improving.
+
+The folds (the output of preprocess_data_to_train on the training data) are computed once and
+cached on disk in a memory-mappable file, that every worker maps. Every evaluated trial is
+recorded in a SQLite results store, so a re-run skips the configurations already evaluated on
+the same data. The best configurations are written to a JSON file that the retraining
+pipeline accepts (src/pipelines/retrain_pipeline.py --params-file).
+
+Usage:
+    python -m src.pipelines.tuning --model all --n-configs 27 --workers 4
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from scipy import sparse
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.ensemble import RandomForestRegressor
+from src.exception import CustomException
+from src.logger import add_console_handler
+from src.utils import load_object, preprocess_data_to_train
+from src.model_registry import model_store
+from src.artifact_format import save_arrays, load_arrays
+
+
+logger = logging.getLogger(__name__)
+
+# Search spaces (from the grids of notebooks/RegressorModel.ipynb) and budget bounds
+SEARCH_SPACES = {
+    'xgb': {
+        'max_depth': [3, 5, 7, 9],
+        'eta': [0.01, 0.05, 0.1, 0.2],
+        'subsample': [0.8, 0.9, 1.0],
+        'colsample_bytree': [0.8, 0.9, 1.0],
+        'min_child_weight': [1, 3, 5],
+    },
+    'rf': {
+        'max_depth': [None, 10, 20, 30],
+        'min_samples_split': [2, 5, 10],
+        'min_samples_leaf': [1, 2, 4],
+        'max_features': [1.0, 0.5, 'sqrt'],
+    },
+}
+# (min, max) boosting rounds or trees
+BUDGETS = {'xgb': (50, 1000), 'rf': (25, 200)}
+
+XGB_EARLY_STOPPING_ROUNDS = 20
+
+
+# FOLDS
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_obj:
+        for block in iter(lambda: file_obj.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fold_cache_key(data_path, preprocessor_path, n_folds, seed):
+    """
+    Identity of the folds: the content of the data and of the fitted preprocessor, and the split.
+    """
+    parts = [_file_digest(data_path), _file_digest(preprocessor_path), str(n_folds), str(seed)]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def prepare_folds(data_path, cache_dir, n_folds=5, seed=42):
+    """
+    Preprocess the training data and split it in folds, unless the same folds are already cached.
+
+    Returns:
+    tuple: The path of the cached folds and their key.
+    """
+    preprocessor_path = model_store.resolve('preprocessor.pkl')
+    key = fold_cache_key(data_path, preprocessor_path, n_folds, seed)
+    path = os.path.join(cache_dir, f"folds-{key}.arrays")
+    if os.path.exists(path):
+        logger.info("Using the cached folds %s", path)
+        return path, key
+
+    X, y = preprocess_data_to_train(    df  =   pd.read_csv(data_path),
+                                        preprocessor =  load_object(preprocessor_path),
+                                        numeric_features = ['volume', 'carat', 'depth', 'table'],
+                                        categorical_features = ['color', 'cut', 'clarity'],
+                                        target = 'price'
+                                        )
+    # Kept sparse: XGBoost treats the implicit zeros as missing, as in the training pipelines
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    fold = np.random.default_rng(seed).permutation(X.shape[0]) % n_folds
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_arrays(path, {
+        'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+        'y': np.asarray(y, dtype=np.float64), 'fold': fold.astype(np.int8),
+    }, meta={'shape': list(X.shape), 'n_folds': n_folds, 'data_path': data_path})
+    logger.info("Folds cached in %s", path)
+    return path, key
+
+
+class Folds:
+    """
+    Cross validation folds mapped from the cache file.
+    """
+
+    def __init__(self, path):
+        arrays, meta = load_arrays(path)
+        self.X = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']))
+        self.X_dense = None
+        self.y = arrays['y']
+        self.fold = arrays['fold']
+        self.n_folds = meta['n_folds']
+
+    def dense(self):
+        # The random forest is faster on dense features, built once per worker when first needed
+        if self.X_dense is None:
+            self.X_dense = self.X.toarray()
+        return self.X_dense
+
+    def splits(self):
+        for k in range(self.n_folds):
+            yield self.fold != k, self.fold == k
+
+
+# TRIALS
+
+# Folds of the current worker process, mapped once by _init_worker
+_worker_folds = None
+
+
+def _init_worker(folds_path):
+    global _worker_folds
+    _worker_folds = Folds(folds_path)
+
+
+def _rmse(y_true, y_pred):
+    return float(np.sqrt(np.mean((y_true - y_pred) ** 2)))
+
+
+def evaluate_xgb(folds, params, budget):
+    scores, rounds = [], []
+    for train, valid in folds.splits():
+        dtrain = xgb.DMatrix(folds.X[train], label=folds.y[train])
+        dvalid = xgb.DMatrix(folds.X[valid], label=folds.y[valid])
+        booster = xgb.train(dict(params, objective='reg:squarederror', eval_metric='rmse', nthread=1),
+                            dtrain, num_boost_round=budget, evals=[(dvalid, 'valid')],
+                            early_stopping_rounds=XGB_EARLY_STOPPING_ROUNDS, verbose_eval=False)
+        best_rounds = booster.best_iteration + 1
+        scores.append(_rmse(folds.y[valid], booster.predict(dvalid, iteration_range=(0, best_rounds))))
+        rounds.append(best_rounds)
+    return scores, {'num_boost_round': int(round(np.mean(rounds)))}
+
+
+def evaluate_rf(folds, params, budget):
+    X = folds.dense()
+    scores = []
+    for train, valid in folds.splits():
+        forest = RandomForestRegressor(n_estimators=budget, n_jobs=1, random_state=42, **params)
+        forest.fit(X[train], folds.y[train])
+        scores.append(_rmse(folds.y[valid], forest.predict(X[valid])))
+    return scores, {'n_estimators': budget}
+
+
+EVALUATORS = {'xgb': evaluate_xgb, 'rf': evaluate_rf}
+
+
+def _run_trial(model, params, budget):
+    started_at = time.perf_counter()
+    scores, extra = EVALUATORS[model](_worker_folds, params, budget)
+    return {
+        'rmse': float(np.mean(scores)),
+        'rmse_std': float(np.std(scores)),
+        'extra': extra,
+        'seconds': time.perf_counter() - started_at,
+    }
+
+
+# RESULTS STORE
+
+def trial_key(model, params, budget, folds_key):
+    payload = json.dumps([model, params, budget, folds_key], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class TuningResults:
+    """
+    SQLite store of the evaluated trials, shared by the successive runs.
+    """
+
+    def __init__(self, db_path='artifacts/tuning/results.sqlite3'):
+        self.db_path = db_path
+        dir_path = os.path.dirname(db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS trials (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    budget INTEGER NOT NULL,
+                    folds_key TEXT NOT NULL,
+                    rmse REAL NOT NULL,
+                    rmse_std REAL NOT NULL,
+                    extra TEXT,
+                    seconds REAL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        with self._connect() as connection:
+            row = connection.execute("SELECT rmse, rmse_std, extra, seconds FROM trials WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {'rmse': row[0], 'rmse_std': row[1], 'extra': json.loads(row[2]) if row[2] else {}, 'seconds': row[3]}
+
+    def put(self, key, model, params, budget, folds_key, result):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO trials (key, model, params, budget, folds_key, rmse, rmse_std, extra, seconds, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, json.dumps(params, sort_keys=True), budget, folds_key, result['rmse'], result['rmse_std'],
+                 json.dumps(result['extra']), result['seconds'], time.time()),
+            )
+
+
+# SEARCH
+
+def sample_configs(space, n_configs, seed=42):
+    """
+    Draw distinct configurations from the search space (all of them if there are fewer).
+    """
+    names = sorted(space)
+    grid_size = math.prod(len(space[name]) for name in names)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(grid_size, size=min(n_configs, grid_size), replace=False)
+
+    configs = []
+    for pick in picks:
+        config = {}
+        for name in names:
+            pick, position = divmod(int(pick), len(space[name]))
+            config[name] = space[name][position]
+        configs.append(config)
+    return configs
+
+
+def successive_halving(model, configs, executor, results, folds_key, min_budget, max_budget, eta=3):
+    """
+    Evaluate the configurations with a growing budget, keeping the best 1/eta of them at every rung.
+
+    Returns:
+    list: The trials of the last rung, best first: dicts with the params, budget, rmse, rmse_std and extra.
+    """
+    budget = min_budget
+    while True:
+        trials = []
+        pending = []
+        for params in configs:
+            key = trial_key(model, params, budget, folds_key)
+            cached = results.get(key)
+            if cached is not None:
+                trials.append(dict(cached, params=params, budget=budget, cached=True))
+            else:
+                pending.append((key, params, executor.submit(_run_trial, model, params, budget)))
+
+        for key, params, future in pending:
+            result = future.result()
+            results.put(key, model, params, budget, folds_key, result)
+            trials.append(dict(result, params=params, budget=budget, cached=False))
+
+        trials.sort(key=lambda trial: trial['rmse'])
+        logger.info("%s rung with %d configs and a budget of %d: best RMSE %.2f (%d cached)",
+                    model, len(trials), budget, trials[0]['rmse'], sum(trial['cached'] for trial in trials))
+
+        if budget >= max_budget or len(trials) == 1:
+            return trials
+
+        configs = [trial['params'] for trial in trials[:max(1, math.ceil(len(trials) / eta))]]
+        budget = min(budget * eta, max_budget)
+
+
+def tune(models=('xgb', 'rf'), data_path='datasets/diamonds/diamonds_clean.csv', cache_dir='artifacts/tuning',
+         n_configs=27, eta=3, n_folds=5, workers=None, seed=42, budgets=None):
+    """
+    Search the hyperparameters of the given models.
+
+    Returns:
+    dict: For every model, its best trial (params, budget, rmse, rmse_std and the model specific extra values).
+    """
+    try:
+        folds_path, folds_key = prepare_folds(data_path, cache_dir, n_folds, seed)
+        results = TuningResults(os.path.join(cache_dir, 'results.sqlite3'))
+        budgets = dict(BUDGETS, **(budgets or {}))
+
+        best = {}
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_init_worker,
+                                 initargs=(folds_path,)) as executor:
+            for model in models:
+                configs = sample_configs(SEARCH_SPACES[model], n_configs, seed)
+                min_budget, max_budget = budgets[model]
+                trials = successive_halving(model, configs, executor, results, folds_key, min_budget, max_budget, eta)
+                best[model] = {name: trials[0][name] for name in ('params', 'budget', 'rmse', 'rmse_std', 'extra')}
+
+        return best
+
+    except Exception as e:
+        raise CustomException(e, sys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=['xgb', 'rf', 'all'], default='all', help='Model(s) to tune')
+    parser.add_argument('--data', default='datasets/diamonds/diamonds_clean.csv', help='Training data')
+    parser.add_argument('--cache-dir', default='artifacts/tuning', help='Folds cache and results store directory')
+    parser.add_argument('--n-configs', type=int, default=27, help='Configurations sampled per model')
+    parser.add_argument('--eta', type=int, default=3, help='Halving rate of the successive halving')
+    parser.add_argument('--folds', type=int, default=5, help='Cross validation folds')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--output', default='artifacts/tuning/best_params.json', help='Where to write the best configurations')
+    args = parser.parse_args(argv)
+
+    add_console_handler(logger)
+
+    models = ['xgb', 'rf'] if args.model == 'all' else [args.model]
+    best = tune(models, args.data, args.cache_dir, args.n_configs, args.eta, args.folds, args.workers)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as file_obj:
+        json.dump(best, file_obj, indent=2)
+    print(json.dumps(best, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Startup of the API serving processes.
+
+Importing pandas, XGBoost, sklearn and the pipelines, loading the models and running their
+first predictions takes seconds. The entry points (Xtream_API.py, Xtream_ASGI.py) only import
+this module, the metrics and the web framework, so a new replica answers its liveness check
+('/') right away. The rest runs in phases:
+
+    import_libraries  NumPy, pandas, XGBoost and sklearn
+    import_service    src.api_service and the pipelines
+    load              the model artifacts (src/model_registry.py)
+    warmup            predictions on a synthetic batch, through every path a request can take
+
+'/ready' answers 503 until the warmup is done, then 200, with the duration of every phase.
+The other requests wait until the process is ready (at most XTREAM_READY_TIMEOUT_S seconds).
+
+Modes (XTREAM_STARTUP):
+    background: the default, the phases run in a background thread. The background services
+        (model watcher, training worker) are started once ready.
+    preload: the phases run when the entry point is imported, for the servers that fork their
+        workers after loading the application (e.g. gunicorn --preload). The workers share the
+        loaded and warmed models copy-on-write, and every worker starts its background services
+        on its first request. The process that loaded the models never starts them.
+"""
+
+import os
+import time
+import logging
+import importlib
+import threading
+import contextlib
+from src.metrics import metrics
+
+
+STARTUP_MODES = ('background', 'preload')
+STARTUP_MODE = os.environ.get('XTREAM_STARTUP', 'background')
+# Rows of the synthetic warmup batch, 0 to skip the warmup
+WARMUP_ROWS = int(os.environ.get('XTREAM_WARMUP_ROWS', 64))
+READY_TIMEOUT = float(os.environ.get('XTREAM_READY_TIMEOUT_S', 120))
+
+# Third-party libraries of the service, timed apart from the project modules
+LIBRARIES = ('numpy', 'pandas', 'xgboost', 'sklearn.ensemble')
+
+logger = logging.getLogger(__name__)
+
+
+class NotReady(RuntimeError):
+    """
+    Raised when a request needs the service and the process is not ready (still starting, or failed to).
+    """
+
+
+def health():
+    """
+    Liveness check, answered as soon as the process runs.
+    """
+    return {"Health_check": "OK"}
+
+
+class Startup:
+    """
+    Phased startup of a serving process, see the module docstring.
+
+    Parameters:
+    mode (str): 'background' or 'preload'.
+    warmup_rows (int): Rows of the synthetic warmup batch, 0 to skip the warmup.
+    """
+
+    def __init__(self, mode=STARTUP_MODE, warmup_rows=WARMUP_ROWS):
+        if mode not in STARTUP_MODES:
+            raise ValueError(f"Unknown startup mode '{mode}', expected one of {STARTUP_MODES}.")
+        self.mode = mode
+        self.warmup_rows = warmup_rows
+        self.created_at = time.perf_counter()
+        self.phases = {}
+        self.ready_after = None
+        self.error = None
+        self._service = None
+        self._services_pid = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        started_at = time.perf_counter()
+        yield
+        self.phases[name] = time.perf_counter() - started_at
+
+    def _run(self):
+        try:
+            with self._phase('import_libraries'):
+                for library in LIBRARIES:
+                    importlib.import_module(library)
+            with self._phase('import_service'):
+                service = importlib.import_module('src.api_service')
+            with self._phase('load'):
+                service.load_models()
+            if self.warmup_rows > 0:
+                with self._phase('warmup'):
+                    service.warmup(self.warmup_rows)
+
+            self._service = service
+            self.ready_after = time.perf_counter() - self.created_at
+            logger.info("API ready after %.2fs (%s)", self.ready_after,
+                        ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases.items()))
+            if self.mode == 'background':
+                self._start_services()
+
+        except Exception as e:
+            self.error = str(e)
+            logger.exception("API startup failed: %s", str(e))
+        finally:
+            self._ready.set()
+
+    def start(self):
+        """
+        Run the startup phases, in a background thread unless in preload mode.
+        """
+        with self._lock:
+            if self._thread is not None or self._ready.is_set():
+                return
+            if self.mode == 'background':
+                self._thread = threading.Thread(target=self._run, name='api-startup', daemon=True)
+                self._thread.start()
+                return
+        self._run()
+
+    def _start_services(self):
+        # Once per process: a worker forked after the load has another pid than the process that loaded
+        pid = os.getpid()
+        if self._services_pid == pid:
+            return
+        with self._lock:
+            if self._services_pid != pid:
+                self._service.start_background_services()
+                self._services_pid = pid
+
+    def is_ready(self):
+        return self._ready.is_set() and self.error is None
+
+    def service(self, timeout=READY_TIMEOUT):
+        """
+        Return the src.api_service module once the process is ready, waiting for the startup if needed.
+        """
+        if not self._ready.wait(timeout):
+            raise NotReady('The API is still starting, please retry later.')
+        if self.error is not None:
+            raise NotReady(f'The API failed to start: {self.error}')
+        self._start_services()
+        return self._service
+
+    def report(self):
+        """
+        Return the readiness of the process and the duration of every startup phase.
+        """
+        return {
+            'ready': self.is_ready(),
+            'mode': self.mode,
+            'phases_s': dict(self.phases),
+            'ready_after_s': self.ready_after,
+            'error': self.error,
+        }
+
+    def collect_metrics(self):
+        return [
+            ('xtream_ready', 'gauge', 'Whether the process is ready to serve.', [({}, int(self.is_ready()))]),
+            ('xtream_startup_phase_seconds', 'gauge', 'Duration of every startup phase of the process.',
+             [({'phase': name}, seconds) for name, seconds in dict(self.phases).items()]),
+        ]
+
+
+# Startup of the serving process
+startup = Startup()
+
+metrics.add_collector(startup.collect_metrics)
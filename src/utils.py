@@ -1,23 +1,69 @@
 import os
 import sys
+import time
+import uuid
+import errno
+import shutil
+import hashlib
 import numpy as np 
 import pandas as pd
 import pickle
+from contextlib import contextmanager
+from scipy import sparse
 from src.exception import CustomException
+from src.metrics import metrics
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on Windows
+    fcntl = None
+
 # GENERAL PURPOSE METHODS
 
-def save_object(file_path, obj):
+def _fsync_dir(dir_path):
+    """
+    Flush a directory entry to disk, so a rename inside it survives a crash (no-op where unsupported).
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
     try:
-        dir_path = os.path.dirname(file_path)
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
-        os.makedirs(dir_path, exist_ok=True)
 
-        with open(file_path, "wb") as file_obj:
-            pickle.dump(obj, file_obj)
+def atomic_write(file_path, write):
+    """
+    Write a file atomically: write(file_obj) fills a temporary file in the same directory,
+    which is fsynced and then renamed over file_path. Readers see the old or the new file, never a torn one.
+    """
+    dir_path = os.path.dirname(file_path) or '.'
+    os.makedirs(dir_path, exist_ok=True)
+
+    tmp_path = os.path.join(dir_path, f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as file_obj:
+            write(file_obj)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _fsync_dir(dir_path)
+
+
+def save_object(file_path, obj):
+    try:
+        atomic_write(file_path, lambda file_obj: pickle.dump(obj, file_obj))
 
     except Exception as e:
         raise CustomException(e, sys)
@@ -30,6 +76,180 @@ def load_object(file_path):
     except Exception as e:
         raise CustomException(e, sys)
 
+
+class ModelStore:
+    """
+    Versioned store of model artifacts.
+
+    Every published version is an immutable directory (root/versions/v000001, ...) holding the
+    complete artifact set. The CURRENT file points to the version in service and is flipped
+    atomically, so readers never see a half-written model and a rollback is a pointer change.
+    Old versions are deleted with a least-recently-used retention policy.
+
+    Until the first version is published, artifacts resolve to the legacy files in legacy_dir.
+
+    derived_files maps an artifact built from other ones (e.g. a compacted model) to the files it
+    was built from. It is not carried over into a new version that replaces any of them.
+    """
+
+    def __init__(self, root='artifacts/store', legacy_dir='artifacts', keep_versions=5, derived_files=None):
+        self.root = root
+        self.legacy_dir = legacy_dir
+        self.keep_versions = keep_versions
+        self.derived_files = dict(derived_files or {})
+        self.versions_dir = os.path.join(root, 'versions')
+        self.current_path = os.path.join(root, 'CURRENT')
+
+    def version_path(self, version):
+        return os.path.join(self.versions_dir, version)
+
+    def list_versions(self):
+        """
+        Return the published versions, oldest first.
+        """
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted(name for name in os.listdir(self.versions_dir) if name.startswith('v'))
+
+    def current_version(self):
+        """
+        Return the version in service, or None if nothing has been published yet.
+        """
+        try:
+            with open(self.current_path, "r") as file_obj:
+                return file_obj.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_current(self, version):
+        """
+        Atomically point CURRENT to a published version (also used to roll back).
+        """
+        try:
+            if not os.path.isdir(self.version_path(version)):
+                raise ValueError(f"Unknown model version '{version}'.")
+            atomic_write(self.current_path, lambda file_obj: file_obj.write(version.encode()))
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def resolve(self, file_name, version=None):
+        """
+        Return the path of an artifact in the given version (the current one by default).
+        Resolving a version marks it as recently used for the retention policy.
+        """
+        version = version or self.current_version()
+        if version is None:
+            return os.path.join(self.legacy_dir, file_name)
+
+        version_path = self.version_path(version)
+        try:
+            os.utime(version_path)
+        except OSError:
+            pass
+        return os.path.join(version_path, file_name)
+
+    def _base_files(self, base_version):
+        """
+        Files to carry over into a new version: the ones of the base version, or the legacy artifacts.
+        """
+        if base_version:
+            base_dir, extensions = self.version_path(base_version), None
+        else:
+            base_dir, extensions = self.legacy_dir, ('.pkl', '.ubj', '.forest', '.prep')
+
+        if not os.path.isdir(base_dir):
+            return {}
+        return {
+            name: os.path.join(base_dir, name)
+            for name in os.listdir(base_dir)
+            if not name.startswith('.') and os.path.isfile(os.path.join(base_dir, name))
+            and (extensions is None or name.endswith(extensions))
+        }
+
+    def publish(self, objects, base_version=None, make_current=True, save=save_object):
+        """
+        Publish a new immutable version.
+
+        Parameters:
+        objects (dict): Mapping of artifact file name to the object to pickle, e.g. {'XGRegressorModel_v2.pkl': booster}.
+        base_version (str, optional): Version whose other artifacts are carried over, except the ones derived
+        from a replaced artifact (see derived_files). The current one by default.
+        make_current (bool): Whether to flip CURRENT to the new version.
+        save (callable): Function used to write every object, save_object (pickle) by default.
+
+        Returns:
+        str: The new version.
+        """
+        try:
+            base_version = base_version or self.current_version()
+            os.makedirs(self.versions_dir, exist_ok=True)
+
+            # Build the version in a staging directory
+            staging_dir = os.path.join(self.root, f".staging-{uuid.uuid4().hex}")
+            os.makedirs(staging_dir)
+            try:
+                for name, path in self._base_files(base_version).items():
+                    if name in objects:
+                        continue
+                    # A derived artifact would no longer match the new version of its sources
+                    if any(source in objects for source in self.derived_files.get(name, ())):
+                        continue
+                    target = os.path.join(staging_dir, name)
+                    try:
+                        # Versions are immutable, so unchanged artifacts can be shared
+                        os.link(path, target)
+                    except OSError:
+                        shutil.copy2(path, target)
+
+                for name, obj in objects.items():
+                    save(os.path.join(staging_dir, name), obj)
+                _fsync_dir(staging_dir)
+
+                # Atomically move it to the next free version number
+                versions = self.list_versions()
+                number = int(versions[-1][1:]) + 1 if versions else 1
+                while True:
+                    version = f"v{number:06d}"
+                    try:
+                        os.rename(staging_dir, self.version_path(version))
+                        break
+                    except OSError as e:
+                        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                            raise
+                        number += 1
+                _fsync_dir(self.versions_dir)
+            finally:
+                if os.path.isdir(staging_dir):
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+
+            if make_current:
+                self.set_current(version)
+            self.prune()
+
+            return version
+
+        except Exception as e:
+            raise CustomException(e, sys)
+
+    def prune(self, keep_versions=None):
+        """
+        Delete the least recently used versions, keeping keep_versions of them plus the current one.
+
+        Returns:
+        list: The deleted versions.
+        """
+        keep_versions = self.keep_versions if keep_versions is None else keep_versions
+        current = self.current_version()
+
+        candidates = [version for version in self.list_versions() if version != current]
+        candidates.sort(key=lambda version: os.path.getmtime(self.version_path(version)), reverse=True)
+
+        deleted = candidates[max(keep_versions - 1, 0):] if current else candidates[keep_versions:]
+        for version in deleted:
+            shutil.rmtree(self.version_path(version), ignore_errors=True)
+        return deleted
+
 # PREPROCESSING METHODS
 
 def feature_engineering(df):
@@ -54,6 +274,62 @@ def feature_engineering(df):
     return df
 
 
+# Conditions that mark a sample as an outlier at prediction time: (feature, operator, threshold)
+OUTLIER_CONDITIONS = [
+    ('z', '<', 2),
+    ('y', '<', 2),
+    ('x', '<', 2),
+    ('table', '>', 75),
+    ('depth', '<', 50),
+    ('density', '<', 0.008),
+]
+
+_COMPARISONS = {'<': np.less, '>': np.greater}
+
+
+def outlier_conditions(df, conditions=OUTLIER_CONDITIONS):
+    """
+    Evaluate the outlier conditions on the input data.
+
+    Parameters:
+    df (DataFrame or dict): The input data, including the engineered 'density' feature.
+    conditions (list): (feature, operator, threshold) tuples.
+
+    Returns:
+    list: One boolean array per condition, True where the sample meets it.
+    """
+    return [
+        _COMPARISONS[operator](np.asarray(df[feature], dtype=np.float64), threshold)
+        for feature, operator, threshold in conditions
+    ]
+
+
+def outlier_reasons(condition_masks, conditions=OUTLIER_CONDITIONS):
+    """
+    Describe why every sample has been flagged as an outlier.
+
+    Parameters:
+    condition_masks (list): Output of outlier_conditions.
+    conditions (list): The conditions the masks were built from.
+
+    Returns:
+    ndarray: One entry per sample, None for valid samples or e.g. "z < 2, density < 0.008".
+    """
+    n_rows = len(condition_masks[0]) if condition_masks else 0
+    reasons = np.full(n_rows, None, dtype=object)
+    if n_rows == 0:
+        return reasons
+
+    matched = np.column_stack(condition_masks)
+    labels = [f"{feature} {operator} {threshold}" for feature, operator, threshold in conditions]
+
+    # Only the (few) rejected rows need a description
+    for row in np.flatnonzero(matched.any(axis=1)):
+        reasons[row] = ", ".join(label for label, hit in zip(labels, matched[row]) if hit)
+
+    return reasons
+
+
 def removing_outliers(df):
     """
     Remove outliers from the input dataframe based on specific conditions.
@@ -65,15 +341,7 @@ def removing_outliers(df):
     DataFrame: The dataframe with outliers removed.
     """
     # Define the conditions for removing outliers (updated without {price} column)
-    conditions = [
-        (df['z'] < 2),
-        (df['y'] < 2),
-        (df['x'] < 2),
-        (df['table'] > 75),
-        (df['depth'] < 50),
-        (df['density'] < 0.008)
-
-    ]
+    conditions = outlier_conditions(df)
 
     # Create a mask for the rows to be removed
     mask = np.any(conditions, axis=0)
@@ -133,7 +401,8 @@ def drop_redundant_features(df,redundant_features = ['x', 'y', 'z', 'density']):
 
 def preprocess_data_to_predict( df,preprocessor,
                                 numeric_features = ['volume', 'carat', 'depth', 'table'],
-                                categorical_features = ['color', 'cut', 'clarity']
+                                categorical_features = ['color', 'cut', 'clarity'],
+                                return_mask = False
                                 ):
 
     """
@@ -144,22 +413,39 @@ def preprocess_data_to_predict( df,preprocessor,
 	    preprocessor: The preprocessor to be used for data transformation.
 	    numeric_features (list): List of numeric features to be included in preprocessing.
 	    categorical_features (list): List of categorical features to be included in preprocessing.
-	    target (str): The target variable for prediction.
+	    return_mask (bool): If True, also return which input rows were kept and why the others were rejected.
 
 	Returns:
-	    X_preprocessed: The preprocessed input data for prediction.
+	    X_preprocessed: The preprocessed input data for prediction (valid rows only).
+	    valid (ndarray): Only with return_mask. Boolean mask of the input rows present in X_preprocessed.
+	    reasons (ndarray): Only with return_mask. Rejection reason of every input row, None for valid ones.
 	"""
     # Adding Features
-    df = feature_engineering(df)
+    with metrics.stage('predict', 'feature_engineering'):
+        df = feature_engineering(df)
 
     # Removing Outliers
-    df = removing_outliers(df)
-
-    # Drop redundant features
-    df = drop_redundant_features(df) 
+    with metrics.stage('predict', 'outliers'):
+        if return_mask:
+            conditions = outlier_conditions(df)
+            valid = ~np.any(conditions, axis=0)
+            reasons = outlier_reasons(conditions)
+            df = df[valid]
+        else:
+            df = removing_outliers(df)
+
+        # Drop redundant features
+        df = drop_redundant_features(df) 
+
+    if return_mask:
+        # Preprocess the data (nothing to transform if every row was rejected)
+        with metrics.stage('predict', 'transform'):
+            X_preprocessed = preprocessor.transform(df) if df.shape[0] > 0 else None
+        return X_preprocessed, valid, reasons
 
     # Preprocess the data
-    X_preprocessed = preprocessor.transform(df)
+    with metrics.stage('predict', 'transform'):
+        X_preprocessed = preprocessor.transform(df)
 
     return X_preprocessed
 
@@ -186,4 +472,245 @@ def preprocess_data_to_train (  df,
     y_new = df[target]
     X_new_preprocessed = preprocessor.transform(X_new)
 
-    return X_new_preprocessed , y_new
\ No newline at end of file
+    return X_new_preprocessed , y_new
+
+# FEATURE MATRIX CACHE
+
+def preprocessor_fingerprint(preprocessor):
+    """
+    Hash of a fitted preprocessor: two preprocessors with the same fitted state transform the data the same way.
+    """
+    return hashlib.sha256(pickle.dumps(preprocessor)).hexdigest()[:16]
+
+
+def row_hashes(df, columns):
+    """
+    64-bit hash of the raw values of every row, over the given columns.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy(dtype=np.uint64)
+
+
+class FeatureMatrixCache:
+    """
+    On-disk cache of the training matrices built by preprocess_data_to_train.
+
+    Rows are identified by the hash of their raw values and the cache is partitioned by the
+    fingerprint of the fitted preprocessor, so a new preprocessor starts from an empty cache.
+    Every call only preprocesses the rows that were never seen and appends them as a new
+    shard (a memory-mapped array container holding their sparse features, their target and
+    whether they passed the outlier filters). The other rows are read back from the shards.
+
+    The shards stay few and the cache bounded: past max_shards shards, the smallest ones are
+    merged into one, and past max_rows rows the oldest shards are removed (their rows are
+    preprocessed again if they come back). Only the shards of the current files stay mapped.
+
+    Parameters:
+    cache_dir (str): Directory of the cache.
+    columns (list, optional): Raw columns hashed to identify a row, all of them by default.
+    max_shards (int): Shards per preprocessor above which the smallest ones are merged.
+    max_rows (int, optional): Rows kept per preprocessor, None for no limit.
+    """
+
+    def __init__(self, cache_dir='artifacts/feature_cache', columns=None, max_shards=16, max_rows=1_000_000):
+        self.cache_dir = cache_dir
+        self.columns = columns
+        self.max_shards = max(max_shards, 2)
+        self.max_rows = max_rows
+        self._shards = {}
+
+    def _shard_dir(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def _shard_names(self, fingerprint):
+        # Oldest first: the names start with the time of their newest rows
+        shard_dir = self._shard_dir(fingerprint)
+        if not os.path.isdir(shard_dir):
+            return []
+        return sorted(name for name in os.listdir(shard_dir) if name.endswith('.arrays') and not name.startswith('.'))
+
+    @contextmanager
+    def _lock(self, fingerprint):
+        """
+        Exclusive access to the shards of a preprocessor, across the processes sharing the cache.
+        """
+        if fcntl is None:
+            yield
+            return
+        shard_dir = self._shard_dir(fingerprint)
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(os.path.join(shard_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_shards(self, fingerprint):
+        """
+        Map the shards written since the last call (by this or by another process). The shards
+        merged or removed since then, and those of the other preprocessors, are unmapped.
+        """
+        from src.artifact_format import load_arrays
+
+        mapped = self._shards.get(fingerprint, {})
+        shards = {}
+        with self._lock(fingerprint):
+            for name in self._shard_names(fingerprint):
+                if name not in mapped:
+                    arrays, meta = load_arrays(os.path.join(self._shard_dir(fingerprint), name))
+                    X = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                          shape=tuple(meta['shape']))
+                    # Sorted once, for the lookups
+                    order = np.argsort(arrays['hashes'], kind='stable')
+                    mapped[name] = (arrays['hashes'][order], arrays['position'][order], X, arrays['y'], meta['sparse'])
+                shards[name] = mapped[name]
+        self._shards = {fingerprint: shards}
+        return list(shards.values())
+
+    def _write_shard(self, fingerprint, timestamp, hashes, position, X, y, is_sparse):
+        from src.artifact_format import save_arrays
+
+        name = f"shard-{timestamp:020d}-{uuid.uuid4().hex[:8]}.arrays"
+        save_arrays(os.path.join(self._shard_dir(fingerprint), name), {
+            'hashes': hashes, 'position': position, 'y': np.asarray(y, dtype=np.float64),
+            'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+        }, meta={'shape': list(X.shape), 'sparse': is_sparse})
+
+    def _append(self, fingerprint, hashes, X, y, kept):
+        is_sparse = sparse.issparse(X)
+        X = sparse.csr_matrix(X)
+        # Position of every row in the shard matrix, -1 for the rows dropped as outliers
+        position = np.full(len(hashes), -1, dtype=np.int64)
+        position[kept] = np.arange(int(kept.sum()))
+
+        with self._lock(fingerprint):
+            self._write_shard(fingerprint, time.time_ns(), hashes, position, X, y, is_sparse)
+            self._compact(fingerprint)
+
+    def _compact(self, fingerprint):
+        """
+        Merge the smallest shards past max_shards, then remove the oldest ones past max_rows.
+        Called with the lock held.
+        """
+        from src.artifact_format import load_arrays
+
+        shard_dir = self._shard_dir(fingerprint)
+        names = self._shard_names(fingerprint)
+        if len(names) > self.max_shards:
+            sizes = {name: len(load_arrays(os.path.join(shard_dir, name))[0]['hashes']) for name in names}
+            smallest = sorted(names, key=lambda name: sizes[name])[:len(names) - self.max_shards // 2 + 1]
+            self._merge(fingerprint, sorted(smallest))
+            names = self._shard_names(fingerprint)
+
+        if self.max_rows is not None and len(names) > 1:
+            sizes = [len(load_arrays(os.path.join(shard_dir, name))[0]['hashes']) for name in names]
+            total = sum(sizes)
+            # The newest shard is always kept
+            for name, size in zip(names[:-1], sizes[:-1]):
+                if total <= self.max_rows:
+                    break
+                os.remove(os.path.join(shard_dir, name))
+                total -= size
+
+    def _merge(self, fingerprint, names):
+        from src.artifact_format import load_arrays
+
+        shard_dir = self._shard_dir(fingerprint)
+        hashes, positions, blocks, targets = [], [], [], []
+        offset = 0
+        for name in names:
+            arrays, meta = load_arrays(os.path.join(shard_dir, name))
+            blocks.append(sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                            shape=tuple(meta['shape'])))
+            hashes.append(arrays['hashes'])
+            positions.append(np.where(arrays['position'] >= 0, arrays['position'] + offset, -1))
+            targets.append(arrays['y'])
+            offset += meta['shape'][0]
+
+        # Rows appended by two processes at once are kept once
+        hashes = np.concatenate(hashes)
+        _, first = np.unique(hashes, return_index=True)
+        first = np.sort(first)
+        hashes, old_position = hashes[first], np.concatenate(positions)[first]
+
+        kept = old_position >= 0
+        X = sparse.vstack(blocks, format='csr')[old_position[kept]]
+        y = np.concatenate(targets)[old_position[kept]]
+        position = np.full(len(hashes), -1, dtype=np.int64)
+        position[kept] = np.arange(int(kept.sum()))
+
+        newest = max(int(name.split('-')[1]) for name in names)
+        self._write_shard(fingerprint, newest, hashes, position, X, y, meta['sparse'])
+        for name in names:
+            os.remove(os.path.join(shard_dir, name))
+
+    def preprocess(self, df, preprocessor, target='price', **kwargs):
+        """
+        Same result as preprocess_data_to_train(df, preprocessor, target=target), reading the rows
+        already preprocessed with this preprocessor from the cache.
+
+        Returns:
+        tuple: The feature matrix and the target Series of the rows that passed the outlier filters.
+        """
+        try:
+            df = df.reset_index(drop=True)
+            fingerprint = preprocessor_fingerprint(preprocessor)
+            hashes = row_hashes(df, self.columns or list(df.columns))
+
+            # Look the rows up in every shard
+            shard_of = np.full(len(df), -1, dtype=np.int64)
+            position = np.full(len(df), -1, dtype=np.int64)
+            shards = self._load_shards(fingerprint)
+            for i, (shard_hashes, shard_position, _, _, _) in enumerate(shards):
+                if len(shard_hashes) == 0:
+                    continue
+                found = np.minimum(np.searchsorted(shard_hashes, hashes), len(shard_hashes) - 1)
+                hit = (shard_of < 0) & (shard_hashes[found] == hashes)
+                shard_of[hit] = i
+                position[hit] = shard_position[found[hit]]
+
+            # Preprocess (once) the rows that were never seen and append them to the cache
+            missing = np.flatnonzero(shard_of < 0)
+            if len(missing) > 0:
+                _, first = np.unique(hashes[missing], return_index=True)
+                new_rows = np.sort(missing[first])
+                X_new, y_new = preprocess_data_to_train(df.iloc[new_rows].copy(), preprocessor, target=target, **kwargs)
+                kept = np.isin(np.arange(len(new_rows)), np.searchsorted(new_rows, y_new.index.to_numpy()))
+                self._append(fingerprint, hashes[new_rows], X_new, y_new, kept)
+
+                # The new rows are read from the matrix just built: the append may have removed
+                # shards past max_rows, the ones already mapped stay readable until the next call
+                new_position = np.full(len(new_rows), -1, dtype=np.int64)
+                new_position[kept] = np.arange(int(kept.sum()))
+                sorter = np.argsort(hashes[new_rows], kind='stable')
+                j = sorter[np.searchsorted(hashes[new_rows], hashes[missing], sorter=sorter)]
+                shard_of[missing] = len(shards)
+                position[missing] = new_position[j]
+                shards = shards + [(None, None, sparse.csr_matrix(X_new), y_new.to_numpy(), sparse.issparse(X_new))]
+
+            rows = np.flatnonzero(position >= 0)
+            blocks, targets = [], []
+            # Gather the rows shard by shard, then put them back in the input order
+            order = np.argsort(shard_of[rows], kind='stable')
+            for i in np.unique(shard_of[rows]):
+                selected = rows[order][shard_of[rows][order] == i]
+                blocks.append(shards[i][2][position[selected]])
+                targets.append(shards[i][3][position[selected]])
+
+            n_features = shards[0][2].shape[1] if shards else 0
+            if blocks:
+                inverse = np.empty(len(rows), dtype=np.int64)
+                inverse[order] = np.arange(len(rows))
+                X = sparse.vstack(blocks, format='csr')[inverse]
+                y = np.concatenate(targets)[inverse]
+            else:
+                X = sparse.csr_matrix((0, n_features))
+                y = np.empty(0)
+
+            # Same matrix type as the preprocessor output (XGBoost reads the zeros of a sparse matrix as missing)
+            if shards and not shards[-1][4]:
+                X = X.toarray()
+            return X, pd.Series(y, index=df.index[rows], name=target)
+
+        except Exception as e:
+            raise CustomException(e, sys)
@@ -0,0 +1,180 @@
+"""
+Wire formats of the /predict and /train requests and responses.
+
+JSON stays the default. Bulk clients can send and receive columnar binary bodies instead,
+chosen with the Content-Type and Accept headers:
+
+    application/json                      JSON (default)
+    application/msgpack                   msgpack map of feature name to column of values. A
+                                          numeric column can also be a bin of little-endian
+                                          float64 values, used as a NumPy array without a copy.
+    application/vnd.apache.arrow.stream   Arrow IPC stream of a table with one column per feature.
+
+Binary bodies are decoded into NumPy columns, which src/decoding.py takes as they are: there is no
+Python object per row. The binary responses hold the same fields as the JSON ones: msgpack encodes
+the same map; Arrow returns a table with the 'predicted_price' and 'reason' columns (one row per
+input row, null price for the rejected rows) and the other fields in the schema metadata, as JSON.
+
+msgpack and pyarrow are optional dependencies, imported when a request first uses them.
+"""
+
+import json
+import importlib
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+FORMATS = (JSON, MSGPACK, ARROW)
+
+# Other media types sent for the same formats
+_ALIASES = {
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.msgpack': MSGPACK,
+}
+
+# Python package of every binary format
+_PACKAGES = {MSGPACK: 'msgpack', ARROW: 'pyarrow'}
+
+# Fields of a prediction response stored as Arrow columns, the others go to the schema metadata
+_ROW_FIELDS = ('predicted_prices', 'predicted_price', 'rejected', 'reason')
+
+
+class UnsupportedFormat(ValueError):
+    """
+    Raised when a binary format is used and its package is not installed.
+    """
+
+
+class InvalidPayload(ValueError):
+    """
+    Raised when a binary request body can't be decoded.
+    """
+
+
+def _media_type(value):
+    media_type = value.split(';')[0].strip().lower()
+    return _ALIASES.get(media_type, media_type)
+
+
+def _import(wire_format):
+    package = _PACKAGES[wire_format]
+    try:
+        return importlib.import_module(package)
+    except ImportError:
+        raise UnsupportedFormat(f"'{wire_format}' needs the '{package}' package, which is not installed.")
+
+
+def request_format(content_type):
+    """
+    Format of a request body from its Content-Type header. Bodies of any other type are read as JSON,
+    as they were before the binary formats.
+    """
+    media_type = _media_type(content_type) if content_type else JSON
+    return media_type if media_type in FORMATS else JSON
+
+
+def response_format(accept):
+    """
+    Format of the response from the Accept header: the supported one with the highest quality,
+    JSON if there is none.
+    """
+    if not accept:
+        return JSON
+    candidates = []
+    for position, item in enumerate(accept.split(',')):
+        media_type, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = _media_type(media_type)
+        if media_type in FORMATS and quality > 0:
+            # Highest quality first, then the order of the header
+            candidates.append((-quality, position, media_type))
+    return min(candidates)[2] if candidates else JSON
+
+
+def decode_request(body, body_format):
+    """
+    Decode a request body into the payload taken by the handlers of src/api_service.py.
+
+    Parameters:
+    body (bytes): Request body.
+    body_format (str): One of FORMATS, see request_format.
+
+    Returns:
+    dict or list: JSON objects, or for the binary formats a dict of columns (NumPy arrays or lists).
+    """
+    if body_format == JSON:
+        return json.loads(body) if body else None
+
+    module = _import(body_format)
+    try:
+        if body_format == MSGPACK:
+            return _from_msgpack(module.unpackb(body, raw=False))
+        return _from_arrow(module.ipc.open_stream(body).read_all())
+    except Exception as e:
+        raise InvalidPayload(f"The request body is not a valid {body_format} payload: {e}")
+
+
+def _from_msgpack(payload):
+    import numpy as np
+
+    if isinstance(payload, dict):
+        # Numeric columns sent as raw float64 buffers are used in place
+        return {name: np.frombuffer(values, dtype='<f8') if isinstance(values, bytes) else values
+                for name, values in payload.items()}
+    return payload
+
+
+def _from_arrow(table):
+    # Numeric columns without nulls are converted without a copy, strings become object arrays
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+def encode_response(result, response_format):
+    """
+    Encode the response of a handler.
+
+    Parameters:
+    result (dict): Response of a src/api_service.py handler.
+    response_format (str): One of FORMATS, see response_format.
+
+    Returns:
+    bytes: The response body.
+    """
+    if response_format == JSON:
+        return json.dumps(result).encode('utf-8')
+
+    module = _import(response_format)
+    if response_format == MSGPACK:
+        return module.packb(result, use_bin_type=True)
+    return _to_arrow(module, result)
+
+
+def _to_arrow(pa, result):
+    if 'predicted_prices' in result:
+        prices = result['predicted_prices']
+        reasons = [None] * len(prices)
+        for rejected in result.get('rejected', []):
+            reasons[rejected['index']] = rejected['reason']
+    elif 'predicted_price' in result:
+        prices = [result['predicted_price']]
+        reasons = [result.get('reason')]
+    else:
+        prices, reasons = [], []
+
+    schema = pa.schema([('predicted_price', pa.float64()), ('reason', pa.string())], metadata={
+        key: json.dumps(value) for key, value in result.items() if key not in _ROW_FIELDS
+    })
+    table = pa.table({'predicted_price': pa.array(prices, pa.float64()),
+                      'reason': pa.array(reasons, pa.string())}, schema=schema)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.model_registry import ARTIFACT_FILES  # noqa: E402
+
+# Models served by the API, not all of them are committed
+requires_models = pytest.mark.skipif(
+    not all(os.path.exists(os.path.join(ROOT, 'artifacts', name)) for name in ARTIFACT_FILES.values()),
+    reason='the model artifacts are not available',
+)
+
+
+@pytest.fixture
+def api_env(tmp_path):
+    """
+    Environment of an API process writing its logs and training queue under tmp_path.
+    """
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'XTREAM_LOG_DIR': str(tmp_path / 'log'),
+        'XTREAM_TRAIN_QUEUE_PATH': str(tmp_path / 'training_jobs.sqlite3'),
+    })
+    return env
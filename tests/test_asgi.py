@@ -0,0 +1,50 @@
+import sys
+import json
+import subprocess
+
+from conftest import ROOT, requires_models
+
+# Sends requests to the ASGI app in process and prints the status and body of every response
+ASGI_REQUESTS = '''
+import sys, json, asyncio
+import Xtream_ASGI
+
+async def call(method, path, body=b'', content_type=b'application/json'):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': [(b'content-type', content_type)]}
+    await Xtream_ASGI.app(scope, receive, send)
+    status = sent[0]['status']
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return status, json.loads(body)
+
+async def main():
+    requests = json.loads(sys.argv[1])
+    return [await call(method, path, body.encode()) for method, path, body in requests]
+
+print(json.dumps(asyncio.run(main())))
+'''
+
+
+def _asgi(api_env, requests):
+    process = subprocess.run([sys.executable, '-c', ASGI_REQUESTS, json.dumps(requests)], cwd=ROOT, env=api_env,
+                             capture_output=True, text=True, timeout=300)
+    assert process.returncode == 0, process.stderr[-2000:]
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+@requires_models
+def test_invalid_bodies_and_unknown_jobs(api_env):
+    (predict_status, predict_body), (train_status, train_body) = _asgi(api_env, [
+        ('POST', '/predict', '{"carat": 0.3,'),
+        ('GET', '/train/not-a-job', ''),
+    ])
+    assert predict_status == 400 and 'valid JSON' in predict_body['error']
+    assert train_status == 404 and 'not-a-job' in train_body['error']
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from src.utils import load_object
+from src.compiled_preprocessor import CompiledPreprocessor
+from src.pipelines.compaction import forest_arrays, truncate_tree, stack_trees, select_trees
+
+RF_PATH = os.path.join(ROOT, 'artifacts', 'RandomForestRegressorModel.pkl')
+pytestmark = pytest.mark.skipif(not os.path.exists(RF_PATH), reason='the random forest artifact is not available')
+
+
+@pytest.fixture(scope='module')
+def forest():
+    return load_object(RF_PATH)
+
+
+@pytest.fixture(scope='module')
+def X():
+    compiled = CompiledPreprocessor.from_column_transformer(
+        load_object(os.path.join(ROOT, 'artifacts', 'preprocessor_predict.pkl')))
+    data = pd.read_csv(os.path.join(ROOT, 'datasets', 'diamonds', 'diamonds.csv')).sample(2000, random_state=0)
+    X, _, _ = compiled.transform({name: data[name].to_numpy() for name in data.columns}, return_mask=True)
+    return X
+
+
+def _stack(forest, precision='float64', max_depth=None):
+    arrays, meta = forest_arrays(forest)
+    offsets = np.asarray(arrays['tree_offsets'])
+    trees = [truncate_tree(arrays, int(offsets[i]), int(offsets[i + 1]), max_depth) for i in range(len(offsets) - 1)]
+    lite_meta = {'kind': 'random_forest_regressor_lite', 'n_features_in_': int(meta['n_features_in_']),
+                 'n_outputs_': int(meta['n_outputs_'])}
+    return stack_trees(trees, lite_meta, precision)
+
+
+def test_full_precision_stack_matches_the_forest(forest, X):
+    np.testing.assert_allclose(_stack(forest).predict(X), forest.predict(X), rtol=1e-12)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'quantized'])
+def test_narrow_thresholds_take_the_same_branches(forest, X, precision):
+    np.testing.assert_array_equal(_stack(forest, precision).apply(X), _stack(forest).apply(X))
+
+
+def test_quantized_leaf_values_stay_within_their_step(forest, X):
+    quantized = _stack(forest, 'quantized')
+    error = np.max(np.abs(quantized.predict(X) - forest.predict(X)))
+    assert error <= quantized.value_scale
+
+
+def test_depth_limit(forest, X):
+    truncated = _stack(forest, max_depth=6)
+    assert truncated.max_depth <= 6
+    assert np.all(np.isfinite(truncated.predict(X)))
+
+
+def test_select_trees_picks_the_best_contribution_first():
+    y = np.array([1.0, 2.0, 3.0])
+    tree_predictions = np.column_stack([y + 5, y, y - 1])
+    assert select_trees(tree_predictions, y, base=np.zeros(3), rf_weight=1.0, n_trees=2)[0] == 1
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from src.utils import load_object
+from src.compiled_preprocessor import CompiledPreprocessor, check_parity, compile_preprocessor, synthetic_batch
+from src.artifact_format import save_compiled_preprocessor, load_compiled_preprocessor
+
+
+@pytest.fixture(scope='module')
+def preprocessor():
+    return load_object(os.path.join(ROOT, 'artifacts', 'preprocessor_predict.pkl'))
+
+
+@pytest.fixture(scope='module')
+def compiled(preprocessor):
+    return CompiledPreprocessor.from_column_transformer(preprocessor)
+
+
+@pytest.fixture(scope='module')
+def diamonds():
+    data = pd.read_csv(os.path.join(ROOT, 'datasets', 'diamonds', 'diamonds.csv'))
+    return {name: data[name].to_numpy() for name in data.columns}
+
+
+def test_parity_on_the_dataset(compiled, preprocessor, diamonds):
+    # Every row of the dataset, outliers included, goes through both paths
+    assert check_parity(compiled, preprocessor, diamonds) <= 1e-9
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parity_on_unknown_categories_and_outliers(compiled, preprocessor, seed):
+    assert check_parity(compiled, preprocessor, synthetic_batch(compiled, n_rows=257, seed=seed)) <= 1e-9
+
+
+def test_parity_when_every_row_is_rejected(compiled, preprocessor):
+    columns = synthetic_batch(compiled, n_rows=5)
+    columns['z'][:] = 1.0
+    assert check_parity(compiled, preprocessor, columns) == 0.0
+
+
+def test_parity_after_a_native_round_trip(compiled, preprocessor, diamonds, tmp_path):
+    path = str(tmp_path / 'preprocessor_predict.prep')
+    save_compiled_preprocessor(path, compiled)
+    assert check_parity(load_compiled_preprocessor(path), preprocessor, diamonds) <= 1e-9
+
+
+def test_compile_preprocessor_checks_parity(preprocessor):
+    assert isinstance(compile_preprocessor(preprocessor), CompiledPreprocessor)
@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.exception import CustomException
+from src.decoding import decode_columns, decode_features
+from src.pipelines.bulk_scoring import iter_csv_chunks
+
+ROW = {'carat': 0.5, 'cut': 'Ideal', 'color': 'E', 'clarity': 'SI1', 'depth': 61.5,
+       'table': 55.0, 'x': 5.0, 'y': 5.1, 'z': 3.1}
+
+
+def test_row_and_column_payloads_decode_alike():
+    rows = decode_features([ROW, ROW])
+    columns = decode_features({feature: [value, value] for feature, value in ROW.items()})
+    assert rows.equals(columns)
+    assert rows['depth'].dtype == np.float64
+
+
+@pytest.mark.parametrize('feature, value', [('depth', None), ('carat', float('nan')), ('x', float('inf')),
+                                            ('cut', None)])
+def test_missing_values_are_refused(feature, value):
+    with pytest.raises(CustomException, match=f"'{feature}' feature is missing or invalid"):
+        decode_features([ROW, dict(ROW, **{feature: value})])
+
+
+def test_missing_values_are_refused_in_column_payloads():
+    payload = {feature: np.array([value, value]) for feature, value in ROW.items()}
+    payload['table'] = np.array([55.0, np.nan])
+    with pytest.raises(CustomException, match="'table' feature is missing or invalid in 1 samples"):
+        decode_columns(payload)
+
+
+def test_csv_rows_with_missing_cells_are_reported_alone():
+    header = ','.join(ROW)
+    line = ','.join(str(value) for value in ROW.values())
+    csv = '\n'.join([header, line, line.replace('61.5', ''), line]) + '\n'
+
+    (columns, errors), = iter_csv_chunks(io.StringIO(csv))
+    assert list(errors) == [1]
+    assert 'depth' in errors[1]
+    assert len(columns['depth']) == 2
+
+
+def test_mixed_scalars_and_lists_are_refused():
+    payload = dict(ROW, carat=[0.3, 1.1], x=(5.0, 6.6))
+    with pytest.raises(CustomException, match="mixes single values and lists of values \\(lists in 'carat', 'x'\\)"):
+        decode_features(payload)
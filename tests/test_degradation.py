@@ -0,0 +1,37 @@
+import time
+import types
+
+import pytest
+
+from conftest import ROOT  # noqa: F401, puts the repository on sys.path
+from src.pipelines import degradation
+from src.pipelines.degradation import DegradationPolicy, FULL, XGB_ONLY
+
+ENSEMBLE = types.SimpleNamespace(rf_n_estimators=100, concurrent=True, weights=(0.5, 0.5))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(degradation, 'time', types.SimpleNamespace(monotonic=lambda: now[0], perf_counter=time.perf_counter))
+    return now
+
+
+def _choose(policy):
+    return policy.choose(1, ENSEMBLE, deadline=time.perf_counter() + 0.005)[0]
+
+
+@pytest.mark.parametrize('cost_half_life, recovered', [(30.0, FULL), (0, XGB_ONLY)])
+def test_forest_comes_back_after_a_transient_spike(clock, cost_half_life, recovered):
+    policy = DegradationPolicy(cost_half_life=cost_half_life)
+    policy.observe(1, {'xgb': 1e-4, 'rf': 1e-3, 'rf_trees': 100})
+    assert _choose(policy) == FULL
+
+    # One slow batch: the forest no longer fits the budget and is not timed anymore
+    policy.observe(1, {'xgb': 1e-4, 'rf': 1.0, 'rf_trees': 100})
+    assert _choose(policy) == XGB_ONLY
+    clock[0] += 10
+    assert _choose(policy) == XGB_ONLY
+
+    clock[0] += 300
+    assert _choose(policy) == recovered
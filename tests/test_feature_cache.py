@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from src.utils import FeatureMatrixCache, load_object, preprocess_data_to_train
+
+
+@pytest.fixture(scope='module')
+def preprocessor():
+    return load_object(os.path.join(ROOT, 'artifacts', 'preprocessor.pkl'))
+
+
+@pytest.fixture(scope='module')
+def data():
+    return pd.read_csv(os.path.join(ROOT, 'datasets', 'diamonds', 'diamonds_clean.csv')).head(400)
+
+
+def _dense(X):
+    return X.toarray() if hasattr(X, 'toarray') else np.asarray(X)
+
+
+def _open_files():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def test_cached_rows_match_the_preprocessing(tmp_path, preprocessor, data):
+    cache = FeatureMatrixCache(str(tmp_path))
+    expected_X, expected_y = preprocess_data_to_train(data.copy(), preprocessor)
+    for _ in range(2):
+        X, y = cache.preprocess(data, preprocessor)
+        np.testing.assert_allclose(_dense(X), _dense(expected_X))
+        np.testing.assert_array_equal(y.to_numpy(), expected_y.to_numpy())
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc')
+def test_small_calls_keep_the_cache_bounded(tmp_path, preprocessor, data):
+    cache = FeatureMatrixCache(str(tmp_path), max_shards=4, max_rows=150)
+    open_files = _open_files()
+    for start in range(0, 400, 10):
+        batch = data.iloc[start:start + 10]
+        X, y = cache.preprocess(batch, preprocessor)
+        expected_X, expected_y = preprocess_data_to_train(batch.copy(), preprocessor)
+        np.testing.assert_allclose(_dense(X), _dense(expected_X))
+        np.testing.assert_array_equal(y.to_numpy(), expected_y.to_numpy())
+
+    (fingerprint,) = os.listdir(tmp_path)
+    shards = [name for name in os.listdir(tmp_path / fingerprint) if name.endswith('.arrays')]
+    assert len(shards) <= 4
+    assert sum(len(cache._load_shards(fingerprint)[i][0]) for i in range(len(shards))) <= 150 + 10
+    assert _open_files() - open_files <= 4
+
+    # Rows evicted from the cache are preprocessed again
+    X, _ = cache.preprocess(data.head(10), preprocessor)
+    np.testing.assert_allclose(_dense(X), _dense(preprocess_data_to_train(data.head(10).copy(), preprocessor)[0]))
+
+
+def test_call_larger_than_the_row_cap(tmp_path, preprocessor, data):
+    # The rows of the second call span two shards which together exceed max_rows
+    cache = FeatureMatrixCache(str(tmp_path), max_rows=10)
+    cache.preprocess(data.head(6), preprocessor)
+    batch = data.head(12)
+    X, y = cache.preprocess(batch, preprocessor)
+    expected_X, expected_y = preprocess_data_to_train(batch.copy(), preprocessor)
+    np.testing.assert_allclose(_dense(X), _dense(expected_X))
+    np.testing.assert_array_equal(y.to_numpy(), expected_y.to_numpy())
+
+    X, _ = cache.preprocess(batch, preprocessor)
+    np.testing.assert_allclose(_dense(X), _dense(expected_X))
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+from src.utils import load_object
+from src.forest_engine import ForestEngine
+from src.artifact_format import forest_to_arrays, save_forest, load_forest
+
+RF_PATH = os.path.join(ROOT, 'artifacts', 'RandomForestRegressorModel.pkl')
+pytestmark = pytest.mark.skipif(not os.path.exists(RF_PATH), reason='the random forest artifact is not available')
+
+
+@pytest.fixture(scope='module')
+def forest():
+    return load_object(RF_PATH)
+
+
+@pytest.fixture(scope='module')
+def X(forest):
+    return np.random.default_rng(0).normal(size=(600, forest.n_features_in_))
+
+
+@pytest.mark.parametrize('n_rows', [1, 100, 600])
+def test_engine_matches_sklearn(forest, X, n_rows):
+    engine = ForestEngine(*forest_to_arrays(forest), max_engine_rows=256)
+    np.testing.assert_array_equal(engine.predict(X[:n_rows]), forest.predict(X[:n_rows]))
+
+
+@pytest.mark.parametrize('max_engine_rows', [None, 256])
+def test_tree_subsets_match_on_both_paths(forest, X, max_engine_rows):
+    engine = ForestEngine(*forest_to_arrays(forest), max_engine_rows=max_engine_rows)
+    trees = np.arange(7)
+    expected = np.mean([tree.predict(X.astype(np.float32)) for tree in forest.estimators_[:7]], axis=0)
+    np.testing.assert_allclose(engine.predict(X, trees=trees), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_large_batches_walk_the_trees_one_by_one(forest, X, n_jobs, monkeypatch):
+    engine = ForestEngine(*forest_to_arrays(forest), max_engine_rows=256, n_jobs=n_jobs)
+    monkeypatch.setattr(engine, '_sum_trees', None)
+    np.testing.assert_allclose(engine.predict(X), forest.predict(X), rtol=1e-12)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'quantized'])
+def test_compacted_forests_match_on_both_paths(forest, X, precision):
+    from src.pipelines.compaction import forest_arrays, truncate_tree, stack_trees
+
+    arrays, meta = forest_arrays(forest)
+    offsets = np.asarray(arrays['tree_offsets'])
+    trees = [truncate_tree(arrays, int(offsets[i]), int(offsets[i + 1]), 8) for i in range(5)]
+    lite_meta = {'kind': 'random_forest_regressor_lite', 'n_features_in_': int(meta['n_features_in_']),
+                 'n_outputs_': int(meta['n_outputs_'])}
+    engine = stack_trees(trees, lite_meta, precision)
+    engine.max_engine_rows = None
+    expected = engine.predict(X)
+    engine.max_engine_rows = 256
+    np.testing.assert_allclose(engine.predict(X), expected, rtol=1e-12)
+
+
+def test_load_forest_can_rebuild_sklearn(forest, X, tmp_path):
+    path = str(tmp_path / 'forest.forest')
+    save_forest(path, forest)
+    assert isinstance(load_forest(path), ForestEngine)
+    rebuilt = load_forest(path, as_sklearn=True)
+    np.testing.assert_array_equal(rebuilt.predict(X), forest.predict(X))
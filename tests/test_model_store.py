@@ -0,0 +1,37 @@
+import os
+
+from conftest import ROOT  # noqa: F401, puts the repository on sys.path
+from src.utils import ModelStore
+from src.artifact_format import DERIVED_FROM
+from src.model_registry import ModelRegistry
+
+RF = 'RandomForestRegressorModel.pkl'
+XGB = 'XGRegressorModel_v2.pkl'
+LITE = 'RandomForestRegressorModel_lite.forest'
+
+
+def _store(tmp_path):
+    return ModelStore(root=str(tmp_path / 'store'), legacy_dir=str(tmp_path / 'legacy'), derived_files=DERIVED_FROM)
+
+
+def _files(store, version):
+    return set(os.listdir(store.version_path(version)))
+
+
+def test_lite_forest_is_carried_over_with_its_sources(tmp_path):
+    store = _store(tmp_path)
+    store.publish({RF: 'forest', XGB: 'booster', LITE: 'lite forest'})
+    version = store.publish({'preprocessor_predict.pkl': 'preprocessor'})
+    assert LITE in _files(store, version)
+
+
+def test_publishing_a_source_drops_the_lite_forest(tmp_path):
+    store = _store(tmp_path)
+    for replaced in (RF, XGB):
+        store.publish({RF: 'forest', XGB: 'booster', LITE: 'lite forest'})
+        version = store.publish({replaced: 'retrained'})
+        assert _files(store, version) == {RF, XGB}
+
+    # The lite variant falls back to the new full forest
+    registry = ModelRegistry(store=store, prefer_native=False, variant='lite')
+    assert registry._resolve(RF, version) == store.resolve(RF, version)
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT, requires_models
+from src.utils import ModelStore, load_object
+from src.forest_engine import ForestEngine
+from src.artifact_format import DERIVED_FROM, save_artifact
+from src.model_registry import ModelRegistry
+from src.decoding import FEATURE_COLUMNS, decode_features
+from src.pipelines import retrain_pipeline
+from src.pipelines.retrain_pipeline import RetrainPipeline, DEFAULT_RF_PARAMS, RF_MODEL_FILE
+from src.pipelines.predict_pipeline import PredictPipeline
+from src.pipelines.compaction import forest_arrays, truncate_tree, stack_trees
+
+LITE = 'RandomForestRegressorModel_lite.forest'
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Version holding the committed artifacts and a lite forest compacted from the served one
+    store = ModelStore(root=str(tmp_path / 'store'), legacy_dir=os.path.join(ROOT, 'artifacts'),
+                       derived_files=DERIVED_FROM)
+    arrays, meta = forest_arrays(load_object(os.path.join(ROOT, 'artifacts', RF_MODEL_FILE)))
+    offsets = np.asarray(arrays['tree_offsets'])
+    trees = [truncate_tree(arrays, int(offsets[i]), int(offsets[i + 1]), 4) for i in range(2)]
+    lite = stack_trees(trees, {'kind': 'random_forest_regressor_lite', 'n_features_in_': int(meta['n_features_in_']),
+                               'n_outputs_': int(meta['n_outputs_'])}, 'float32')
+    store.publish({LITE: lite}, save=save_artifact)
+
+    monkeypatch.setattr(retrain_pipeline, 'model_store', store)
+    monkeypatch.setattr(retrain_pipeline, 'model_registry', ModelRegistry(store=store))
+    return store
+
+
+@requires_models
+def test_retrained_models_are_published_and_served(tmp_path, store):
+    data = pd.read_csv(os.path.join(ROOT, 'datasets', 'diamonds', 'diamonds_clean.csv')).head(1500)
+    csv_path = str(tmp_path / 'train.csv')
+    data.to_csv(csv_path, index=False)
+
+    # A tiny memory budget: one tree per pass over the chunks, each one fitted on 200 rows at most
+    pipeline = RetrainPipeline(chunk_rows=400, max_memory_mb=0.001, rf_samples_per_tree=200, num_boost_round=5,
+                               rf_params=dict(DEFAULT_RF_PARAMS, n_estimators=3, max_depth=6))
+    assert pipeline.trees_per_pass(24) == 1
+    assert os.path.exists(store.resolve(LITE))
+    result = pipeline.run([csv_path])
+    version = result['model_version']
+    assert store.current_version() == version
+    assert np.isfinite(result['ensemble_rmse'])
+
+    forest = load_object(store.resolve(RF_MODEL_FILE, version))
+    assert len(forest.estimators_) == 3
+    assert all(tree.tree_.weighted_n_node_samples[0] <= 200 for tree in forest.estimators_)
+
+    # The lite forest was compacted from the replaced models: the lite variant serves the new forest
+    assert not os.path.exists(store.resolve(LITE, version))
+    registry = ModelRegistry(store=store, variant='lite')
+    rf_model = registry.get()['rf_model']
+    assert isinstance(rf_model, ForestEngine) and rf_model.n_estimators == 3
+
+    predictions = PredictPipeline(registry=registry).predict(decode_features(data[FEATURE_COLUMNS].head(20).to_dict('list')))
+    assert len(predictions) > 0 and np.all(np.isfinite(predictions))
@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from conftest import ROOT, requires_models
+
+# Loads the API in preload mode, forks like gunicorn --preload and posts a single row from the child
+FORK_AFTER_PRELOAD = '''
+import os, sys, signal
+import Xtream_API
+
+row = {'carat': 0.5, 'cut': 'Ideal', 'color': 'E', 'clarity': 'SI1', 'depth': 61.5,
+       'table': 55.0, 'x': 5.0, 'y': 5.1, 'z': 3.1}
+assert Xtream_API.startup.is_ready(), Xtream_API.startup.report()
+
+pid = os.fork()
+if pid == 0:
+    signal.alarm(30)
+    response = Xtream_API.app.test_client().post('/predict', json=row)
+    os._exit(0 if response.status_code == 200 and response.json.get('predicted_price') else 1)
+
+_, status = os.waitpid(pid, 0)
+sys.exit(os.waitstatus_to_exitcode(status))
+'''
+
+
+@requires_models
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_micro_batched_predict_after_fork(api_env):
+    # The warmup starts the micro-batching scheduler before the fork, the child must get a working one
+    env = dict(api_env, XTREAM_STARTUP='preload', XTREAM_MICRO_BATCHING='1')
+    process = subprocess.run([sys.executable, '-c', FORK_AFTER_PRELOAD], cwd=ROOT, env=env,
+                             capture_output=True, text=True, timeout=300)
+    assert process.returncode == 0, process.stderr[-2000:]
+
+
+def test_liveness_before_ready():
+    from src.startup import Startup, health
+
+    startup = Startup(mode='background', warmup_rows=0)
+    assert health() == {'Health_check': 'OK'}
+    assert not startup.is_ready()
+    assert startup.report()['ready'] is False
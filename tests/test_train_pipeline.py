@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT, requires_models
+from src.utils import FeatureMatrixCache
+from src.pipelines.train_pipeline import TrainPipeline, FreshDataBuffer, check_training_samples
+
+
+@pytest.fixture
+def samples():
+    return pd.read_csv(f'{ROOT}/datasets/diamonds/diamonds_clean.csv').sample(40, random_state=0).reset_index(drop=True)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    # Never promoted, so the served models don't change
+    return TrainPipeline(buffer=FreshDataBuffer(str(tmp_path / 'buffer.csv')), min_rows=20, max_rmse_increase=-1.0,
+                         feature_cache=FeatureMatrixCache(str(tmp_path / 'feature_cache')))
+
+
+def test_drop_keeps_the_samples_appended_after_the_read(tmp_path, samples):
+    buffer = FreshDataBuffer(str(tmp_path / 'buffer.csv'))
+    buffer.append(samples.iloc[:10])
+    n_read = len(buffer.read())
+    buffer.append(samples.iloc[10:15])
+
+    buffer.drop(n_read)
+    pd.testing.assert_frame_equal(buffer.read(), samples.iloc[10:15].reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize('column, value', [('price', np.nan), ('depth', np.inf), ('cut', None)])
+def test_invalid_samples_are_refused(samples, column, value):
+    samples.loc[3, column] = value
+    with pytest.raises(ValueError, match=column):
+        check_training_samples(samples)
+
+
+@requires_models
+def test_invalid_samples_never_reach_the_buffer(pipeline, samples):
+    samples.loc[0, 'price'] = np.nan
+    with pytest.raises(Exception, match='price'):
+        pipeline.train(samples)
+    assert pipeline.buffer.stats()[0] == 0
+
+
+@requires_models
+def test_failed_update_moves_its_samples_aside(pipeline, samples):
+    # A bad sample written to the buffer by an older version
+    bad = samples.iloc[:20].copy()
+    bad.loc[0, 'price'] = np.nan
+    pipeline.buffer.append(bad)
+
+    with pytest.raises(Exception):
+        pipeline.update()
+    assert pipeline.buffer.stats()[0] == 0
+    assert len(pd.read_csv(pipeline.buffer.rejected_path)) == 20
+
+    # The next updates are not affected
+    assert pipeline.train(samples.iloc[20:])['updated']
+
+
+@requires_models
+def test_concurrent_training_requests_lose_no_samples(pipeline, samples):
+    results = []
+
+    def train(rows):
+        results.append(pipeline.train(rows))
+
+    threads = [threading.Thread(target=train, args=(samples.iloc[start:start + 5],)) for start in range(0, 40, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    trained = sum(result['buffered_samples'] for result in results if result['updated'])
+    assert trained + pipeline.buffer.stats()[0] == len(samples)
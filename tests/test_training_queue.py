@@ -0,0 +1,58 @@
+import types
+
+import pandas as pd
+import pytest
+
+from conftest import ROOT  # noqa: F401, puts the repository on sys.path
+from src.pipelines.training_queue import TrainingJobQueue, TrainingWorker, BUFFERED, SUCCEEDED, FAILED
+
+
+class FakePipeline:
+    """
+    Buffers the samples and updates the model once the buffer holds min_rows of them.
+    """
+
+    def __init__(self, min_rows=3, fail=False):
+        self.rows = 0
+        self.min_rows = min_rows
+        self.fail = fail
+        self.buffer = types.SimpleNamespace(stats=lambda: (self.rows, None))
+
+    def train(self, features):
+        self.rows += features.shape[0]
+        if self.rows < self.min_rows:
+            return {'buffered_samples': self.rows, 'updated': False}
+        trained, self.rows = self.rows, 0
+        if self.fail:
+            raise ValueError('update failed')
+        return {'buffered_samples': trained, 'updated': True}
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return TrainingJobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+def _submit(job_queue, worker):
+    job_id = job_queue.enqueue(pd.DataFrame({'carat': [0.3, 0.4], 'price': [500.0, 600.0]}))
+    worker.run_once()
+    return job_id
+
+
+def test_buffered_jobs_succeed_with_the_update(job_queue):
+    worker = TrainingWorker(job_queue, pipeline=FakePipeline())
+    first = _submit(job_queue, worker)
+    assert job_queue.get(first)['status'] == BUFFERED
+
+    second = _submit(job_queue, worker)
+    for job_id in (first, second):
+        job = job_queue.get(job_id)
+        assert job['status'] == SUCCEEDED
+        assert job['metrics'] == {'buffered_samples': 4, 'updated': True}
+
+
+def test_buffered_jobs_fail_with_the_update(job_queue):
+    worker = TrainingWorker(job_queue, pipeline=FakePipeline(fail=True))
+    first = _submit(job_queue, worker)
+    second = _submit(job_queue, worker)
+    assert [job_queue.get(job_id)['status'] for job_id in (first, second)] == [FAILED, FAILED]
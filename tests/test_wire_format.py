@@ -0,0 +1,110 @@
+import sys
+import json
+import subprocess
+
+import numpy as np
+import pytest
+
+from conftest import ROOT, requires_models
+from src import wire_format
+from src.wire_format import JSON, MSGPACK, ARROW, InvalidPayload, request_format, response_format, decode_request, encode_response
+from src.decoding import decode_features
+
+SAMPLE = {'carat': [0.3, 1.1], 'cut': ['Ideal', 'Premium'], 'color': ['E', 'G'], 'clarity': ['VS1', 'SI2'],
+          'depth': [61.5, 62.0], 'table': [55.0, 58.0], 'x': [4.3, 6.6], 'y': [4.35, 6.6], 'z': [2.65, 4.1]}
+
+
+@pytest.mark.parametrize('content_type, expected', [
+    (None, JSON),
+    ('application/json; charset=utf-8', JSON),
+    ('application/msgpack', MSGPACK),
+    ('application/x-msgpack', MSGPACK),
+    ('application/vnd.apache.arrow.stream', ARROW),
+    ('text/plain', JSON),
+])
+def test_request_format(content_type, expected):
+    assert request_format(content_type) == expected
+
+
+@pytest.mark.parametrize('accept, expected', [
+    (None, JSON),
+    ('*/*', JSON),
+    ('application/msgpack', MSGPACK),
+    ('application/json;q=0.5, application/vnd.apache.arrow.stream', ARROW),
+    ('application/msgpack, application/json', MSGPACK),
+    ('application/msgpack;q=0, application/json', JSON),
+    ('application/msgpack;q=oops, application/vnd.msgpack;q=0.2', MSGPACK),
+])
+def test_response_format(accept, expected):
+    assert response_format(accept) == expected
+
+
+def test_msgpack_columns_decode_like_json():
+    msgpack = pytest.importorskip('msgpack')
+    payload = dict(SAMPLE, carat=np.asarray(SAMPLE['carat'], dtype='<f8').tobytes())
+    columns = decode_request(msgpack.packb(payload, use_bin_type=True), MSGPACK)
+    assert isinstance(columns['carat'], np.ndarray)
+    assert decode_features(columns).equals(decode_features(decode_request(json.dumps(SAMPLE).encode(), JSON)))
+
+
+def test_arrow_stream_decodes_like_json():
+    pa = pytest.importorskip('pyarrow')
+    table = pa.table(SAMPLE)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    columns = decode_request(sink.getvalue().to_pybytes(), ARROW)
+    assert decode_features(columns).equals(decode_features(SAMPLE))
+
+
+def test_arrow_response_holds_rows_and_metadata():
+    pa = pytest.importorskip('pyarrow')
+    result = {'predicted_prices': [512.0, None], 'rejected': [{'index': 1, 'reason': 'out of range'}],
+              'model_version': 'v1'}
+    table = pa.ipc.open_stream(encode_response(result, ARROW)).read_all()
+    assert table.column('predicted_price').to_pylist() == [512.0, None]
+    assert table.column('reason').to_pylist() == [None, 'out of range']
+    assert json.loads(table.schema.metadata[b'model_version']) == 'v1'
+
+
+def test_msgpack_response_round_trips():
+    msgpack = pytest.importorskip('msgpack')
+    result = {'predicted_price': 512.0}
+    assert msgpack.unpackb(encode_response(result, MSGPACK), raw=False) == result
+
+
+@pytest.mark.parametrize('body_format, package', [(MSGPACK, 'msgpack'), (ARROW, 'pyarrow')])
+def test_garbage_body_is_refused(body_format, package):
+    pytest.importorskip(package)
+    with pytest.raises(InvalidPayload):
+        decode_request(b'\xc1 not a payload', body_format)
+
+
+def test_missing_package_is_reported(monkeypatch):
+    monkeypatch.setitem(wire_format._PACKAGES, MSGPACK, 'not_an_installed_package')
+    with pytest.raises(wire_format.UnsupportedFormat):
+        decode_request(b'', MSGPACK)
+
+
+# Posts the same bodies to the Flask app and prints the status and body of every response
+FLASK_REQUESTS = '''
+import sys, json
+import Xtream_API
+
+client = Xtream_API.app.test_client()
+responses = [client.post(path, data=body, content_type=content_type) for path, body, content_type in json.loads(sys.argv[1])]
+print(json.dumps([(response.status_code, response.json) for response in responses]))
+'''
+
+
+@requires_models
+def test_flask_reads_bodies_like_the_asgi_app(api_env):
+    row = json.dumps({name: values[0] for name, values in SAMPLE.items()})
+    requests = [('/predict', row, 'text/plain'), ('/predict', row, None), ('/predict', '{"carat": 0.3,', 'application/json')]
+    process = subprocess.run([sys.executable, '-c', FLASK_REQUESTS, json.dumps(requests)], cwd=ROOT, env=api_env,
+                             capture_output=True, text=True, timeout=300)
+    assert process.returncode == 0, process.stderr[-2000:]
+    (plain_status, plain), (untyped_status, untyped), (invalid_status, invalid) = json.loads(process.stdout.splitlines()[-1])
+    assert plain_status == untyped_status == 200
+    assert plain['predicted_price'] == untyped['predicted_price'] is not None
+    assert invalid_status == 400 and 'valid JSON' in invalid['error']